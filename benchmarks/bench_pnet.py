@@ -0,0 +1,163 @@
+"""
+Micro-benchmarks for the ``pnet`` header classes.
+
+Compares the compiled struct layouts against the original per-field
+implementation, which resolved every field type and called
+``struct.calcsize`` on each parse and re-encoded the whole header on
+every field assignment, and the Internet checksum against the original
+word at a time implementation.
+
+Run with ``python benchmarks/bench_pnet.py``.
+"""
+from __future__ import print_function
+import struct
+import timeit
+import ipaddress
+import os
+import pnet
+from pnet.msg import TYPES, msg
+
+
+def legacy_checksum(*data):
+    data = b''.join(data)
+
+    if len(data) % 2:
+        data += b'\x00'
+
+    csum = sum(struct.unpack('!H', data[x:x+2])[0]
+               for x in range(0, len(data), 2))
+
+    csum = (csum >> 16) + (csum & 0xffff)
+    csum += csum >> 16
+    return ~csum & 0xffff
+
+
+class legacy(msg):
+    """The original, uncompiled, field handling."""
+    @classmethod
+    def parse(cls, buf, offset=0):
+        self = cls(buf=buf, offset=offset)
+        try:
+            self._decode()
+        except struct.error as e:
+            raise pnet.ParseError(str(e))
+        return self
+
+    def _get_routine(self, mode, fmt):
+        fmt = TYPES.get(fmt, fmt)
+        if isinstance(fmt, dict):
+            return (fmt['format'], fmt.get(mode, lambda x: x))
+        else:
+            return (fmt, lambda x: x)
+
+    def _decode(self):
+        self.offset = 0
+        for field in self.fields:
+            name, sfmt = field[:2]
+            fmt, routine = self._get_routine('decode', sfmt)
+            size = struct.calcsize(fmt)
+            value = struct.unpack_from(fmt, self.buf, self.offset)
+            if len(value) == 1:
+                value = value[0]
+            dict.__setitem__(self, name, routine(value))
+            self.offset += size
+
+    def _encode(self):
+        buf = bytearray(len(self.buf))
+        self.offset = 0
+
+        for field in self.fields:
+            name, fmt = field[:2]
+            default = b'\x00' if len(field) <= 2 else field[2]
+            fmt, routine = self._get_routine('encode', fmt)
+
+            size = struct.calcsize(fmt)
+            if dict.get(self, name) is None:
+                if not isinstance(default, bytes):
+                    struct.pack_into(fmt, buf, self.offset, default)
+            else:
+                value = routine(dict.get(self, name))
+                if not isinstance(value, (set, tuple, list)):
+                    value = [value]
+                struct.pack_into(fmt, buf, self.offset, *value)
+
+            self.offset += size
+
+        self.buf[:self.offset] = buf[:self.offset]
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if not self.buf.readonly:
+            self._encode()
+
+
+class legacy_ethhdr(legacy, pnet.ethhdr):
+    pass
+
+
+class legacy_ip4hdr(legacy, pnet.ip4hdr):
+    pass
+
+
+class legacy_udphdr(legacy, pnet.udphdr):
+    pass
+
+
+IMPLEMENTATIONS = {
+    'legacy': (legacy_ethhdr, legacy_ip4hdr, legacy_udphdr),
+    'compiled': (pnet.ethhdr, pnet.ip4hdr, pnet.udphdr),
+}
+
+SRC = pnet.HWAddress(b'\x02\x00\x00\x00\x00\x01')
+BROADCAST = pnet.HWAddress(u'ff:ff:ff:ff:ff:ff')
+DST = ipaddress.IPv4Address(u'255.255.255.255')
+
+
+def build(ethhdr, ip4hdr, udphdr, data=b'\x00' * 300):
+    size = ethhdr.min_size + ip4hdr.min_size + udphdr.min_size
+    packet = bytearray(len(data) + size)
+    eth = ethhdr({'src': SRC, 'dst': BROADCAST, 'type': pnet.ETH_P_IP},
+                 buf=packet)
+    ip4 = ip4hdr({'dst': DST, 'proto': 17,
+                  'len': len(data) + ip4hdr.min_size + udphdr.min_size},
+                 buf=eth.payload)
+    udp = udphdr({'sport': 68, 'dport': 67,
+                  'len': len(data) + udphdr.min_size},
+                 buf=ip4.payload)
+    ip4['csum'] = 0xffff
+    udp['csum'] = 0xffff
+    udp.payload = data
+    return packet
+
+
+def parse(ethhdr, ip4hdr, udphdr, frame):
+    eth = ethhdr.parse(frame)
+    ip4 = ip4hdr.parse(eth.payload)
+    udp = udphdr.parse(ip4.payload)
+    # the fields a DHCP receive loop actually looks at
+    return eth['type'], ip4['proto'], udp['dport'], udp.payload
+
+
+def bench(name, func, number):
+    elapsed = min(timeit.repeat(func, number=number, repeat=5))
+    print('{:<24} {:>12,.0f} ops/s'.format(name, number / elapsed))
+
+
+def main(number=20000):
+    frame = bytes(build(*IMPLEMENTATIONS['compiled']))
+    for impl, classes in sorted(IMPLEMENTATIONS.items()):
+        bench('{} parse'.format(impl),
+              lambda: parse(*(classes + (frame,))), number)
+        bench('{} build'.format(impl), lambda: build(*classes), number)
+
+    header = os.urandom(pnet.udphdr.min_size)
+    for size in (64, 256, 576, 1024, 1500):
+        payload = os.urandom(size)
+        for impl, func in (('compiled', pnet.checksum),
+                           ('legacy', legacy_checksum)):
+            bench('{} checksum {}B'.format(impl, size),
+                  lambda: func(header, payload), number)
+
+
+if __name__ == '__main__':
+    main()
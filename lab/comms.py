@@ -8,12 +8,235 @@
 Communication drivers and connection management.
 """
 from builtins import object
+import time
+import inspect
 import logging
-from lab.ssh import get_ssh, get_sftp
+import threading
+import contextlib
+from lab.ssh import get_ssh, get_sftp, SSHCommsError, SSHException
 
 
 log = logging.getLogger(name='lab.comms')
 
+# errors after which a connection is checked and re-established
+RECONNECT_ERRORS = (SSHCommsError, SSHException, EOFError)
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class SessionPool(object):
+    """A pool of up to ``size`` connections to a location, handed out
+    to concurrent callers one at a time.
+
+    Idle connections are health checked every ``check_interval`` seconds
+    in the background and dropped if they went down, so callers are
+    handed a working connection without paying for the check themselves.
+
+    Parameters
+    ----------
+    location : the location to connect to
+    factory : callable returning a new connection to a location
+    is_up : predicate which returns True if a connection is up
+    size : int, maximum number of connections to open
+    check_interval : float, seconds between health checks of idle
+        connections
+    """
+    def __init__(self, location, factory, is_up, size=4, check_interval=30):
+        self.location = location
+        self.factory = factory
+        self.is_up = is_up
+        self.size = size
+        self.check_interval = check_interval
+        self.closed = False
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._count = 0
+        # time callers spent waiting for a connection
+        self.waits = 0
+        self.wait_time = 0.
+        self.max_wait = 0.
+
+        self._checker = threading.Thread(target=self._check_idle)
+        self._checker.daemon = True
+        self._checker.start()
+
+    def acquire(self, timeout=None):
+        """Take a connection out of the pool, opening a new one if the
+        pool isn't full yet, otherwise block until one is released.
+        """
+        start = time.time()
+        with self._cond:
+            while not self._idle and self._count >= self.size:
+                if self.closed:
+                    raise RuntimeError('Session pool is closed')
+
+                remaining = None if timeout is None \
+                    else start + timeout - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout('No connection to {} available after '
+                                      '{}s'.format(self.location, timeout))
+                self._cond.wait(remaining)
+
+            self._record_wait(time.time() - start)
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+
+        try:
+            session = self.factory(self.location)
+        except Exception:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+        log.debug("Opened pooled connection {} of {} to {}".format(
+            self._count, self.size, self.location))
+        return session
+
+    def release(self, session, discard=False):
+        """Return a connection to the pool, or close it if ``discard``
+        is set or the pool has been closed.
+        """
+        with self._cond:
+            if discard or self.closed:
+                self._count -= 1
+            else:
+                self._idle.append(session)
+            self._cond.notify()
+
+        if discard or self.closed:
+            self._close_session(session)
+
+    @contextlib.contextmanager
+    def session(self, timeout=None):
+        session = self.acquire(timeout)
+        try:
+            yield session
+        except Exception:
+            self.release(session, discard=not self._alive(session))
+            raise
+        else:
+            self.release(session)
+
+    def _record_wait(self, waited):
+        if waited > 0.001:
+            self.waits += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def _alive(self, session):
+        try:
+            return self.is_up(session)
+        except Exception:
+            return False
+
+    def _close_session(self, session):
+        try:
+            session.close()
+        except Exception:
+            log.exception("Failed to close pooled connection to {}".format(
+                self.location))
+
+    def _check_idle(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.check_interval)
+                if self.closed:
+                    return
+                idle, self._idle = self._idle, []
+
+            # check outside of the lock so callers aren't held up
+            dead = [session for session in idle if not self._alive(session)]
+
+            with self._cond:
+                for session in idle:
+                    if session in dead:
+                        self._count -= 1
+                    else:
+                        self._idle.append(session)
+                self._cond.notify_all()
+
+            for session in dead:
+                log.debug("Dropping dead pooled connection to {}".format(
+                    self.location))
+                self._close_session(session)
+
+    def statistics(self):
+        with self._cond:
+            return {'size': self.size,
+                    'connections': self._count,
+                    'idle': len(self._idle),
+                    'waits': self.waits,
+                    'wait_time': self.wait_time,
+                    'max_wait': self.max_wait}
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+            self._cond.notify_all()
+
+        for session in idle:
+            self._close_session(session)
+
+
+class PooledCommand(object):
+    """A remote command which is run on whichever pooled connection is
+    available at the time it's called.
+    """
+    def __init__(self, pool, name, args=()):
+        self.pool = pool
+        self.name = name
+        self.args = tuple(args)
+
+    def __getitem__(self, args):
+        if not isinstance(args, tuple):
+            args = (args,)
+        return PooledCommand(self.pool, self.name, self.args + args)
+
+    def _bind(self, machine):
+        cmd = machine[self.name]
+        return cmd[self.args] if self.args else cmd
+
+    def __call__(self, *args, **kwargs):
+        with self.pool.session() as machine:
+            return self._bind(machine)(*args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        with self.pool.session() as machine:
+            return self._bind(machine).run(*args, **kwargs)
+
+    def popen(self, *args, **kwargs):
+        # the process outlives the session, which is free to be reused
+        with self.pool.session() as machine:
+            return self._bind(machine).popen(*args, **kwargs)
+
+    def __repr__(self):
+        return 'PooledCommand({!r}, {!r})'.format(self.name, self.args)
+
+
+class SSHPool(SessionPool):
+    """A :py:class:`SessionPool` of ssh machines which can be used much
+    like a single machine: ``pool['ls']('-l')`` runs on any available
+    connection, while anything else needs an explicit session::
+
+        with pool.session() as ssh:
+            ssh.cwd.chdir('/tmp')
+            ssh['ls']()
+    """
+    def __init__(self, location, size=4, check_interval=30):
+        super(SSHPool, self).__init__(
+            location, get_ssh, lambda ssh: ssh._session.alive(),
+            size=size, check_interval=check_interval)
+
+    def __getitem__(self, name):
+        return PooledCommand(self, name)
+
 
 _registry = {
     'ssh': {
@@ -21,6 +244,11 @@ _registry = {
         'is_up': lambda ssh: ssh._session.alive(),
         'magic_methods': ['__getitem__']
     },
+    'ssh_pool': {
+        'factory': lambda location, **kwargs: SSHPool(location, **kwargs),
+        'is_up': lambda pool: not pool.closed,
+        'magic_methods': ['__getitem__']
+    },
     'sftp': {
         'factory': lambda location: get_sftp(location),
         'is_up': lambda sftp: sftp.get_channel().active,
@@ -39,62 +267,178 @@ def register(name, factory, is_up, **kwargs):
 class Reliable(object):
     """A reliable connection proxy which attempts to re-establish an
     underlying connection to a location if it goes down.
+
+    Once the connection has been found to be up it is trusted for the
+    next ``liveness_interval`` seconds without checking again. A method call
+    failing with a connection error invalidates that, and the call is
+    retried once on a re-established connection. The same goes for
+    running commands looked up on the proxy, like ``proxy['ls']()``.
     """
-    def __init__(self, location, factory, is_up, **kwargs):
+    def __init__(self, location, factory, is_up, liveness_interval=1.0,
+                 **kwargs):
         self.location = location
         self.factory = factory
         # predicate which returns True if our underlying connection is up
         self.is_up = is_up
+        self.liveness_interval = liveness_interval
         self.kwargs = kwargs
-        # cached connection
+        # cached connection and until when it's trusted to be up
         self._driver = None
+        self._expires = 0
 
     @property
     def driver(self):
+        if time.time() < self._expires:
+            return self._driver
+
         if self._driver is None or not self.is_up(self._driver):
             self._driver = self.factory(self.location, **self.kwargs)
             log.debug("Reconnected driver {}".format(self._driver))
 
+        self._expires = time.time() + self.liveness_interval
         return self._driver
 
+    def invalidate(self):
+        """Check the connection again on next use."""
+        self._expires = 0
+
+    def _call(self, lookup, *args, **kwargs):
+        try:
+            return lookup(self.driver)(*args, **kwargs)
+        except RECONNECT_ERRORS as err:
+            log.warning("Connection to {} failed, retrying: {}".format(
+                self.location, err))
+            self.invalidate()
+            return lookup(self.driver)(*args, **kwargs)
+
+    def _lookup(self, lookup, *args):
+        result = self._call(lookup, *args)
+        if hasattr(result, 'popen'):
+            # a command, which is looked up again should running it fail
+            return ReliableCommand(
+                self, lambda driver: lookup(driver)(*args))
+        return result
+
     def __repr__(self):
         clsname = type(self).__name__
         return object.__repr__(self).replace(
             clsname, '{}({})'.format(clsname, repr(self.driver)))
 
     def __getattr__(self, attr):
-        return getattr(self.driver, attr)
+        value = getattr(self.driver, attr)
+        if not inspect.ismethod(value):
+            return value
+
+        def method(*args, **kwargs):
+            return self._call(lambda driver: getattr(driver, attr),
+                              *args, **kwargs)
+        return method
 
     def __dir__(self):
         return sorted(set(dir(type(self.driver)) + list(
             self.driver.__dict__.keys())))
 
 
-def reliable_proxy(location, key):
+class ReliableCommand(object):
+    """A command looked up on a :py:class:`Reliable` proxy, e.g. with
+    ``proxy['ls']``, which is looked up again on a re-established
+    connection and retried once should running it fail with a connection
+    error.
+    """
+    def __init__(self, proxy, lookup):
+        self.proxy = proxy
+        self.lookup = lookup
+
+    @property
+    def command(self):
+        """The command bound to the current connection."""
+        return self.lookup(self.proxy.driver)
+
+    def _run(self, name, *args, **kwargs):
+        return self.proxy._call(
+            lambda driver: getattr(self.lookup(driver), name),
+            *args, **kwargs)
+
+    def __getitem__(self, args):
+        return ReliableCommand(
+            self.proxy, lambda driver: self.lookup(driver)[args])
+
+    def __call__(self, *args, **kwargs):
+        return self._run('__call__', *args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        return self._run('run', *args, **kwargs)
+
+    def popen(self, *args, **kwargs):
+        return self._run('popen', *args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.command, attr)
+
+    # pipelines, redirection and modifiers apply to the bound command
+    def __or__(self, other):
+        if isinstance(other, ReliableCommand):
+            other = other.command
+        return self.command | other
+
+    def __ror__(self, other):
+        return other | self.command
+
+    def __gt__(self, other):
+        return self.command > other
+
+    def __lt__(self, other):
+        return self.command < other
+
+    def __rshift__(self, other):
+        return self.command >> other
+
+    def __and__(self, other):
+        return self.command & other
+
+    def __str__(self):
+        return str(self.command)
+
+    def __repr__(self):
+        return 'ReliableCommand({!r})'.format(self.command)
+
+
+def _magic_method(name):
+    def method(proxy, *args):
+        return proxy._lookup(
+            lambda driver: getattr(type(driver), name).__get__(driver),
+            *args)
+    return method
+
+
+def reliable_proxy(location, key, **kwargs):
     """Create reliable proxy instance for a communications driver according to
-    the registry.
+    the registry. Any ``kwargs`` are passed on to the driver's factory.
     """
     # Since we pop 'magic_methods' below but also need that list for every new
     # proxy instance, we copy the original registered map.
     data = _registry[key].copy()
+    data.update(kwargs)
     return type(
         'ReliableProxy',
         (Reliable,),
-        {name: lambda proxy, *args:
-            getattr(type(proxy.driver), name)(proxy.driver, *args)
-         for name in data.pop('magic_methods', [])}
+        {name: _magic_method(name) for name in data.pop('magic_methods', [])}
     )(location, **data)
 
 
 class connection(object):
     """A descriptor for declaring connection types on role controllers
     which does lazy loading of a ``Reliable`` proxy wrapper.
+
+    Any ``kwargs`` are passed on to the driver's factory, for example
+    ``connection('ssh_pool', size=8)``.
     """
     def __init__(self, key, **kwargs):
         if key not in _registry:
             raise KeyError(
                 "No comms driver for {} has been registered".format(key))
         self.key = key
+        self.kwargs = kwargs
         self._proxies = {}
 
     def __get__(self, ctl, type=None):
@@ -106,7 +450,7 @@ class connection(object):
         if proxy is None:
             logging.debug("Creating new {} connection for {}"
                           .format(self.key, ctl.location))
-            proxy = reliable_proxy(ctl.location, self.key)
+            proxy = reliable_proxy(ctl.location, self.key, **self.kwargs)
             self._proxies[ctl.location] = proxy
 
         return proxy
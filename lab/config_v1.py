@@ -1,6 +1,17 @@
+import os
+import pickle
+import hashlib
+import tempfile
 import importlib
 from enum import Enum
-from ruamel import yaml
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from ruamel.yaml import YAML
+
+# bumped whenever what's cached changes
+CACHE_VERSION = 3
 
 
 class LabConfigError(Exception):
@@ -48,12 +59,88 @@ class Union(dict):
         raise KeyError(key)
 
 
-def load(config_path):
-    with config_path.open() as fp:
-        config = yaml.load(fp.read(), yaml.RoundTripLoader)
-
-    envs = dict(_parse_environments(config.get('environments', {})))
-    zones = dict(_parse_zones(config.get('zones', {})))
+class LazyMap(Mapping):
+    """A read-only mapping of raw map sections which are only parsed, by
+    ``parse(name, section)``, once they're first looked up.
+    """
+    def __init__(self, sections, parse):
+        self.sections = sections
+        self.parse = parse
+        self.parsed = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.parsed[name]
+        except KeyError:
+            data = self.parsed[name] = self.parse(name, self.sections[name])
+            return data
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def __len__(self):
+        return len(self.sections)
+
+
+def _cache_file(cache_dir, config_path):
+    digest = hashlib.sha1(
+        os.path.abspath(str(config_path)).encode('utf-8')).hexdigest()
+    return os.path.join(str(cache_dir), 'map-{}.pickle'.format(digest))
+
+
+def _read_cache(cachefile, key):
+    try:
+        with open(cachefile, 'rb') as fp:
+            cached_key, data = pickle.load(fp)
+    except Exception:
+        return None
+    return data if cached_key == key else None
+
+
+def _write_cache(cachefile, key, data):
+    # write atomically, concurrent sessions may share the cache
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cachefile))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump((key, data), fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, cachefile)
+    except Exception:
+        os.unlink(tmpfile)
+        raise
+
+
+def load(config_path, cache_dir=None, roundtrip=False):
+    """Load the environments and zones of a map file.
+
+    The map is parsed with the safe loader unless ``roundtrip`` is set.
+    With a ``cache_dir`` the parsed map is cached there, keyed by the
+    file's content hash and modification time, so it's only parsed again
+    once it changes.
+
+    Environments and zones are returned as :py:class:`LazyMap`, only the
+    ones which are looked up are parsed.
+    """
+    with config_path.open('rb') as fp:
+        contents = fp.read()
+
+    cachefile = key = config = None
+    if cache_dir is not None:
+        key = (hashlib.sha1(contents).hexdigest(),
+               os.path.getmtime(str(config_path)), roundtrip,
+               CACHE_VERSION)
+        cachefile = _cache_file(cache_dir, config_path)
+        config = _read_cache(cachefile, key)
+
+    if config is None:
+        # the safe loader parses YAML 1.2 like the round trip one, but
+        # uses libyaml when it's available
+        config = YAML(typ='rt' if roundtrip else 'safe').load(contents)
+        config = config or {}
+        if cachefile:
+            _write_cache(cachefile, key, config)
+
+    envs = LazyMap(config.get('environments') or {}, _parse_environment)
+    zones = LazyMap(config.get('zones') or {}, _parse_zone)
     return envs, zones
 
 
@@ -101,13 +188,11 @@ def _parse_common(yaml, domain=None):
     return data
 
 
-def _parse_zones(config):
-    for name, yaml in config.items():
-        name_is_domain = len(name.split('.')) > 1
-        domain = name if name_is_domain else None
-        yield name, _parse_common(yaml, domain)
+def _parse_zone(name, yaml):
+    name_is_domain = len(name.split('.')) > 1
+    domain = name if name_is_domain else None
+    return _parse_common(yaml, domain)
 
 
-def _parse_environments(config):
-    for name, yaml in config.items():
-        yield name, _parse_common(yaml)
+def _parse_environment(name, yaml):
+    return _parse_common(yaml)
@@ -7,13 +7,24 @@
 """
 Log monitoring and capture.
 """
-from builtins import next
 from builtins import str
 from builtins import object
+import io
+import os
+import re
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
 import posixpath
 import itertools
 import logging
+from collections import namedtuple, OrderedDict
 import plumbum
+from plumbum.commands import shquote
+from lab.utils import encode_path
 
 
 logger = logging.getLogger('logwatch')
@@ -25,62 +36,276 @@ def get_ssh(ctl):
     return ctl.ssh if getattr(ctl.ssh, '_session', None) else ctl.ssh()
 
 
+# remote compression command and file suffix
+COMPRESSORS = {
+    'gzip': ('gzip -c', '.gz'),
+    'zstd': ('zstd -c -q', '.zst'),
+    None: (None, ''),
+}
+
+# Pipe a reader into a compressor, exiting with the reader's status if
+# the compressor succeeded; not every remote sh has ``set -o pipefail``
+PIPELINE = ('exec 3>&1; status=$({{ {{ {reader}; echo $? >&4; }} | '
+            '{compressor} >&3; }} 4>&1) || exit; exit $status')
+
+LogStat = namedtuple('LogStat', 'st_ino,st_size,st_mtime')
+
+
+def parse_stat_listing(output):
+    """Parse ``stat -c '%i %s %Y %n'`` output into a dict of
+    ``LogStat`` by file name."""
+    stats = {}
+    for line in output.splitlines():
+        try:
+            inode, size, mtime, name = line.split(' ', 3)
+            stats[name] = LogStat(int(inode), int(size), int(mtime))
+        except ValueError:
+            continue
+    return stats
+
+
+def rotation_chain(stats, logname):
+    """Return the names of a log and its contiguously numbered rotations
+    found in ``stats``, newest first."""
+    chain = []
+    name = logname
+    for idx in itertools.count(1):
+        if name not in stats:
+            return chain
+        chain.append(name)
+        name = posixpath.extsep.join((logname, str(idx)))
+
+
+def appended_ranges(mark, chain):
+    """Work out which parts of a log's rotation chain were written since
+    ``mark`` was taken.
+
+    Parameters
+    ----------
+    mark : ``(inode, size)`` of the log when it was marked, or None if it
+        didn't exist
+    chain : list of ``(log, stat)`` for the log and its rotations, newest
+        first
+
+    Returns
+    -------
+    ranges : list of ``(log, offset)`` to read from, oldest first
+    """
+    if not chain:
+        return []
+    if mark is None:
+        return [(chain[0][0], 0)]
+
+    inode, size = mark
+    for idx, (log, stat) in enumerate(chain):
+        if stat.st_ino != inode:
+            continue
+
+        newer = [(newer_log, 0) for newer_log, _ in reversed(chain[:idx])]
+        if stat.st_size >= size:
+            return [(log, size)] + newer
+
+        # Truncated in place (logrotate's copytruncate), so the rest of
+        # what was marked went to the next rotation
+        ranges = [(log, 0)] + newer
+        if idx + 1 < len(chain) and chain[idx + 1][1].st_size >= size:
+            ranges.insert(0, (chain[idx + 1][0], size))
+        return ranges
+
+    # The marked file was rotated beyond the numbered chain (compressed
+    # or removed), only the current log is known to be new
+    logger.warning('Lost track of {} across log rotation'.format(
+        chain[0][0]))
+    return [(chain[0][0], 0)]
+
+
 class logfiles(object):
     """A log capture source for files found at a remote location.
+
+    By default logs are truncated before each test and read back in full.
+    With ``incremental=True`` remote logs are left untouched instead: the
+    inode and size of every log is recorded on :py:meth:`prepare` and
+    :py:meth:`capture` only fetches what was appended since, following
+    the log across rotations.
+
+    :py:meth:`capture_to` streams logs into local files compressed with
+    ``compress``, one of ``'gzip'`` (the default), ``'zstd'`` or None.
     """
-    def __init__(self, ctl, *tables):
+    def __init__(self, ctl, *tables, **kwargs):
         self.ctl = ctl
         self.ssh = get_ssh(ctl)
         self.logtable = tables
         self.ident = ctl.hostname
+        self.incremental = kwargs.pop('incremental', False)
+        self.compress = kwargs.pop('compress', 'gzip')
+        # log path -> (inode, size) at prepare time
+        self.marks = {}
 
-    def iterlogs(self):
-        """Iterate through all log rotation based variations of a log
-        that exists. """
-        def numbered_log(ctl, logdir, logname):
-            remote = self.ssh.path(logdir)
-            remote_log = remote.join(logname)
+    def numbered_logs(self, logdir, logname):
+        """Iterate through a log and all of its rotations that exist."""
+        remote = self.ssh.path(logdir)
+        remote_log = remote.join(logname)
+
+        # Should (it shouldn't) discontinuous numbering happen for
+        # any reason, we won't notice. Might cause problems.
+        # Hopefully not something we'll have to deal with...
+        for idx in itertools.count(1):
             if not remote_log.exists():
                 return
             yield remote_log
+            remote_log = remote.join(posixpath.extsep.join(
+                (logname, str(idx))))
 
-            # Should (it shouldn't) discontinuous numbering happen for
-            # any reason, we won't notice. Might cause problems.
-            # Hopefully not something we'll have to deal with...
-            for idx in itertools.count(1):
-                remote_log = remote.join(posixpath.extsep.join(
-                    (logname, str(idx))))
-                if not remote_log.exists():
-                    return
-                yield remote_log
-
+    def iterlogs(self):
+        """Iterate through all log rotation based variations of a log
+        that exists. """
         for logdir, logfiles in self.logtable:
             for logfile in logfiles:
                 # This yields another generator. I did not intend for this
                 # to be a yield from
-                yield numbered_log(self.ctl, logdir, logfile)
+                yield self.numbered_logs(logdir, logfile)
+
+    def _logdirs(self):
+        logdirs = OrderedDict()
+        for logdir, logfiles in self.logtable:
+            logdirs.setdefault(str(logdir), []).extend(logfiles)
+        return logdirs
+
+    def discover(self, logdir, lognames):
+        """Stat every log in ``lognames`` and all their rotations in
+        ``logdir`` with a single remote command.
+
+        Returns a dict of ``LogStat`` by file name.
+        """
+        patterns = ' '.join('{0} {0}.[0-9]*'.format(shquote(name))
+                            for name in lognames)
+        script = 'cd {} && stat -c "%i %s %Y %n" -- {}'.format(
+            shquote(logdir), patterns)
+        # stat fails on globs which match nothing, but lists the rest
+        _, out, _ = self.ssh['sh']['-c', script].run(retcode=None)
+        return parse_stat_listing(out)
+
+    def iterchains(self):
+        """Iterate through ``(path, chain)`` for every log, where chain
+        lists ``(log, stat)`` for the log and its rotations, newest first.
+        """
+        for logdir, lognames in self._logdirs().items():
+            stats = self.discover(logdir, lognames)
+            remote = self.ssh.path(logdir)
+            for logname in lognames:
+                chain = [(remote.join(name), stats[name])
+                         for name in rotation_chain(stats, logname)]
+                yield posixpath.join(logdir, logname), chain
 
     def prepare(self):
-        """Prepare by truncating all existing logs."""
+        """Prepare by truncating all existing logs, or when incremental,
+        by marking where each log currently ends."""
+        if self.incremental:
+            logger.info('Marking logs for {}'.format(self.ident))
+            self.marks = {}
+            for path, chain in self.iterchains():
+                if chain:
+                    stat = chain[0][1]
+                    self.marks[path] = (stat.st_ino, stat.st_size)
+            return
+
         logger.info('Truncating logs for {}'.format(self.ident))
-        for logset in self.iterlogs():
-            log = next(logset, None)
-            if not log:
+        for logdir, lognames in self._logdirs().items():
+            stats = self.discover(logdir, lognames)
+            truncate, remove = [], []
+            for logname in lognames:
+                chain = rotation_chain(stats, logname)
+                truncate.extend(chain[:1])
+                remove.extend(chain[1:])
+
+            if not truncate:
                 continue
+            # Truncate by replacing it with an empty file
+            script = 'cd {} && {}'.format(shquote(logdir), ' && '.join(
+                ['> {}'.format(shquote(name)) for name in truncate] +
+                (['rm -f -- {}'.format(' '.join(map(shquote, remove)))]
+                 if remove else [])))
+            self.ssh['sh']('-c', script)
+
+    def _ranges(self):
+        """Iterate through ``(log, offset)`` for everything to capture."""
+        for path, chain in self.iterchains():
+            if self.incremental:
+                sizes = {str(log): stat.st_size for log, stat in chain}
+                ranges = appended_ranges(self.marks.get(path), chain)
+            else:
+                sizes = None
+                ranges = [(log, 0) for log, stat in chain if stat.st_size]
 
-            log.write('')  # Truncate by replacing it with an empty file
-            for log in logset:
-                log.unlink()
+            for log, offset in ranges:
+                if sizes is None or sizes[str(log)] > offset:
+                    yield log, offset
+
+    def _reader(self, log, offset):
+        if not offset:
+            return 'cat {}'.format(shquote(str(log)))
+        return 'tail -c +{} {}'.format(offset + 1, shquote(str(log)))
+
+    def _read(self, log, offset):
+        if not offset:
+            return log.read()
+        return self.ssh['tail']('-c', '+{}'.format(offset + 1), str(log))
 
     def capture(self):
         """Capture logs for provided controller."""
         logger.info('Capturing logs for {}'.format(self.ident))
-        for log in itertools.chain.from_iterable(self.iterlogs()):
-            if log.stat().st_size > 0:
-                logger.debug('Captured {} for {}'.format(
-                    log.name, self.ident
-                ))
-                yield log, log.read()
+        for log, offset in self._ranges():
+            contents = self._read(log, offset)
+            if contents:
+                logger.debug('Captured {} from offset {} for {}'.format(
+                    log.name, offset, self.ident))
+                yield log, contents
+
+    def capture_to(self, directory):
+        """Stream logs for the provided controller into local files in
+        ``directory``, compressed on the remote side as they're sent.
+
+        Yields ``(log, path)`` for every file written.
+        """
+        logger.info('Capturing logs for {} into {}'.format(
+            self.ident, directory))
+        compressor, suffix = COMPRESSORS[self.compress]
+        for log, offset in self._ranges():
+            target = os.path.join(str(directory),
+                                  encode_path(str(log)) + suffix)
+            script = self._reader(log, offset)
+            if compressor:
+                script = PIPELINE.format(reader=script,
+                                         compressor=compressor)
+
+            proc = self.ssh['sh']['-c', script].popen()
+            # drain stderr alongside, a remote filling it can't block
+            stderr = []
+            drain = threading.Thread(
+                target=lambda: stderr.append(proc.stderr.read()))
+            drain.daemon = True
+            drain.start()
+            try:
+                with open(target, 'wb') as fp:
+                    shutil.copyfileobj(proc.stdout, fp, 1 << 16)
+                proc.wait()
+                drain.join()
+            except Exception:
+                proc.kill()
+                if os.path.exists(target):
+                    os.unlink(target)
+                raise
+
+            if proc.returncode:
+                # don't leave a partial capture among the good ones
+                os.unlink(target)
+                logger.error('Failed to capture {} for {}: {}'.format(
+                    log, self.ident, b''.join(stderr)))
+                continue
+
+            logger.debug('Captured {} from offset {} for {}'.format(
+                log.name, offset, self.ident))
+            yield log, target
 
 
 class journal(object):
@@ -106,3 +331,314 @@ class journal(object):
         except plumbum.ProcessExecutionError as err:
             if '-- Logs begin at' not in err.stdout:
                 logger.exception("Failed to capture journal log")
+
+
+def format_journal_entry(entry):
+    """Format a ``journalctl -o json`` entry like ``-o short-iso``."""
+    message = entry.get('MESSAGE', '')
+    if isinstance(message, list):
+        # non UTF-8 messages are sent as a list of byte values
+        message = bytes(bytearray(message)).decode('utf-8', 'replace')
+
+    usec = int(entry.get('__REALTIME_TIMESTAMP', 0))
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S',
+                              time.gmtime(usec // 1000000))
+    ident = entry.get('SYSLOG_IDENTIFIER') or entry.get('_COMM', '')
+    pid = entry.get('_PID')
+    if pid:
+        ident = '{}[{}]'.format(ident, pid)
+    return u'{}.{:06d}Z {} {}: {}\n'.format(
+        timestamp, usec % 1000000, entry.get('_HOSTNAME', ''), ident,
+        message)
+
+
+class journalstream(object):
+    """A log capture source which follows a systemd unit's journal in
+    the background.
+
+    A single ``journalctl -f -o json`` runs for the lifetime of the
+    source, spooling entries to a local file as they arrive. Tests are
+    delimited by the journal cursor of the last entry seen, so capturing
+    only has to copy the spooled entries since :py:meth:`prepare`. If the
+    stream drops it's restarted with ``--after-cursor``, so no entries
+    are lost or duplicated.
+
+    Parameters
+    ----------
+    ctl : the role ctl whose journal to follow
+    unit : str, the systemd unit
+    sync_timeout : float, seconds to wait at capture for the stream to
+        catch up to the remote journal
+    compress : the compression :py:meth:`capture_to` streams the spooled
+        entries through, as for ``logfiles``
+    """
+    def __init__(self, ctl, unit, sync_timeout=5, compress='gzip'):
+        self.ctl = ctl
+        self.ssh = get_ssh(ctl)
+        self.unit = unit
+        self.sync_timeout = sync_timeout
+        self.compress = compress
+
+        self._cond = threading.Condition()
+        self._spool = tempfile.TemporaryFile()
+        self._size = 0
+        # cursors spooled since the last prepare
+        self._cursors = set()
+        self._proc = None
+        self._closed = False
+
+        # Follow on from the unit's latest entry, so it's known to have
+        # been received even if the unit stays idle
+        try:
+            self.cursor = self._remote_cursor()
+        except plumbum.ProcessExecutionError:
+            logger.exception('Failed to query the journal cursor')
+            self.cursor = None
+
+        self._thread = threading.Thread(target=self._follow)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _command(self):
+        args = ['--unit', self.unit, '--follow', '--output', 'json',
+                '--no-pager']
+        if self.cursor:
+            args.extend(['--after-cursor', self.cursor])
+        else:
+            args.extend(['--lines', '0'])
+        return self.ssh['journalctl'][tuple(args)]
+
+    def _follow(self):
+        while not self._closed:
+            try:
+                self._proc = self._command().popen()
+                for line in iter(self._proc.stdout.readline, b''):
+                    self._append(json.loads(line.decode('utf-8')))
+                self._proc.wait()
+            except Exception:
+                logger.exception('Journal stream for {} failed'.format(
+                    self.unit))
+
+            if not self._closed:
+                logger.warning('Journal stream for {} ended, restarting '
+                               'after cursor {}'.format(self.unit,
+                                                        self.cursor))
+                time.sleep(1)
+
+    def _append(self, entry):
+        data = format_journal_entry(entry).encode('utf-8')
+        with self._cond:
+            if self._closed:
+                return
+            self._spool.seek(self._size)
+            self._spool.write(data)
+            self._size += len(data)
+            self.cursor = entry['__CURSOR']
+            self._cursors.add(self.cursor)
+            self._cond.notify_all()
+
+    def _remote_cursor(self):
+        """Return the cursor of the unit's latest entry in the journal."""
+        out = self.ssh['journalctl']('--unit', self.unit, '--lines', '1',
+                                     '--output', 'json', '--no-pager')
+        for line in out.splitlines():
+            if line.strip():
+                return json.loads(line)['__CURSOR']
+
+    def _sync(self):
+        """Wait for the stream to catch up to the remote journal."""
+        try:
+            target = self._remote_cursor()
+        except plumbum.ProcessExecutionError:
+            logger.exception('Failed to query the journal cursor')
+            return
+
+        deadline = time.time() + self.sync_timeout
+        with self._cond:
+            while target and target != self.cursor and \
+                    target not in self._cursors:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.warning('Journal stream for {} is lagging '
+                                   'behind'.format(self.unit))
+                    return
+                self._cond.wait(remaining)
+
+    def prepare(self):
+        """Mark the start of a test at the last entry received.
+
+        Entries spooled before are dropped, so the spool only ever holds
+        a single test's worth.
+        """
+        self._sync()
+        with self._cond:
+            self._spool.seek(0)
+            self._spool.truncate()
+            self._size = 0
+            self._cursors = set()
+            logger.info('Journal for {} marked at cursor {}'.format(
+                self.unit, self.cursor))
+
+    def _copy_spooled(self, fp):
+        """Copy the entries spooled since :py:meth:`prepare` into ``fp``,
+        returning how many bytes were copied."""
+        self._sync()
+        with self._cond:
+            self._spool.seek(0)
+            remaining = length = self._size
+            while remaining:
+                chunk = self._spool.read(min(remaining, 1 << 16))
+                fp.write(chunk)
+                remaining -= len(chunk)
+            return length
+
+    def capture(self):
+        data = io.BytesIO()
+        if self._copy_spooled(data):
+            yield self.unit, data.getvalue().decode('utf-8')
+
+    def capture_to(self, directory):
+        """Stream the entries since :py:meth:`prepare` into a local file in
+        ``directory``, compressed with ``compress``.
+        """
+        compressor, suffix = COMPRESSORS[self.compress]
+        target = os.path.join(str(directory),
+                              '{}.journal{}'.format(self.unit, suffix))
+        with open(target, 'wb') as fp:
+            if compressor:
+                proc = subprocess.Popen(compressor.split(),
+                                        stdin=subprocess.PIPE, stdout=fp)
+                try:
+                    length = self._copy_spooled(proc.stdin)
+                finally:
+                    proc.stdin.close()
+                    proc.wait()
+                if proc.returncode:
+                    length = 0
+                    logger.error('Failed to compress the journal of '
+                                 '{}'.format(self.unit))
+            else:
+                length = self._copy_spooled(fp)
+
+        if not length:
+            os.unlink(target)
+            return
+        yield self.unit, target
+
+    def close(self):
+        """Stop following the journal and drop the spool."""
+        with self._cond:
+            self._closed = True
+            self._spool.close()
+        if self._proc and self._proc.poll() is None:
+            self._proc.kill()
+
+
+# inline flags applying to a whole pattern, e.g. (?i)
+GLOBAL_FLAGS = re.compile(r'(?<!\\)\(\?[aiLmsux]+\)')
+
+
+class PatternMatcher(object):
+    """Match lines against many regular expressions at once.
+
+    The patterns are compiled into a single alternation so every line is
+    scanned once, however many patterns there are. Global inline flags
+    like ``(?i)`` would apply to every pattern and aren't allowed, use a
+    scoped ``(?i:...)`` instead.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        for pattern in self.patterns:
+            self._check(pattern)
+        self.regex = re.compile('|'.join(
+            '(?P<p{}>(?:{}))'.format(idx, pattern)
+            for idx, pattern in enumerate(self.patterns)))
+
+    @staticmethod
+    def _check(pattern):
+        if GLOBAL_FLAGS.search(pattern):
+            raise ValueError('Global inline flags in log pattern {!r}, use '
+                             'scoped flags like (?i:...)'.format(pattern))
+        for name in re.compile(pattern).groupindex:
+            if re.match(r'p\d+$', name):
+                raise ValueError('Group name {} in log pattern {!r} is '
+                                 'reserved'.format(name, pattern))
+
+    def search(self, line):
+        """Return the first pattern found in ``line``, or None."""
+        match = self.regex.search(line)
+        if match:
+            # the outermost group closes last, so it names the pattern
+            return self.patterns[int(match.lastgroup[1:])]
+
+
+class logtail(object):
+    """Follow remote logs in the background, calling
+    ``on_match(ctl, log, pattern, line)`` for every line matching one of
+    ``patterns``.
+
+    A single ``tail -F`` follows every log in ``tables``, so logs which
+    are rotated or don't exist yet are picked up as they appear.
+    """
+    def __init__(self, ctl, patterns, *tables, **kwargs):
+        self.ctl = ctl
+        self.ssh = get_ssh(ctl)
+        self.logtable = tables
+        self.matcher = PatternMatcher(patterns)
+        self.on_match = kwargs.pop('on_match', None)
+        self.matches = []
+        self._proc = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._follow)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _paths(self):
+        return [posixpath.join(str(logdir), logname)
+                for logdir, lognames in self.logtable
+                for logname in lognames]
+
+    def _follow(self):
+        paths = self._paths()
+        # tail only prints headers when following several files
+        log = paths[0] if len(paths) == 1 else None
+        while not self._closed:
+            try:
+                self._proc = self.ssh['tail'][
+                    ('-F', '-n', '0') + tuple(paths)].popen()
+                for line in iter(self._proc.stdout.readline, b''):
+                    line = line.decode('utf-8', 'replace').rstrip('\n')
+                    if line.startswith('==> ') and line.endswith(' <=='):
+                        log = line[4:-4]
+                        continue
+                    self._match(log, line)
+                self._proc.wait()
+            except Exception:
+                logger.exception('Following logs on {} failed'.format(
+                    self.ctl))
+
+            if not self._closed:
+                logger.warning('Following logs on {} ended, '
+                               'restarting'.format(self.ctl))
+                time.sleep(1)
+
+    def _match(self, log, line):
+        pattern = self.matcher.search(line)
+        if pattern is None:
+            return
+        logger.warning('Found {!r} in {} on {}: {}'.format(
+            pattern, log, self.ctl, line))
+        self.matches.append((log, pattern, line))
+        if self.on_match:
+            self.on_match(self.ctl, log, pattern, line)
+
+    def close(self):
+        """Stop following logs."""
+        self._closed = True
+        if self._proc and self._proc.poll() is None:
+            self._proc.kill()
+
+    def join(self, timeout=None):
+        """Wait for the background thread to finish after closing."""
+        self._thread.join(timeout)
@@ -8,23 +8,23 @@
 This module contains the following networkng helpers:
 
 - ip address generator for the localhost
-- best route calculator
+- best route calculator (memoized)
 """
 from __future__ import print_function
 from __future__ import absolute_import
 from builtins import str
 from builtins import next
 from builtins import range
-import pyroute2
-import pyroute2.iproute
 import plumbum
 from .ping import ping_cmds
+from .netlink import get_cache
+from .routes import get_resolver
 from . import utils
 from .utils import *
 
 # re-exports
 from pyroute2 import NetlinkError
-from .macvlan import MacVLan
+from .macvlan import MacVLan, MacVLanSet
 
 
 def find_best_route(dst_host, dev_list=None, version=4):
@@ -45,38 +45,31 @@ def find_best_route(dst_host, dev_list=None, version=4):
     Returns
     -------
     ifacename, ipaddr: tuple of (<interface name>, <ipaddr>)
-    '''
-    dst_host = utils.check_ipaddr(dst_host, version=version)[0]
-    family = utils.version_to_family(version)
-
-    RT_TABLE_MAIN = 254
 
-    with pyroute2.IPDB() as ipdb:
-        # We have to do it manually for now because the ipdb.routes API
-        # to too buggy at the moment.
-        routes = ipdb.nl.get_routes(family=family, dst=str(dst_host),
-                                    table=RT_TABLE_MAIN)
+    Routes are cached until the kernel reports a route, address or link
+    change, or for at most ``RouteResolver.ttl`` seconds.
+    '''
+    return get_resolver().resolve(dst_host, version=version)
 
-        try:
-            route = routes[0]
-        except IndexError:
-            raise RuntimeError('No suitable route found')
 
-        rta_oif = route.get_attr('RTA_OIF')
-        interface = ipdb.interfaces[rta_oif]
+def find_best_routes(dst_hosts, version=4):
+    '''
+    Return the best interface and IP to reach each of ``dst_hosts``,
+    resolving every uncached destination in a single netlink request.
 
-        for addr in utils.iter_addrs(interface):
-            if addr.version == version and not addr.is_link_local:
-                return interface['ifname'], addr.ip
+    Returns
+    -------
+    routes : dict of {<dst_host>: (<interface name>, <ipaddr>)}
+    '''
+    return get_resolver().resolve_many(dst_hosts, version=version)
 
 
 def ip_ifaces(version=4):
     '''return the list of ips corresponding to each NIC'''
-    with pyroute2.IPDB() as ipdb:
-        for ifname, data in ipdb.by_name.items():
-            for addr in utils.iter_addrs(data):
-                if addr.version == version and not addr.is_link_local:
-                    yield ifname, addr
+    for ifname, data in get_cache().interfaces().items():
+        for addr in utils.iter_addrs(data):
+            if addr.version == version and not addr.is_link_local:
+                yield ifname, addr
 
 
 def ping(addr):
@@ -5,7 +5,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from builtins import object
+import os
 import time
+import heapq
+import itertools
 import select
 import socket
 import fcntl
@@ -13,11 +16,12 @@ import struct
 import logging
 import threading
 import ipaddress
-import errno
 import pnet
 from pnet import udphdr, ethhdr, ip4hdr, dhcp4
 from pnet.bpf import attach_filter
+from pnet.ring import open_receiver, BatchReceiver
 from pnet.dhcp4 import DHCPPacket, DHCPMessage, DHCPOption, DHCPOpCode, bootp_filter
+from .netlink import get_cache
 
 
 SIOCGIFHWADDR = 0x8927
@@ -49,20 +53,35 @@ def generate_packet(src, data):
                   'len': len(data) + udphdr.min_size},
                  buf=ip4.payload)
 
-    ip4['csum'] = pnet.checksum(ip4.tobytes())
+    ip4['csum'] = pnet.checksum(ip4.buf[:ip4.offset])
     udp['csum'] = pnet.ipv4_checksum(ip4, udp, data)
     udp.payload = data
     return packet
 
 
 class DHCP4Socket(object):
-    def __init__(self, ifname):
+    """A raw socket receiving BOOTP frames on ``ifname``.
+
+    Sockets driven by a ``DHCP4Engine`` are created with ``poll=False``,
+    as the engine polls them, and with ``ring=False`` to receive into the
+    engine's shared buffer ``pool`` rather than a ring of their own.
+    """
+    def __init__(self, ifname, ring=True, poll=True, pool=None):
         self.ifname = ifname
-        self.poll = select.epoll()
+        self.closed = False
+        self.poll = select.epoll() if poll else None
         self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
                                   socket.htons(pnet.ETH_P_ALL))
-        self.poll.register(self.sock, select.POLLIN | select.POLLPRI |
-                           select.POLLHUP | select.POLLERR)
+        if self.poll:
+            self.poll.register(self.sock, select.POLLIN | select.POLLPRI |
+                               select.POLLHUP | select.POLLERR)
+        # Drain many frames per wakeup, from a kernel mapped ring if we can
+        if ring:
+            self.rx = open_receiver(self.sock)
+        else:
+            self.rx = BatchReceiver(self.sock, pool=pool)
+        logger.debug('Receiving on {} with {}'.format(
+            ifname, type(self.rx).__name__))
         attach_filter(self.sock, bootp_filter())
         self.sock.setblocking(0)
         self.sock.bind((ifname, 3))
@@ -80,23 +99,20 @@ class DHCP4Socket(object):
             return
 
         def recv_all():
-            while True:
+            for frame in self.rx.recv():
                 try:
-                    payload, addr = self.sock.recvfrom(0x1000)
-                    eth = ethhdr.parse(payload)
-                    ip4 = ip4hdr.parse(eth.payload)
-                    udp = udphdr.parse(ip4.payload)
-                    reply = DHCPPacket.parse(udp.payload)
-                except socket.error as e:
-                    if e.errno != errno.EAGAIN:
-                        raise e
-                    return None
+                    payload = frame.payload
+                    if DHCPPacket.peek_xid(payload) != packet.xid:
+                        frame.release()
+                        continue
+                    # NOTE: the reply's options reference the frame's
+                    # buffer, so it must outlive this receive
+                    reply = DHCPPacket.parse(frame.detach().payload)
                 except pnet.ParseError:
+                    frame.release()
                     continue
 
-                if reply.xid != packet.xid:
-                    continue
-                elif reply.message_type != expect:
+                if reply.message_type != expect:
                     raise RuntimeError('DHCP protocol error')
                 return reply
 
@@ -125,6 +141,17 @@ class DHCP4Socket(object):
 
         raise RuntimeError('Failed to acquire dhcp lease')
 
+    def statistics(self):
+        """Frame counters for this socket, including kernel drops."""
+        return self.rx.statistics()
+
+    def close(self):
+        self.closed = True
+        if self.poll:
+            self.poll.close()
+        self.rx.close()
+        self.sock.close()
+
 
 def build_options(message_type, chaddr, requested_ip=None,
                   hostname=None, vendor=None):
@@ -157,40 +184,290 @@ def build_options(message_type, chaddr, requested_ip=None,
     return common
 
 
+class Transaction(object):
+    """A DHCP request which is waiting on a reply of type ``expect``."""
+    def __init__(self, sock, packet, expect):
+        self.sock = sock
+        self.packet = packet
+        self.expect = expect
+        self.frame = generate_packet(sock.src, packet.tobytes())
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting on DHCP reply')
+        if self._error:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, callback):
+        """Call ``callback(transaction)`` once a reply or error is in."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _set(self, result=None, error=None):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception('DHCP callback {} failed'.format(callback))
+
+
+class Timer(object):
+    """A callback scheduled on a ``DHCP4Engine``."""
+    def __init__(self, deadline, seq, callback):
+        self.deadline = deadline
+        self.seq = seq
+        self.callback = callback
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+    def cancel(self):
+        self.callback = None
+
+
+class DHCP4Engine(object):
+    """Run the DHCP exchanges of any number of interfaces from a single
+    thread.
+
+    The engine owns every interface's socket in one epoll set, matches
+    replies to outstanding transactions by ``xid`` and drives
+    retransmissions, timeouts and lease renewals from a timer heap.
+    Frames from all sockets are received into one shared buffer pool.
+    """
+    def __init__(self):
+        self.poll = select.epoll()
+        self.pool = pnet.BufferPool()
+        self._lock = threading.Lock()
+        self._sockets = {}  # ifname -> [DHCP4Socket, refcount]
+        self._fds = {}  # fileno -> DHCP4Socket
+        self._pending = {}  # xid -> Transaction
+        self._timers = []
+        self._seq = itertools.count()
+
+        # self-pipe to interrupt a blocking poll when timers change
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self.poll.register(self._wakeup_r, select.POLLIN)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def attach(self, ifname):
+        """Return the engine's socket for ``ifname``, creating it as needed.
+        """
+        with self._lock:
+            entry = self._sockets.get(ifname)
+            if entry is None:
+                sock = self._open(ifname)
+                entry = self._sockets[ifname] = [sock, 0]
+                self._fds[sock.sock.fileno()] = sock
+                self.poll.register(sock.sock, select.POLLIN | select.POLLPRI |
+                                   select.POLLHUP | select.POLLERR)
+            entry[1] += 1
+            return entry[0]
+
+    def _open(self, ifname):
+        return DHCP4Socket(ifname, ring=False, poll=False, pool=self.pool)
+
+    def detach(self, sock):
+        """Drop a reference to ``sock``, closing it with the last one."""
+        with self._lock:
+            entry = self._sockets[sock.ifname]
+            entry[1] -= 1
+            if entry[1]:
+                return
+            del self._sockets[sock.ifname]
+            del self._fds[sock.sock.fileno()]
+            self.poll.unregister(sock.sock)
+        sock.close()
+
+    def call_later(self, delay, callback):
+        """Run ``callback`` from the engine thread after ``delay`` seconds.
+        """
+        timer = Timer(time.time() + delay, next(self._seq), callback)
+        with self._lock:
+            heapq.heappush(self._timers, timer)
+        os.write(self._wakeup_w, b'\x00')
+        return timer
+
+    def exchange(self, sock, packet, expect, interval=2, retry=3,
+                 timeout=10):
+        """Send ``packet`` on ``sock`` and return a ``Transaction`` which
+        completes with the first reply carrying its ``xid``.
+
+        Like ``DHCP4Socket.send`` the packet is sent ``retry`` times,
+        ``interval`` seconds apart, and the transaction fails after
+        ``timeout`` seconds.
+        """
+        transaction = Transaction(sock, packet, expect)
+        with self._lock:
+            self._pending[packet.xid] = transaction
+
+        def transmit(remaining):
+            if transaction.done():
+                return
+            sock.sock.send(transaction.frame)
+            if remaining > 1:
+                self.call_later(interval, lambda: transmit(remaining - 1))
+
+        def expire():
+            with self._lock:
+                self._pending.pop(packet.xid, None)
+            transaction._set(
+                error=RuntimeError('Failed to acquire dhcp lease'))
+
+        self.call_later(0, lambda: transmit(retry))
+        self.call_later(timeout, expire)
+        return transaction
+
+    def _dispatch(self, sock):
+        for frame in sock.rx.recv():
+            try:
+                xid = DHCPPacket.peek_xid(frame.payload)
+                with self._lock:
+                    transaction = self._pending.get(xid)
+                if transaction is None:
+                    frame.release()
+                    continue
+                reply = DHCPPacket.parse(frame.detach().payload)
+            except pnet.ParseError:
+                frame.release()
+                continue
+
+            with self._lock:
+                self._pending.pop(xid, None)
+
+            if reply.message_type != transaction.expect:
+                transaction._set(error=RuntimeError('DHCP protocol error'))
+            else:
+                transaction._set(result=reply)
+
+    def _run_timers(self):
+        """Run all expired timers and return the time until the next."""
+        while True:
+            with self._lock:
+                if not self._timers:
+                    return -1
+                timeout = self._timers[0].deadline - time.time()
+                if timeout > 0:
+                    return timeout
+                timer = heapq.heappop(self._timers)
+
+            if timer.callback:
+                try:
+                    timer.callback()
+                except Exception:
+                    logger.exception('DHCP timer {} failed'.format(
+                        timer.callback))
+
+    def _run(self):
+        while True:
+            timeout = self._run_timers()
+            for fd, _ in self.poll.poll(timeout):
+                if fd == self._wakeup_r:
+                    os.read(fd, 0x1000)
+                    continue
+
+                with self._lock:
+                    sock = self._fds.get(fd)
+                if sock is None or sock.closed:
+                    continue
+                try:
+                    self._dispatch(sock)
+                except Exception:
+                    # the socket may have been detached and closed since
+                    if not sock.closed:
+                        logger.exception('Receiving on {} failed'.format(
+                            sock.ifname))
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process wide ``DHCP4Engine``."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = DHCP4Engine()
+        return _engine
+
+
 class DHCP4(object):
-    def __init__(self, iface):
+    def __init__(self, iface, engine=None, wait=True):
+        """Start acquiring a lease for ``iface``.
+
+        By default this blocks until the lease is acquired and its
+        address is set on ``iface``. With ``wait=False`` it returns right
+        away, leaving the caller to ``wait()`` and assign the address.
+        """
         self.iface = iface
-        self.sock = DHCP4Socket(iface.ifname)
+        self.engine = engine or get_engine()
+        self.sock = self.engine.attach(iface.ifname)
 
         self._yiaddr = None
         self._subnet_mask = None
+        self._error = None
+        self._renewal = None
+        self._closed = False
         self._ready_event = threading.Event()
-        self._stop_event = threading.Event()
-        self._thread = threading.Thread(target=self._lease)
-        self._thread.daemon = True
-        self._thread.start()
-        if not self._ready_event.wait(10.0):
-            raise RuntimeError('Failed to get DHCP lease')
 
-        logger.info('Setting {} on {}...'.format(self.yiaddr,
-                                                 self.iface.ifname))
-        self.iface.add_ip(self.yiaddr.compressed,
-                          mask=self.subnet_mask.compressed)
-        self.iface.commit()
+        self._discover()
+        if wait:
+            self.wait()
+            logger.info('Setting {} on {}...'.format(self.yiaddr,
+                                                     self.iface.ifname))
+            get_cache().add_address(self.iface.index, self.yiaddr.compressed,
+                                    self.prefixlen)
+
+    def wait(self, timeout=10.0):
+        """Block until the lease is acquired."""
+        if not self._ready_event.wait(timeout) or self._error:
+            if not self._closed:
+                self._closed = True
+                self.engine.detach(self.sock)
+            raise RuntimeError('Failed to get DHCP lease')
 
     def _discover(self, src=None):
         logger.info('Sending DHCP4 discover on {}...'.format(self.iface.ifname))
         chaddr = src or self.sock.src
         options = build_options(DHCPMessage.Discover, chaddr)
         packet = DHCPPacket(DHCPOpCode.Request, chaddr=chaddr, options=options)
-        return self.sock.send(packet, src=src, expect=DHCPMessage.Offer)
+        transaction = self.engine.exchange(self.sock, packet,
+                                           DHCPMessage.Offer)
+        transaction.add_done_callback(self._on_offer)
+        return transaction
 
     def _request(self, yiaddr, src=None):
         logger.info('Sending DHCP4 request on {}...'.format(self.iface.ifname))
         chaddr = src or self.sock.src
         options = build_options(DHCPMessage.Request, chaddr, requested_ip=yiaddr)
         packet = DHCPPacket(DHCPOpCode.Request, chaddr=chaddr, options=options)
-        return self.sock.send(packet, src=src, expect=DHCPMessage.ACK)
+        transaction = self.engine.exchange(self.sock, packet,
+                                           DHCPMessage.ACK)
+        transaction.add_done_callback(self._on_ack)
+        return transaction
 
     def _release(self, yiaddr, src=None):
         logger.info('Sending DHCP4 release on {}...'.format(self.iface.ifname))
@@ -199,33 +476,52 @@ class DHCP4(object):
         packet = DHCPPacket(DHCPOpCode.Request, chaddr=chaddr, options=options)
         self.sock.send(packet, src=src)
 
-    def _lease(self):
-        offer = self._discover()
-        self._yiaddr = offer.yiaddr
-
-        while True:
-            reply = self._request(self._yiaddr)
-            options = dict(reply.options)
-
-            self._yiaddr = reply.yiaddr
-            self._subnet_mask = options[DHCPOption.SubnetMask].tobytes()
-            self._ready_event.set()
+    def _fail(self, err):
+        logger.error('DHCP4 on {} failed: {}'.format(self.iface.ifname, err))
+        self._error = err
+        self._ready_event.set()
 
-            # TODO: fix
-            lease_time = reply.secs
+    def _on_offer(self, transaction):
+        try:
+            offer = transaction.result()
+        except RuntimeError as err:
+            return self._fail(err)
 
-            # If there's either no leasetime, or the stop event has
-            # been set before our renew timeout, renew our lease
-            if not lease_time:
-                logger.debug('No lease time on DHCP lease!')
-                return
-            elif self._stop_event.wait(lease_time // 2):
-                logger.debug('Leaving DHCP renewal loop!')
-                return
+        self._yiaddr = offer.yiaddr
+        if not self._closed:
+            self._request(self._yiaddr)
+
+    def _on_ack(self, transaction):
+        try:
+            reply = transaction.result()
+        except RuntimeError as err:
+            return self._fail(err)
+
+        options = dict(reply.options)
+        self._yiaddr = reply.yiaddr
+        self._subnet_mask = options[DHCPOption.SubnetMask].tobytes()
+        self._ready_event.set()
+
+        # TODO: fix
+        lease_time = reply.secs
+
+        # If there's either no leasetime, or we've been closed before
+        # our renew timeout, don't renew our lease
+        if not lease_time:
+            logger.debug('No lease time on DHCP lease!')
+        elif not self._closed:
+            self._renewal = self.engine.call_later(
+                lease_time // 2, lambda: self._request(self._yiaddr))
 
     def close(self):
-        self._stop_event.set()
+        if self._closed:
+            return
+
+        self._closed = True
+        if self._renewal:
+            self._renewal.cancel()
         self._release(self._yiaddr)
+        self.engine.detach(self.sock)
 
     @property
     def yiaddr(self):
@@ -234,3 +530,8 @@ class DHCP4(object):
     @property
     def subnet_mask(self):
         return ipaddress.IPv4Address(self._subnet_mask)
+
+    @property
+    def prefixlen(self):
+        return ipaddress.ip_network(
+            u'0.0.0.0/{}'.format(self.subnet_mask)).prefixlen
@@ -9,21 +9,27 @@ from builtins import object
 import time
 import logging
 import socket
+import itertools
 import ipaddress
+from collections import namedtuple
 import pyroute2
+from pyroute2.netlink.rtnl.ifinfmsg import IFF_UP
 from .dhcp import DHCP4
+from .netlink import get_cache
 
 
 logger = logging.getLogger(__name__)
 
+Link = namedtuple('Link', 'ifname,index')
+
 
 def _generate_device_name(prefix):
-    with pyroute2.IPDB() as ipdb:
-        for idx in range(100):
-            name = '{}{}'.format(prefix, idx)
-            if name not in ipdb.interfaces:
-                return name
-        raise RuntimeError('Unable to allocate a {} interface'.format(prefix))
+    cache = get_cache()
+    for idx in range(100):
+        name = '{}{}'.format(prefix, idx)
+        if name not in cache:
+            return name
+    raise RuntimeError('Unable to allocate a {} interface'.format(prefix))
 
 
 class MacVLan(object):
@@ -57,29 +63,33 @@ class MacVLan(object):
         self.name = _generate_device_name(name)
         self.dhcp = None
 
-        self.ipdb = pyroute2.IPDB()
-        vlan = self.ipdb.create(kind='macvlan',
-                                link=self.ipdb.interfaces[interface],
-                                ifname=self.name,
-                                mode='bridge')
-        vlan.up()
-        vlan.commit()
+        self.cache = get_cache()
+        ipr = self.cache.ipr
+        ipr.link('add', ifname=self.name, kind='macvlan',
+                 link=self.cache.index(interface), macvlan_mode='bridge')
+        index = ipr.link_lookup(ifname=self.name)[0]
+        self.link = Link(self.name, index)
+        ipr.link('set', index=index, state='up')
+        self.cache.sync_links()
 
         # Start dhcp process if necessary
         if dhcp:
             try:
-                self.dhcp = DHCP4(vlan)
+                self.dhcp = DHCP4(self.link)
             except RuntimeError:
                 self.close()
                 raise
 
+    def _iter_ipaddrs(self):
+        for addr, prefix in self.cache[self.link.index]['ipaddr']:
+            yield addr
+
     @property
     def addresses(self):
         """Obtain information about the macvlan to determin its addresses."""
         data = {}
 
-        ipaddrs = self.ipdb.interfaces[self.name].ipaddr
-        for addr, prefix in ipaddrs:
+        for addr in self._iter_ipaddrs():
             addr = ipaddress.ip_address(addr)
             if addr.is_link_local:
                 continue
@@ -107,7 +117,7 @@ class MacVLan(object):
 
     @property
     def exists(self):
-        return self.ipdb and self.name in self.ipdb.interfaces
+        return bool(self.cache) and self.link.index in self.cache
 
     def close(self):
         """Delete the macvlan.
@@ -119,17 +129,161 @@ class MacVLan(object):
             self.dhcp.close()
             self.dhcp = None
 
-        if self.ipdb:
+        if self.cache:
             if self.exists:
-                try:
-                    iface = self.ipdb.interfaces[self.name]
-                    if iface.get('ipdb_scope') != 'create':
-                        iface.remove().commit()
-                except KeyError:
-                    pass
-
-            self.ipdb.release()
-            self.ipdb = None
+                self.cache.ipr.link('del', index=self.link.index)
+                self.cache.forget_link(self.link.index)
+            self.cache = None
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        if not exception_type:
+            self.close()
+
+
+class _MacVLanMember(MacVLan):
+    """A macvlan owned by a :py:class:`MacVLanSet`."""
+    def __init__(self, link, cache):
+        self.name = link.ifname
+        self.link = link
+        self.cache = cache
+        self.dhcp = None
+
+
+class MacVLanSet(list):
+    """Provision a set of ``count`` macvlans bound to ``interface`` at once.
+
+    All the devices are created and brought up with a single netlink
+    batch each, their DHCP leases are acquired concurrently and they're
+    deleted together again on :py:meth:`close`. Members support the same
+    API as a :py:class:`MacVLan`::
+
+        with MacVLanSet('eno1', 100) as vlans:
+            addrs = [vlan.get_address(socket.AF_INET) for vlan in vlans]
+
+    The ``NetlinkCache`` to use and the ``IPRoute`` to send batches on
+    can be given as ``cache`` and ``ipr``.
+    """
+    def __init__(self, interface, count, name='macvlan', dhcp=True,
+                 timeout=10, cache=None, ipr=None):
+        super(MacVLanSet, self).__init__()
+        self.cache = cache or get_cache()
+        # Batches get a socket of their own so their acks can't be
+        # mistaken for replies on the shared one
+        self.ipr = ipr or pyroute2.IPRoute()
+        try:
+            self._create(interface, count, name)
+            if dhcp:
+                self._lease(timeout)
+        except Exception as err:
+            # don't let a failed cleanup mask the original error
+            try:
+                self.close()
+            except Exception:
+                logger.exception('Failed to delete macvlans')
+            raise err
+
+    def _sync_links(self):
+        self.cache.sync_links()
+        return self.cache.names
+
+    def _create(self, interface, count, prefix):
+        links = self._sync_links()
+        parent = links[interface]
+        names = ('{}{}'.format(prefix, idx) for idx in itertools.count())
+        names = list(itertools.islice(
+            (name for name in names if name not in links), count))
+
+        def add(ipr, name):
+            ipr.link('add', ifname=name, kind='macvlan', link=parent,
+                     macvlan_mode='bridge')
+
+        batch = pyroute2.IPBatch()
+        for name in names:
+            add(batch, name)
+        self.ipr.sendto(batch.batch, (0, 0))
+
+        # Errors for a batch come back asynchronously, so check what was
+        # actually created and retry whatever is missing on its own to
+        # raise the appropriate NetlinkError
+        links = self._sync_links()
+        missing = [name for name in names if name not in links]
+        self.extend(_MacVLanMember(Link(name, links[name]), self.cache)
+                    for name in names if name in links)
+        for name in missing:
+            add(self.ipr, name)
+            index = self.ipr.link_lookup(ifname=name)[0]
+            self.append(_MacVLanMember(Link(name, index), self.cache))
+
+        batch.reset()
+        for vlan in self:
+            batch.link('set', index=vlan.link.index, state='up')
+        self.ipr.sendto(batch.batch, (0, 0))
+
+        # As above, bring up any link the batch failed to on its own
+        self.cache.sync_links()
+        for vlan in self:
+            flags = self.cache.get(vlan.link.index, {}).get('flags', 0)
+            if not flags & IFF_UP:
+                self.ipr.link('set', index=vlan.link.index, state='up')
+
+    def _lease(self, timeout):
+        for vlan in self:
+            vlan.dhcp = DHCP4(vlan.link, wait=False)
+
+        # The leases are all being acquired concurrently, so this waits
+        # at most ``timeout`` seconds overall
+        deadline = time.time() + timeout
+        batch = pyroute2.IPBatch()
+        for vlan in self:
+            vlan.dhcp.wait(max(0, deadline - time.time()))
+            logger.info('Setting {} on {}...'.format(vlan.dhcp.yiaddr,
+                                                     vlan.name))
+            batch.addr('add', index=vlan.link.index,
+                       address=vlan.dhcp.yiaddr.compressed,
+                       mask=vlan.dhcp.prefixlen)
+        self.ipr.sendto(batch.batch, (0, 0))
+
+        # Retry any address the batch failed to add to raise its error
+        self.cache.sync_addrs()
+        for vlan in self:
+            address = (vlan.dhcp.yiaddr.compressed, vlan.dhcp.prefixlen)
+            ipaddr = self.cache.get(vlan.link.index, {}).get('ipaddr', ())
+            if address not in ipaddr:
+                self.cache.add_address(vlan.link.index, *address)
+
+    def close(self):
+        """Release all leases and delete every macvlan in the set."""
+        if not getattr(self, 'ipr', None):
+            return
+
+        for vlan in self:
+            if vlan.dhcp:
+                vlan.dhcp.close()
+                vlan.dhcp = None
+
+        batch = pyroute2.IPBatch()
+        for vlan in self:
+            batch.link('del', index=vlan.link.index)
+            vlan.cache = None
+        try:
+            self.ipr.sendto(batch.batch, (0, 0))
+
+            # Delete any link the batch failed to on its own
+            self.cache.sync_links()
+            for vlan in self:
+                if vlan.link.index in self.cache:
+                    self.ipr.link('del', index=vlan.link.index)
+                    self.cache.forget_link(vlan.link.index)
+        finally:
+            self.ipr.close()
+            self.ipr = None
+            del self[:]
 
     def __del__(self):
         self.close()
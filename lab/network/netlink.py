@@ -0,0 +1,226 @@
+#
+# Copyright 2017 Sangoma Technologies Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+A process wide cache of the kernel's links and addresses.
+
+The cache is filled with a single dump and then kept current from RTNL
+multicast notifications, so interface lookups don't require dumping
+the kernel's state each time like a ``pyroute2.IPDB`` does.
+"""
+from builtins import object
+import time
+import logging
+import threading
+import pyroute2
+from pyroute2.netlink import rtnl
+
+
+logger = logging.getLogger(__name__)
+
+GROUPS = (rtnl.RTMGRP_LINK |
+          rtnl.RTMGRP_IPV4_IFADDR | rtnl.RTMGRP_IPV6_IFADDR |
+          rtnl.RTMGRP_IPV4_ROUTE | rtnl.RTMGRP_IPV6_ROUTE)
+
+
+def _link_name(msg):
+    return msg.get_attr('IFLA_IFNAME')
+
+
+def _addr_key(msg):
+    address = msg.get_attr('IFA_LOCAL') or msg.get_attr('IFA_ADDRESS')
+    return address, msg['prefixlen']
+
+
+class NetlinkCache(object):
+    """Links and their addresses, keyed by interface index.
+
+    Each interface is a dict with ``index``, ``ifname``, ``flags`` and
+    ``ipaddr`` keys, where ``ipaddr`` is a set of ``(address, prefixlen)``
+    tuples, mirroring the interface records of an ``IPDB``.
+
+    Parameters
+    ----------
+    ipr : the ``IPRoute`` to send requests on, a new one by default
+    events : the ``IPRoute`` to receive notifications on, by default a new
+        one bound to the link, address and route groups
+    """
+    def __init__(self, ipr=None, events=None):
+        self.lock = threading.RLock()
+        self.links = {}
+        self.names = {}
+        self._listeners = []
+
+        # shared socket for requests
+        self.ipr = ipr or pyroute2.IPRoute()
+
+        # Subscribe before the initial dump so no change can be missed
+        if events is None:
+            events = pyroute2.IPRoute()
+            events.bind(groups=GROUPS)
+        self._events = events
+        self.sync_links()
+        self.sync_addrs()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def subscribe(self, callback):
+        """Call ``callback(msg)`` for every RTNL notification received.
+
+        Should notifications be lost, e.g. when the socket's buffer
+        overflows, the cache is synced again and ``callback(None)`` is
+        called instead, as anything may have changed.
+        """
+        with self.lock:
+            self._listeners.append(callback)
+
+    def get(self, key, default=None):
+        """Return a copy of an interface by index or name."""
+        with self.lock:
+            index = self.names.get(key, key)
+            iface = self.links.get(index)
+            if iface is None:
+                return default
+            return dict(iface, ipaddr=set(iface['ipaddr']))
+
+    def __getitem__(self, key):
+        iface = self.get(key)
+        if iface is None:
+            raise KeyError(key)
+        return iface
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.names or key in self.links
+
+    def index(self, ifname):
+        with self.lock:
+            return self.names[ifname]
+
+    def interfaces(self):
+        """Return a snapshot of all interfaces keyed by name."""
+        with self.lock:
+            return {name: self.get(index)
+                    for name, index in self.names.items()}
+
+    def sync_links(self):
+        """Replace the cached links with a fresh dump."""
+        with self.lock:
+            links = {}
+            for msg in self.ipr.get_links():
+                iface = self.links.get(msg['index']) or {'ipaddr': set()}
+                iface.update(index=msg['index'], ifname=_link_name(msg),
+                             flags=msg['flags'])
+                links[msg['index']] = iface
+
+            self.links = links
+            self.names = {iface['ifname']: index
+                          for index, iface in links.items()}
+
+    def sync_addrs(self, index=None):
+        """Replace the cached addresses of every or a single interface
+        with a fresh dump.
+        """
+        with self.lock:
+            kwargs = {'index': index} if index is not None else {}
+            addrs = {}
+            for msg in self.ipr.get_addr(**kwargs):
+                addrs.setdefault(msg['index'], set()).add(_addr_key(msg))
+
+            targets = [index] if index is not None else list(self.links)
+            for idx in targets:
+                iface = self.links.get(idx)
+                if iface:
+                    iface['ipaddr'] = addrs.get(idx, set())
+
+    def add_address(self, index, address, prefixlen):
+        """Add an address to an interface and refresh its cached addresses."""
+        self.ipr.addr('add', index=index, address=address, mask=prefixlen)
+        self.sync_addrs(index)
+
+    def forget_link(self, index):
+        """Drop a link known to be deleted ahead of its notification."""
+        with self.lock:
+            iface = self.links.pop(index, None)
+            if iface:
+                self.names.pop(iface['ifname'], None)
+
+    def _apply(self, msg):
+        event = msg['event']
+        index = msg.get('index')
+
+        if event == 'RTM_NEWLINK':
+            name = _link_name(msg)
+            iface = self.links.setdefault(index, {'index': index,
+                                                  'ipaddr': set()})
+            if iface.get('ifname') not in (None, name):
+                self.names.pop(iface['ifname'], None)
+            iface['ifname'] = name
+            iface['flags'] = msg['flags']
+            self.names[name] = index
+        elif event == 'RTM_DELLINK':
+            self.forget_link(index)
+        elif event == 'RTM_NEWADDR' and index in self.links:
+            self.links[index]['ipaddr'].add(_addr_key(msg))
+        elif event == 'RTM_DELADDR' and index in self.links:
+            self.links[index]['ipaddr'].discard(_addr_key(msg))
+
+    def _resync(self):
+        """Sync the whole cache after notifications were lost."""
+        self.sync_links()
+        self.sync_addrs()
+        return [None]
+
+    def _notify(self, msgs):
+        with self.lock:
+            listeners = list(self._listeners)
+
+        for msg in msgs:
+            for callback in listeners:
+                try:
+                    callback(msg)
+                except Exception:
+                    logger.exception(
+                        'Netlink listener {} failed'.format(callback))
+
+    def _run(self):
+        failures = 0
+        while True:
+            try:
+                msgs = self._events.get()
+            except Exception:
+                # Most likely ENOBUFS, the kernel dropped notifications
+                logger.exception('Failed to read netlink notifications, '
+                                 'resyncing')
+                try:
+                    msgs = self._resync()
+                    failures = 0
+                except Exception:
+                    logger.exception('Failed to resync netlink cache')
+                    failures += 1
+                    time.sleep(min(0.1 * 2 ** failures, 5))
+                    continue
+            else:
+                with self.lock:
+                    for msg in msgs:
+                        self._apply(msg)
+
+            self._notify(msgs)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process wide ``NetlinkCache``."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = NetlinkCache()
+        return _cache
@@ -0,0 +1,221 @@
+#
+# Copyright 2017 Sangoma Technologies Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Memoized route resolution.
+
+Resolved routes are cached per destination for ``ttl`` seconds and the
+whole cache is dropped as soon as the kernel notifies us of a route,
+address or link change.
+"""
+from builtins import str
+from builtins import object
+import time
+import threading
+import ipaddress
+from . import utils
+from .netlink import get_cache
+
+
+RT_TABLE_DEFAULT = 253
+RT_TABLE_MAIN = 254
+RT_TABLE_LOCAL = 255
+# Tables consulted, in order, by the kernel's default policy rules
+DEFAULT_POLICY = (RT_TABLE_LOCAL, RT_TABLE_MAIN, RT_TABLE_DEFAULT)
+# Tables holding unicast routes to other hosts, in lookup order
+LOOKUP_TABLES = (RT_TABLE_MAIN, RT_TABLE_DEFAULT)
+RTN_UNICAST = 1
+
+# Notifications which may change the outcome of a route lookup
+INVALIDATING_EVENTS = frozenset(('RTM_NEWROUTE', 'RTM_DELROUTE',
+                                 'RTM_NEWADDR', 'RTM_DELADDR',
+                                 'RTM_NEWLINK', 'RTM_DELLINK'))
+
+
+def _route_network(msg, version):
+    dst = msg.get_attr('RTA_DST') or ('0.0.0.0' if version == 4 else '::')
+    return ipaddress.ip_network(u'{}/{}'.format(dst, msg['dst_len']))
+
+
+def _route_table(msg):
+    return msg.get_attr('RTA_TABLE') or msg['table']
+
+
+def _route_oif(msg):
+    oif = msg.get_attr('RTA_OIF')
+    if oif is None:
+        # Multipath routes, fall back to the first hop
+        hops = msg.get_attr('RTA_MULTIPATH') or ()
+        for hop in hops:
+            return hop['oif']
+    return oif
+
+
+class RouteResolver(object):
+    """Resolve and memoize the ``(ifname, addr)`` used to reach a host.
+
+    Parameters
+    ----------
+    ttl : float, seconds a resolved route remains valid
+    netlink : the ``NetlinkCache`` to use, the process wide one by default
+    """
+    def __init__(self, ttl=60, netlink=None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._netlink = netlink or get_cache()
+        self._netlink.subscribe(self._on_event)
+
+    def _on_event(self, msg):
+        # None after a resync, when anything may have changed
+        if msg is None or msg['event'] in INVALIDATING_EVENTS:
+            self.invalidate()
+
+    def invalidate(self):
+        """Drop every cached route."""
+        with self._lock:
+            self._routes.clear()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._routes.get(key)
+            if entry and entry[0] > time.time():
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def _store(self, key, route):
+        with self._lock:
+            self._routes[key] = (time.time() + self.ttl, route)
+
+    def _source(self, oif, version):
+        try:
+            interface = self._netlink[oif]
+        except KeyError:
+            raise RuntimeError('No suitable route found')
+
+        for addr in utils.iter_addrs(interface):
+            if addr.version == version and not addr.is_link_local:
+                return interface['ifname'], addr.ip
+
+    def resolve(self, dst_host, version=4):
+        """Return the ``(ifname, addr)`` to use to reach ``dst_host``."""
+        key = (dst_host, version)
+        hit, route = self._lookup(key)
+        if hit:
+            return route
+
+        dst = utils.check_ipaddr(dst_host, version=version)[0]
+        routes = self._netlink.ipr.get_routes(
+            family=utils.version_to_family(version), dst=str(dst),
+            table=RT_TABLE_MAIN)
+        try:
+            oif = _route_oif(routes[0])
+        except IndexError:
+            raise RuntimeError('No suitable route found')
+
+        route = self._source(oif, version)
+        self._store(key, route)
+        return route
+
+    def _default_policy(self, version):
+        """Whether routing only follows the kernel's default policy rules,
+        i.e. there's no policy routing and no VRFs."""
+        for rule in self._netlink.ipr.get_rules(
+                family=utils.version_to_family(version)):
+            table = rule.get_attr('FRA_TABLE') or rule['table']
+            if rule.get_attr('FRA_L3MDEV') or table not in DEFAULT_POLICY:
+                return False
+        return True
+
+    def _local_addrs(self, version):
+        return set(addr.ip for iface in self._netlink.interfaces().values()
+                   for addr in utils.iter_addrs(iface)
+                   if addr.version == version)
+
+    def _match(self, table, dst):
+        for _, network, _, oif in table:
+            if dst in network:
+                return oif
+
+    def resolve_many(self, dst_hosts, version=4):
+        """Resolve several destinations at once.
+
+        Rather than querying the kernel per destination, the routing
+        tables are dumped in a single request and every uncached
+        destination is matched against the main, then the default table by
+        longest prefix, then lowest metric. That is what the kernel's
+        default policy rules do; with any other rules (policy routing or
+        VRFs) and for this host's own addresses, each destination is
+        resolved with :py:meth:`resolve` instead.
+
+        Returns
+        -------
+        routes : dict, mapping each of ``dst_hosts`` to its route
+        """
+        results, pending = {}, []
+        for dst_host in dst_hosts:
+            hit, route = self._lookup((dst_host, version))
+            if hit:
+                results[dst_host] = route
+            else:
+                pending.append(dst_host)
+
+        if not pending:
+            return results
+
+        if not self._default_policy(version):
+            for dst_host in pending:
+                results[dst_host] = self.resolve(dst_host, version=version)
+            return results
+
+        table = []
+        for msg in self._netlink.ipr.get_routes(
+                family=utils.version_to_family(version)):
+            oif = _route_oif(msg)
+            if oif is not None and msg['type'] == RTN_UNICAST and \
+                    _route_table(msg) in LOOKUP_TABLES:
+                table.append((LOOKUP_TABLES.index(_route_table(msg)),
+                              _route_network(msg, version),
+                              msg.get_attr('RTA_PRIORITY') or 0, oif))
+        # Main table first, most specific first, then lowest metric
+        table.sort(key=lambda entry: (entry[0], -entry[1].prefixlen,
+                                      entry[2]))
+
+        local = self._local_addrs(version)
+        for dst_host in pending:
+            dst = utils.check_ipaddr(dst_host, version=version)[0]
+            if dst in local:
+                # routed through the local table
+                results[dst_host] = self.resolve(dst_host, version=version)
+                continue
+
+            oif = self._match(table, dst)
+            if oif is None:
+                raise RuntimeError(
+                    'No suitable route found for {}'.format(dst_host))
+
+            route = self._source(oif, version)
+            self._store((dst_host, version), route)
+            results[dst_host] = route
+
+        return results
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    """Return the process wide ``RouteResolver``."""
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = RouteResolver()
+        return _resolver
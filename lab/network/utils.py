@@ -2,9 +2,11 @@
 Networking utility functions.
 These should be as minimal as possible to enable remote execution.
 """
+import time
 import errno
 import logging
 import socket
+import threading
 import itertools
 import contextlib
 
@@ -45,8 +47,9 @@ try:
         IP and fqdn if either can be found
         '''
         family = version_to_family(version)
-        for res in socket.getaddrinfo(dst, 0, family, socket.SOCK_STREAM, 0,
-                                      socket.AI_PASSIVE | socket.AI_CANONNAME):
+        for res in dns_cache.getaddrinfo(
+                dst, 0, family, socket.SOCK_STREAM, 0,
+                socket.AI_PASSIVE | socket.AI_CANONNAME):
             family, socktype, proto, canonname, sa = res
             try:
                 addr = ipaddress.ip_address(unicode(sa[0]))
@@ -63,6 +66,81 @@ except ImportError:
         "Some network utils are not available; no `ipaddress` could be found")
 
 
+class ResolverCache(object):
+    """A ``socket.getaddrinfo`` cache.
+
+    Successful lookups are kept for ``ttl`` seconds and failed ones for
+    ``negative_ttl`` seconds. Concurrent lookups of the same query share
+    a single call to the system resolver.
+    """
+    def __init__(self, ttl=300, negative_ttl=30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pending = {}
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0,
+                    flags=0):
+        key = (host, port, family, socktype, proto, flags)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] > time.time():
+                    self.hits += 1
+                    return self._result(entry)
+
+                pending = self._pending.get(key)
+                if not pending:
+                    self.misses += 1
+                    pending = self._pending[key] = threading.Event()
+                    break
+
+            # Another thread is already resolving this query
+            pending.wait()
+
+        entry = None
+        try:
+            try:
+                entry = (time.time() + self.ttl, socket.getaddrinfo(*key),
+                         None)
+            except socket.gaierror as error:
+                entry = (time.time() + self.negative_ttl, None, error)
+        finally:
+            with self._lock:
+                if entry:
+                    self._entries[key] = entry
+                    self.failures += bool(entry[2])
+                del self._pending[key]
+            pending.set()
+
+        return self._result(entry)
+
+    @staticmethod
+    def _result(entry):
+        _, result, error = entry
+        if error:
+            raise socket.gaierror(*error.args)
+        return list(result)
+
+    def statistics(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'failures': self.failures,
+                    'entries': len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+dns_cache = ResolverCache()
+
+
 def version_to_family(version):
     if version == 4:
         return socket.AF_INET
@@ -93,9 +171,13 @@ def get_sock_addr(host, port=0, family=None, version=None, sockmod=socket):
     if not family:
         family = version_to_family(version) if version else socket.AF_UNSPEC
 
+    # Only local lookups can be answered from the cache
+    getaddrinfo = dns_cache.getaddrinfo if sockmod is socket \
+        else sockmod.getaddrinfo
+
     err = None
-    for res in sockmod.getaddrinfo(host, port, family, socket.SOCK_DGRAM, 0,
-                                   socket.AI_PASSIVE):
+    for res in getaddrinfo(host, port, family, socket.SOCK_DGRAM, 0,
+                           socket.AI_PASSIVE):
         family, socktype, proto, _, sa = res
         sock = None
         try:
@@ -0,0 +1,185 @@
+#
+# Copyright 2017 Sangoma Technologies Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Run a remote command on many role controllers at once.
+
+A command is started concurrently on every controller over its existing
+``ssh`` connection, each host's output can be streamed as it arrives and
+a :py:class:`HostResult` with the host's exit status, output and timing
+is returned for every controller::
+
+    results = fan_out(pytest.roles.enumerate(['dut', 'peer']),
+                      'systemctl', ['is-active', 'nginx'])
+    for result in results.failed:
+        print(result.ctl, result.retcode, result.stderr)
+"""
+from builtins import object
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+log = logging.getLogger(__name__)
+
+# seconds a timed out command gets to exit on SIGTERM before it's killed
+KILL_AFTER = 5
+# timeout(1)'s exit statuses when the command timed out
+TIMEOUT_STATUSES = (124, 137)
+
+
+class FanOutError(RuntimeError):
+    def __init__(self, results):
+        self.results = results
+        super(FanOutError, self).__init__(
+            'Command failed on {}'.format(', '.join(
+                str(result.ctl) for result in results)))
+
+
+class HostResult(object):
+    """The outcome of a command on one controller."""
+    def __init__(self, ctl):
+        self.ctl = ctl
+        self.retcode = None
+        self.stdout = ''
+        self.stderr = ''
+        self.error = None
+        self.started = None
+        self.elapsed = None
+        self.timed_out = False
+
+    @property
+    def ok(self):
+        return self.error is None and self.retcode == 0
+
+    def __repr__(self):
+        return '<HostResult {}: retcode={} elapsed={:.3f}s>'.format(
+            self.ctl, self.retcode, self.elapsed or 0)
+
+
+class Results(list):
+    """A :py:class:`HostResult` per controller, in the order given."""
+    @property
+    def failed(self):
+        return [result for result in self if not result.ok]
+
+    def check(self):
+        """Raise a :py:class:`FanOutError` if the command failed anywhere."""
+        failed = self.failed
+        if failed:
+            raise FanOutError(failed)
+        return self
+
+
+def _decode(line):
+    return line.decode('utf-8', 'replace') if isinstance(line, bytes) \
+        else line
+
+
+def _read_lines(pipe, stream, lines, on_output, ctl):
+    for line in iter(pipe.readline, b''):
+        line = _decode(line)
+        lines.append(line)
+        if on_output:
+            on_output(ctl, stream, line.rstrip('\n'))
+
+
+def _command(machine, command, args, timeout):
+    if callable(command):
+        cmd = command(machine)
+    elif timeout is not None:
+        # Killing the local ssh client leaves the command running on the
+        # host, so have timeout(1) kill it there
+        cmd = machine['timeout']['-k', str(KILL_AFTER), str(timeout),
+                                 str(machine[command].executable)]
+    else:
+        cmd = machine[command]
+    return cmd[tuple(args)] if args else cmd
+
+
+def _run(ctl, command, args, timeout, on_output, connection):
+    result = HostResult(ctl)
+    result.started = time.time()
+    timer = None
+    try:
+        machine = getattr(ctl, connection)
+        proc = _command(machine, command, args, timeout).popen()
+
+        if timeout is not None:
+            def expire():
+                result.timed_out = True
+                proc.kill()
+            # only a backstop for named commands, should the host hang
+            timer = threading.Timer(
+                timeout if callable(command) else timeout + KILL_AFTER + 1,
+                expire)
+            timer.daemon = True
+            timer.start()
+
+        stdout, stderr = [], []
+        reader = threading.Thread(target=_read_lines, args=(
+            proc.stderr, 'stderr', stderr, on_output, ctl))
+        reader.daemon = True
+        reader.start()
+        _read_lines(proc.stdout, 'stdout', stdout, on_output, ctl)
+        reader.join()
+
+        result.retcode = proc.wait()
+        result.stdout = ''.join(stdout)
+        result.stderr = ''.join(stderr)
+        if timeout is not None and result.retcode in TIMEOUT_STATUSES \
+                and time.time() - result.started >= timeout:
+            result.timed_out = True
+        if result.timed_out:
+            result.error = RuntimeError(
+                'Timed out after {}s'.format(timeout))
+    except Exception as err:
+        log.exception('Failed to run command on {}'.format(ctl))
+        result.error = err
+    finally:
+        if timer:
+            timer.cancel()
+        result.elapsed = time.time() - result.started
+    return result
+
+
+def fan_out(ctls, command, args=(), timeout=None, on_output=None,
+            max_workers=32, connection='ssh'):
+    """Run a command on every controller in ``ctls`` concurrently.
+
+    Parameters
+    ----------
+    ctls : iterable of role controllers, e.g. from ``pytest.roles.enumerate``
+    command : str, name of the remote program, or a callable which builds
+        the plumbum command from a controller's connection
+    args : sequence of arguments bound to the command
+    timeout : float, seconds after which a host's command is killed. A
+        named command is run under ``timeout(1)`` so it's killed on the
+        host too. For a command built by a callable only the local ssh
+        client is killed and the command keeps running on the host,
+        unless the callable wraps it in ``timeout`` itself.
+    on_output : callable, ``on_output(ctl, stream, line)`` called for each
+        line of ``'stdout'`` or ``'stderr'`` as it's received
+    max_workers : int, maximum number of hosts to run on at once
+    connection : str, name of the controllers' connection attribute
+
+    Returns
+    -------
+    results : :py:class:`Results`, one per controller
+    """
+    ctls = list(ctls)
+    if not ctls:
+        return Results()
+
+    pool = ThreadPool(min(max_workers, len(ctls)))
+    try:
+        return Results(pool.map(
+            lambda ctl: _run(ctl, command, args, timeout, on_output,
+                             connection), ctls))
+    finally:
+        pool.close()
+        pool.join()
@@ -8,12 +8,24 @@
 Paramiko machine ctl
 '''
 import os
+import time
 import types
+import fnmatch
+import posixpath
+import collections
+import atexit
+import shutil
+import hashlib
 import logging
+import tempfile
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
 import plumbum
 from stat import S_ISDIR
 from plumbum import ProcessExecutionError
-from paramiko import SSHException
+from paramiko import SSHException, SFTPAttributes
+from paramiko import sftp as sftp_proto
 from paramiko.agent import Agent as SSHAgent
 from paramiko.ssh_exception import AuthenticationException
 
@@ -29,6 +41,141 @@ SSH_OPTS = ['-o', 'UserKnownHostsFile=/dev/null',
             '-o', 'ServerAliveInterval=5']
 
 
+# Share one ssh connection per destination between every ssh, scp and
+# rpyc channel opened to it. execnet keeps its own connections, as the
+# master's options would override its host key checking.
+MULTIPLEX = os.environ.get('PYTESTLAB_SSH_MULTIPLEX', '') not in ('', '0')
+
+
+class ControlMaster(object):
+    """An OpenSSH ControlMaster connection to ``user@hostname:port``.
+
+    Other ``ssh`` and ``scp`` invocations passed :py:attr:`options` open
+    their sessions as channels of the master's connection, skipping the
+    connection setup and authentication entirely. The master's output is
+    written to :py:attr:`logfile`.
+    """
+    def __init__(self, hostname, user='root', port=22, keyfile=None,
+                 timeout=30):
+        self.hostname = hostname
+        self.user = user
+        self.port = port
+        self.keyfile = keyfile
+
+        # Socket paths are limited to ~100 characters, keep them short
+        key = '{}@{}:{}'.format(user, hostname, port).encode('utf-8')
+        self.path = os.path.join(_control_dir(),
+                                 hashlib.sha1(key).hexdigest()[:16])
+        self.options = ['-o', 'ControlMaster=no',
+                        '-o', 'ControlPath={}'.format(self.path)]
+
+        args = ['ssh', '-M', '-N', '-p', str(port),
+                '-o', 'ControlPath={}'.format(self.path),
+                '-o', 'BatchMode=yes'] + SSH_OPTS
+        if keyfile:
+            args.extend(['-i', os.path.expanduser(keyfile)])
+        args.append('{}@{}'.format(user, hostname))
+
+        log.info("Starting SSH control master to {}@{}:{}...".format(
+            user, hostname, port))
+        # A file rather than a pipe nobody reads, which a chatty master
+        # could fill and block on
+        self.logfile = self.path + '.log'
+        with open(self.logfile, 'ab') as output:
+            self.proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                         stdout=output, stderr=output)
+
+        # The socket appears once the connection is authenticated
+        deadline = time.time() + timeout
+        while not os.path.exists(self.path):
+            if self.proc.poll() is not None:
+                raise SSHException('SSH control master to {} failed: {}'.format(
+                    hostname, self.output()))
+            if time.time() > deadline:
+                self.close()
+                raise SSHException('Timed out starting SSH control master '
+                                   'to {}'.format(hostname))
+            time.sleep(0.05)
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None and os.path.exists(self.path)
+
+    def output(self):
+        """Return what the master logged."""
+        with open(self.logfile, 'rb') as fp:
+            return fp.read().decode('utf-8', 'replace')
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+_masters = {}
+_masters_lock = threading.Lock()
+_control_path = []
+
+
+def _control_dir():
+    if not _control_path:
+        _control_path.append(tempfile.mkdtemp(prefix='pytestlab-ssh-'))
+    return _control_path[0]
+
+
+def get_control_master(hostname, user='root', port=22, keyfile=None):
+    """Return the running ``ControlMaster`` for a destination, starting
+    a new one if necessary.
+    """
+    key = (user, hostname, port)
+    with _masters_lock:
+        master = _masters.get(key)
+        if not master or not master.alive:
+            if master:
+                log.warning("SSH control master to {} died: {}".format(
+                    hostname, master.output()))
+                master.close()
+            master = _masters[key] = ControlMaster(hostname, user=user,
+                                                   port=port, keyfile=keyfile)
+        return master
+
+
+def get_control_opts(hostname, multiplex=None, **kwargs):
+    """Return the options to pass to ``ssh`` or ``scp`` to ride on a shared
+    control master to ``hostname``, none unless ``multiplex`` is set.
+    Password authentication can't be multiplexed.
+    """
+    multiplex = MULTIPLEX if multiplex is None else multiplex
+    if not multiplex or (kwargs.get('password') and
+                         not kwargs.get('keyfile')):
+        return []
+
+    master = get_control_master(hostname, user=kwargs.get('user', 'root'),
+                                port=kwargs.get('port', 22),
+                                keyfile=kwargs.get('keyfile'))
+    return master.options
+
+
+def get_ssh_opts(hostname, multiplex=None, **kwargs):
+    """Return the options to pass to ``ssh`` or ``scp`` to reach
+    ``hostname``, riding on a shared control master if ``multiplex`` is
+    set.
+    """
+    return SSH_OPTS + get_control_opts(hostname, multiplex, **kwargs)
+
+
+@atexit.register
+def _close_control_masters():
+    with _masters_lock:
+        for master in _masters.values():
+            master.close()
+        _masters.clear()
+    if _control_path:
+        shutil.rmtree(_control_path.pop(), ignore_errors=True)
+
+
 def walk(self, remotepath):
     """Taken from https://gist.github.com/johnfink8/2190472
 
@@ -50,6 +197,325 @@ def walk(self, remotepath):
             yield x
 
 
+class _TreeWalk(object):
+    """Breadth first listing of a remote tree which keeps up to ``window``
+    SFTP requests in flight at once.
+
+    Responses are dispatched to :py:meth:`_async_response` by paramiko's
+    request machinery, the same way a prefetching ``SFTPFile`` gets its
+    data.
+    """
+    def __init__(self, sftp, root, include=None, exclude=None,
+                 maxdepth=None, window=16):
+        self.sftp = sftp
+        self.root = root
+        self.include = include
+        self.exclude = exclude
+        self.maxdepth = maxdepth
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._dirs = collections.deque([(root, 0)])
+        self._entries = collections.deque()
+        # request number -> (path, depth, handle)
+        self._requests = {}
+
+    def _matches(self, patterns, relpath):
+        name = posixpath.basename(relpath)
+        return any(fnmatch.fnmatch(relpath, pattern) or
+                   fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+    def _send(self, cmd, path, depth, handle=None):
+        arg = handle if handle is not None else path
+        num = self.sftp._async_request(self, cmd, arg)
+        self._requests[num] = (path, depth, handle)
+
+    def _close(self, handle):
+        # the response carries nothing of interest
+        self.sftp._async_request(type(None), sftp_proto.CMD_CLOSE, handle)
+
+    def _async_response(self, t, msg, num):
+        with self._lock:
+            path, depth, handle = self._requests.pop(num)
+
+            if t == sftp_proto.CMD_HANDLE:
+                self._send(sftp_proto.CMD_READDIR, path, depth,
+                           msg.get_binary())
+            elif t == sftp_proto.CMD_NAME:
+                for _ in range(msg.get_int()):
+                    filename = msg.get_text()
+                    longname = msg.get_text()
+                    attr = SFTPAttributes._from_msg(msg, filename, longname)
+                    if filename not in ('.', '..'):
+                        self._add(path, depth, attr)
+                self._send(sftp_proto.CMD_READDIR, path, depth, handle)
+            elif t == sftp_proto.CMD_STATUS:
+                if handle is not None:
+                    self._close(handle)
+                code = msg.get_int()
+                if code != sftp_proto.SFTP_EOF:
+                    log.warning("Failed to list {}: {}".format(
+                        path, msg.get_text()))
+
+    def _add(self, dirpath, depth, attr):
+        path = posixpath.join(dirpath, attr.filename)
+        relpath = posixpath.relpath(path, self.root)
+        if self.exclude and self._matches(self.exclude, relpath):
+            return
+
+        if S_ISDIR(attr.st_mode or 0) and (
+                self.maxdepth is None or depth + 1 < self.maxdepth):
+            self._dirs.append((path, depth + 1))
+        if not self.include or self._matches(self.include, relpath):
+            self._entries.append((path, attr))
+
+    def __iter__(self):
+        try:
+            while True:
+                with self._lock:
+                    while self._dirs and len(self._requests) < self.window:
+                        path, depth = self._dirs.popleft()
+                        self._send(sftp_proto.CMD_OPENDIR, path, depth)
+                    entries, self._entries = \
+                        self._entries, collections.deque()
+                    pending = bool(self._requests)
+
+                for entry in entries:
+                    yield entry
+                if not entries and not pending:
+                    return
+                if not entries:
+                    # handle one response, which calls _async_response
+                    self.sftp._read_response()
+        finally:
+            # stop listening for responses to abandoned requests
+            with self._lock:
+                for num, (_, _, handle) in self._requests.items():
+                    self.sftp._expecting.pop(num, None)
+                    if handle is not None:
+                        self._close(handle)
+                self._requests.clear()
+
+
+def iter_tree(self, remotepath, include=None, exclude=None, maxdepth=None,
+              window=16):
+    """Walk a remote tree breadth first, yielding ``(path, attr)`` for
+    every entry as the listings arrive.
+
+    Many directories are listed at once, so walking a tree isn't
+    serialized on the link's round trip time the way :py:func:`walk` is.
+
+    Parameters
+    ----------
+    remotepath : str, the directory to walk
+    include : list of glob patterns, only entries whose path relative to
+        ``remotepath`` or name matches one are yielded
+    exclude : list of glob patterns, matching entries are neither yielded
+        nor descended into
+    maxdepth : int, how many levels to descend, 1 lists ``remotepath`` only
+    window : int, maximum number of requests in flight
+    """
+    return iter(_TreeWalk(self, remotepath, include=include, exclude=exclude,
+                          maxdepth=maxdepth, window=window))
+
+
+class TransferStats(object):
+    """Totals for a :py:class:`BulkTransfer` run."""
+    def __init__(self):
+        self.files = 0
+        # bytes sent over the link, and bytes skipped by resuming
+        self.bytes = 0
+        self.resumed = 0
+        self.elapsed = 0.
+
+    @property
+    def throughput(self):
+        """Bytes per second sent over the link."""
+        return self.bytes / self.elapsed if self.elapsed else 0.
+
+    def __repr__(self):
+        return '<TransferStats {} files, {} bytes ({} resumed) in {:.2f}s, ' \
+            '{:.2f} MB/s>'.format(self.files, self.bytes, self.resumed,
+                                  self.elapsed, self.throughput / 1e6)
+
+
+class BulkTransfer(object):
+    """Move many, possibly large, files over SFTP.
+
+    Files are split into ``chunk_size`` chunks which are requested
+    ``window`` at a time without waiting on each other, and up to
+    ``concurrency`` files move at once, each over its own SFTP session
+    on the same ssh transport. A partial destination file is resumed if
+    its last ``overlap`` bytes match the source's.
+
+    Parameters
+    ----------
+    sftp : the ``paramiko.SFTPClient`` to transfer over
+    chunk_size : int, bytes per chunk
+    window : int, chunks in flight per file
+    concurrency : int, files transferred at once
+    resume : bool, whether to resume partial files
+    overlap : int, bytes compared to validate a partial file
+    """
+    def __init__(self, sftp, chunk_size=1 << 18, window=16, concurrency=4,
+                 resume=True, overlap=1 << 16):
+        self.sftp = sftp
+        self.chunk_size = chunk_size
+        self.window = window
+        self.concurrency = concurrency
+        self.resume = resume
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self._clients = [sftp]
+        self._opened = []
+
+    def _acquire_client(self):
+        with self._lock:
+            if self._clients:
+                return self._clients.pop()
+
+        import paramiko
+        transport = self.sftp.get_channel().get_transport()
+        client = paramiko.SFTPClient.from_transport(transport)
+        with self._lock:
+            self._opened.append(client)
+        return client
+
+    def _release_client(self, client):
+        with self._lock:
+            self._clients.append(client)
+
+    def close(self):
+        """Close the extra SFTP sessions opened for concurrent files."""
+        with self._lock:
+            opened, self._opened = self._opened, []
+            self._clients = [self.sftp]
+        for client in opened:
+            client.close()
+
+    def _chunks(self, start, size):
+        chunks = [(offset, min(self.chunk_size, size - offset))
+                  for offset in range(start, size, self.chunk_size)]
+        for idx in range(0, len(chunks), self.window):
+            yield chunks[idx:idx + self.window]
+
+    def _resume_offset(self, partial, size, read_src, read_dst):
+        """Return the offset to continue from for a ``partial`` sized
+        destination of a ``size`` sized source.
+        """
+        if not self.resume or not partial or partial > size:
+            return 0
+
+        start = max(0, partial - self.overlap)
+        if read_src(start, partial - start) != read_dst(start,
+                                                       partial - start):
+            return 0
+        return partial
+
+    @staticmethod
+    def _read_at(fileobj, offset, length):
+        fileobj.seek(offset)
+        return fileobj.read(length)
+
+    def _get(self, sftp, remotepath, localpath):
+        size = sftp.stat(remotepath).st_size
+        dirname = os.path.dirname(localpath)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        partial = os.path.getsize(localpath) \
+            if os.path.exists(localpath) else 0
+        with sftp.open(remotepath, 'rb') as src, \
+                open(localpath, 'r+b' if partial else 'wb') as dst:
+            done = self._resume_offset(
+                partial, size,
+                lambda offset, length: self._read_at(src, offset, length),
+                lambda offset, length: self._read_at(dst, offset, length))
+            dst.seek(done)
+            dst.truncate()
+            for chunks in self._chunks(done, size):
+                for data in src.readv(chunks):
+                    dst.write(data)
+        return size - done, done
+
+    def _put(self, sftp, localpath, remotepath):
+        size = os.path.getsize(localpath)
+        try:
+            partial = sftp.stat(remotepath).st_size
+        except IOError:
+            partial = 0
+
+        with open(localpath, 'rb') as src, \
+                sftp.open(remotepath, 'r+b' if partial else 'wb') as dst:
+            done = self._resume_offset(
+                partial, size,
+                lambda offset, length: self._read_at(src, offset, length),
+                lambda offset, length: self._read_at(dst, offset, length))
+            if done < partial:
+                dst.truncate(done)
+            # writes are acknowledged asynchronously, errors are raised
+            # at the latest when the file is closed
+            dst.set_pipelined(True)
+            dst.seek(done)
+            for chunks in self._chunks(done, size):
+                for offset, length in chunks:
+                    src.seek(offset)
+                    dst.write(src.read(length))
+        return size - done, done
+
+    def _run(self, transfer, files):
+        stats = TransferStats()
+        files = list(files)
+        if not files:
+            return stats
+
+        def run(paths):
+            client = self._acquire_client()
+            try:
+                return transfer(client, *paths)
+            finally:
+                self._release_client(client)
+
+        start = time.time()
+        pool = ThreadPool(min(self.concurrency, len(files)))
+        try:
+            for sent, resumed in pool.imap_unordered(run, files):
+                stats.files += 1
+                stats.bytes += sent
+                stats.resumed += resumed
+        finally:
+            pool.close()
+            pool.join()
+            stats.elapsed = time.time() - start
+
+        log.info("Transferred {!r}".format(stats))
+        return stats
+
+    def get(self, remotepath, localpath):
+        return self.get_many([(remotepath, localpath)])
+
+    def get_many(self, files):
+        """Download ``(remotepath, localpath)`` pairs, returning
+        :py:class:`TransferStats`.
+        """
+        return self._run(self._get, files)
+
+    def put(self, localpath, remotepath):
+        return self.put_many([(localpath, remotepath)])
+
+    def put_many(self, files):
+        """Upload ``(localpath, remotepath)`` pairs, returning
+        :py:class:`TransferStats`.
+        """
+        return self._run(self._put, files)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def get_paramiko_sftp(hostname, **kwargs):
     ssh = get_paramiko_ssh(hostname, **kwargs)
     return ssh.sftp
@@ -74,6 +540,7 @@ def get_paramiko_ssh(hostname, **kwargs):
 
     ssh = ParamikoMachine(hostname, **settings)
     ssh.sftp.walk = types.MethodType(walk, ssh.sftp)
+    ssh.sftp.iter_tree = types.MethodType(iter_tree, ssh.sftp)
     return ssh
 
 
@@ -93,6 +560,7 @@ def get_generic_sftp(hostname, **kwargs):
     def get_sftp(transport):
         sftp = paramiko.SFTPClient.from_transport(transport)
         sftp.walk = types.MethodType(walk, sftp)
+        sftp.iter_tree = types.MethodType(iter_tree, sftp)
         return sftp
 
     def iter_credentials():
@@ -134,10 +602,11 @@ def get_generic_ssh(hostname, **kwargs):
 
     password = kwargs.get('password')
     keyfile = kwargs.get('keyfile')
+    opts = get_ssh_opts(hostname, **kwargs)
     settings = {'user': kwargs.get('user', 'root'),
                 'port': kwargs.get('port', 22),
-                'ssh_opts': SSH_OPTS,
-                'scp_opts': SSH_OPTS}
+                'ssh_opts': opts,
+                'scp_opts': opts}
 
     if password:
         settings['password'] = kwargs.get('password')
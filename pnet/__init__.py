@@ -1,7 +1,7 @@
 import struct
 import ipaddress
 from .utils import HWAddress
-from .msg import ParseError, msg, checksum
+from .msg import ParseError, msg, checksum, Checksum
 
 
 # IEEE = 802.3 Ethernet magic constants. The frame sizes omit the
@@ -99,7 +99,7 @@ def ipv4_checksum(ip4, udp, data):
         ip4_src.packed if ip4_src else b'\x00' * 4,
         ip4_dst.packed if ip4_dst else b'\x00' * 4,
         struct.pack('!HH', ip4['proto'], ip4_len),
-        udp.tobytes(),
+        udp.buf[:udp.offset],
         data
     )
 
@@ -141,3 +141,104 @@ class udphdr(msg):
               ('dport', 'be16'),
               ('len', 'be16'),
               ('csum', 'be16'))
+
+
+class BufferPool(object):
+    """A set of reusable receive buffers.
+
+    Buffers which are never released are simply replaced by a freshly
+    allocated one the next time the pool runs dry.
+    """
+    def __init__(self, size=0x1000, count=16):
+        self.size = size
+        self._free = [bytearray(size) for _ in range(count)]
+
+    def acquire(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def release(self, buf):
+        self._free.append(buf)
+
+
+class Frame(object):
+    """A layered, zero-copy view of an ethernet frame.
+
+    Every layer is a header parsed over a ``memoryview`` slice of the
+    same receive buffer, only parsed once first accessed, so nothing is
+    copied until a field is actually read.
+    """
+    def __init__(self, buf, length=None, pool=None, transient=False):
+        self.buf = buf
+        self.pool = pool
+        # Transient frames live in memory owned by someone else (like a
+        # kernel ring) and are only valid until the next receive
+        self.transient = transient
+        self.view = memoryview(buf)[:length]
+        self._eth = None
+        self._ip4 = None
+        self._udp = None
+
+    @property
+    def eth(self):
+        if self._eth is None:
+            self._eth = ethhdr.parse(self.view)
+        return self._eth
+
+    @property
+    def ip4(self):
+        if self._ip4 is None:
+            self._ip4 = ip4hdr.parse(self.eth.payload)
+        return self._ip4
+
+    @property
+    def udp(self):
+        if self._udp is None:
+            self._udp = udphdr.parse(self.ip4.payload)
+        return self._udp
+
+    @property
+    def payload(self):
+        return self.udp.payload
+
+    def detach(self):
+        """Return a frame which stays valid after this one is released.
+
+        Pooled buffers are simply taken out of the pool, only transient
+        frames need to be copied.
+        """
+        if self.transient:
+            return Frame(bytearray(self.view))
+        self.pool = None
+        return self
+
+    def release(self):
+        """Hand the underlying buffer back to its pool.
+
+        Views into the frame must not be used after this.
+        """
+        if self.pool:
+            self.pool.release(self.buf)
+            self.pool = None
+
+    def __len__(self):
+        return len(self.view)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def recv_frame(sock, pool):
+    """Receive a single frame from ``sock`` into a buffer from ``pool``."""
+    buf = pool.acquire()
+    try:
+        length = sock.recv_into(buf)
+    except Exception:
+        pool.release(buf)
+        raise
+    return Frame(buf, length, pool=pool)
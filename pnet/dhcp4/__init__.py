@@ -51,16 +51,30 @@ class DHCPPacket:
         if not self.xid:
             self.xid = os.urandom(4)
 
+    @classmethod
+    def peek_xid(cls, payload):
+        """Read the transaction id of a raw packet without parsing it."""
+        if len(payload) < 8:
+            raise pnet.ParseError('Truncated DHCP packet')
+        return payload[4:8].tobytes()
+
     @classmethod
     def parse(cls, payload):
-        _, _, options = payload.tobytes().partition(COOKIE)
-        if not options:
+        # The cookie sits at a fixed offset right after the BOOTP
+        # header, check it in place rather than searching a copy
+        payload = memoryview(payload)
+        options_start = cls.layout.size + len(COOKIE)
+        if payload[cls.layout.size:options_start].tobytes() != COOKIE:
             raise pnet.ParseError('Failed to find DHCP cookie')
 
+        options = payload[options_start:]
+        if not len(options):
+            raise pnet.ParseError('Failed to find DHCP options')
+
         try:
             result = cls.layout.unpack_from(payload)
         except struct.error as e:
-            raise ParseError(str(e))
+            raise pnet.ParseError(str(e))
 
         self = cls(
             result[0],
@@ -72,7 +86,7 @@ class DHCPPacket:
             siaddr=result[9],
             giaddr=result[10],
             chaddr=result[11],
-            options=Options.parse(memoryview(options))
+            options=Options.parse(options)
         )
 
         self.htype = result[1]
@@ -1,4 +1,7 @@
+import sys
 import struct
+from binascii import hexlify
+from collections import namedtuple, OrderedDict
 from ipaddress import IPv4Address
 from .utils import HWAddress
 
@@ -24,22 +27,189 @@ TYPES = {
 }
 
 
+if hasattr(int, 'from_bytes'):
+    def _to_int(data):
+        return int.from_bytes(data, 'big')
+else:
+    def _to_int(data):
+        return int(hexlify(data) or b'0', 16)
+
+
+def _fold(value):
+    """Reduce an integer to its 16-bit ones' complement sum.
+
+    Since ``2 ** 16 == 1 (mod 0xffff)``, a big endian integer built from a
+    run of 16-bit words is congruent to the sum of those words, which
+    lets the whole sum be computed by a single C level conversion. A
+    nonzero sum folds to 0xffff (negative zero) rather than 0.
+    """
+    return value % 0xffff or (0xffff if value else 0)
+
+
+class Checksum(object):
+    """An Internet checksum (RFC 1071) over one or more chunks of data.
+
+    Chunks are summed in place without being joined and a range of
+    already summed bytes can be replaced using the incremental update of
+    RFC 1624, so a single field change doesn't require summing the whole
+    message again.
+    """
+    def __init__(self, *data):
+        self.sum = 0
+        self.length = 0
+        self.update(*data)
+
+    def update(self, *data):
+        """Append chunks of data to the checksum."""
+        for chunk in data:
+            length = len(chunk)
+            if not length:
+                continue
+
+            # Shifting the running sum left by an odd number of bytes
+            # swaps its bytes, which is a multiplication by 0x100
+            value = self.sum * 0x100 if length % 2 else self.sum
+            self.sum = _fold(value + _to_int(chunk))
+            self.length += length
+        return self
+
+    def replace(self, offset, old, new):
+        """Replace the bytes ``old`` found at ``offset`` with ``new``.
+
+        Implements ``HC' = ~(~HC + ~m + m')`` from RFC 1624.
+        """
+        if len(old) != len(new):
+            raise ValueError('Replacement must be the same length')
+
+        # Bytes at an odd distance from the end contribute byte swapped
+        trailing = self.length - offset - len(old)
+        if trailing < 0:
+            raise ValueError('Replacement is outside of the summed data')
+        scale = 0x100 if trailing % 2 else 1
+
+        old_sum = _fold(_to_int(old) * scale)
+        new_sum = _fold(_to_int(new) * scale)
+        self.sum = _fold(self.sum + (0xffff - old_sum) + new_sum)
+        return self
+
+    @property
+    def value(self):
+        # Data of odd length is padded with a trailing zero byte
+        csum = _fold(self.sum * 0x100) if self.length % 2 else self.sum
+        return ~csum & 0xffff
+
+    def __int__(self):
+        return self.value
+
+
 def checksum(*data):
-    # TODO: Use iterator to avoid copying
-    data = b''.join(data)
+    return Checksum(*data).value
+
+
+# Byte orders which agree with the network byte order used by layouts
+_NETWORK_ORDERS = ('>', '!') + (('@', '=') if sys.byteorder == 'big' else ())
+# Format characters whose encoding does not depend on byte order
+_ORDERLESS = set('0123456789xcbB?sp')
+
+
+Field = namedtuple('Field', 'name,index,count,offset,struct,decode,encode,'
+                            'default')
+
+
+def _compile_type(ftype):
+    """Resolve a field type into a network byte order struct format and
+    its decode/encode routines.
+
+    Fields declared in another byte order are stored as raw bytes in the
+    layout and converted by their own routines so that a whole header can
+    still be packed by a single ``struct.Struct``.
+    """
+    spec = TYPES.get(ftype, ftype)
+    if isinstance(spec, dict):
+        fmt, decode, encode = spec['format'], spec.get('decode'), \
+            spec.get('encode')
+    else:
+        fmt, decode, encode = spec, None, None
+
+    if fmt[0] in '@=<>!':
+        order, body = fmt[0], fmt[1:]
+    else:
+        order, body = '@', fmt
+
+    if order in _NETWORK_ORDERS or _ORDERLESS.issuperset(body):
+        return body, decode, encode, None
+
+    # NOTE: native alignment never applies as fields are packed
+    # individually, so '@' is equivalent to '='
+    native = struct.Struct(('=' if order == '@' else order) + body)
+
+    def swapped_decode(raw):
+        value = native.unpack(raw)
+        value = value[0] if len(value) == 1 else value
+        return decode(value) if decode else value
 
-    if len(data) % 2:
-        data += b'\x00'
+    def swapped_encode(value):
+        if encode:
+            value = encode(value)
+        if not isinstance(value, (set, tuple, list)):
+            value = [value]
+        return native.pack(*value)
 
-    csum = sum(struct.unpack('!H', data[x:x+2])[0]
-               for x in range(0, len(data), 2))
+    return '{}s'.format(native.size), swapped_decode, swapped_encode, native
 
-    csum = (csum >> 16) + (csum & 0xffff)
-    csum += csum >> 16
-    return ~csum & 0xffff
 
+class Layout(object):
+    """The compiled representation of a message's ``fields``.
 
-class msg(dict):
+    The whole header is described by one network byte order
+    ``struct.Struct`` and every field records its offset and its own
+    struct so it can be decoded and rewritten in place independently.
+    """
+    def __init__(self, fields):
+        self.fields = OrderedDict()
+        fmt, index, offset = '!', 0, 0
+
+        for field in fields:
+            name, ftype = field[:2]
+            default = field[2] if len(field) > 2 else None
+            body, decode, encode, native = _compile_type(ftype)
+
+            fieldstruct = struct.Struct('!' + body)
+            zeros = fieldstruct.unpack(b'\x00' * fieldstruct.size)
+            if default is None or isinstance(default, bytes):
+                # Assume we have an empty buffer
+                default = zeros
+            elif native:
+                default = (native.pack(default),)
+            elif not isinstance(default, (set, tuple, list)):
+                default = (default,)
+
+            self.fields[name] = Field(name, index, len(zeros), offset,
+                                      fieldstruct, decode, encode,
+                                      tuple(default))
+            fmt += body
+            index += len(zeros)
+            offset += fieldstruct.size
+
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+
+class MsgMeta(type):
+    """Compile the ``fields`` of every msg class into a ``Layout`` once,
+    at class creation.
+    """
+    def __init__(cls, name, bases, namespace):
+        super(MsgMeta, cls).__init__(name, bases, namespace)
+        cls.layout = Layout(getattr(cls, 'fields', ()))
+        cls._fields_names = tuple(cls.layout.fields)
+
+
+# Python 2 and 3 compatible way of declaring the metaclass
+_MsgBase = MsgMeta('_MsgBase', (dict,), {})
+
+
+class msg(_MsgBase):
     buf = None
     fields = ()
     _fields_names = ()
@@ -47,8 +217,12 @@ class msg(dict):
     def __init__(self, content=None, offset=0, buf=None):
         content = content or {}
         dict.__init__(self, content)
-        self._register_fields()
         self.offset = offset
+        # Raw values unpacked from the buffer, decoded on first access
+        self._raw = None
+        self._lazy = False
+        # Whether the buffer holds a complete header yet
+        self._encoded = False
         # NOTE: we assume this is zeroed
         self.buf = memoryview(buf or bytearray(0x100))
         if content and not self.buf.readonly:
@@ -57,74 +231,90 @@ class msg(dict):
     @classmethod
     def parse(cls, buf, offset=0):
         self = cls(buf=buf, offset=offset)
-        try:
-            self._decode()
-        except struct.error as e:
-            raise ParseError(str(e))
+        if len(self.buf) < cls.layout.size:
+            raise ParseError('{} requires {} bytes, got {}'.format(
+                cls.__name__, cls.layout.size, len(self.buf)))
+
+        # Fields are only decoded once they are looked up
+        self.offset = cls.layout.size
+        self._lazy = True
+        self._encoded = True
         return self
 
-    def _register_fields(self):
-        self._fields_names = tuple([x[0] for x in self.fields])
+    def _decode_field(self, field):
+        raw = self._raw
+        if raw is None:
+            raw = self._raw = self.layout.struct.unpack_from(self.buf)
 
-    def _get_routine(self, mode, fmt):
-        fmt = TYPES.get(fmt, fmt)
-        if isinstance(fmt, dict):
-            return (fmt['format'], fmt.get(mode, lambda x: x))
+        if field.count == 1:
+            value = raw[field.index]
         else:
-            return (fmt, lambda x: x)
+            value = raw[field.index:field.index + field.count]
+        return field.decode(value) if field.decode else value
 
     def _decode(self):
-        self.offset = 0
-        for field in self.fields:
-            name, sfmt = field[:2]
-            fmt, routine = self._get_routine('decode', sfmt)
-            size = struct.calcsize(fmt)
-            value = struct.unpack_from(fmt, self.buf, self.offset)
-            if len(value) == 1:
-                value = value[0]
-            self[name] = routine(value)
-            self.offset += size
+        """Decode every field not yet decoded from the buffer."""
+        if not self._lazy:
+            return
 
-    def _encode(self):
-        # Workaround old 2.7 versions not having buffer protocol
-        # implemented correctly on memory view... thanks CentOS 7
-        buf = bytearray(len(self.buf))
-        self.offset = 0
+        for name, field in self.layout.fields.items():
+            if not dict.__contains__(self, name):
+                dict.__setitem__(self, name, self._decode_field(field))
+        self._lazy = False
 
-        for field in self.fields:
-            name, fmt = field[:2]
-            default = b'\x00' if len(field) <= 2 else field[2]
-            fmt, routine = self._get_routine('encode', fmt)
+    def _pack_field(self, field, value):
+        if value is None:
+            return field.default
 
-            size = struct.calcsize(fmt)
-            if self[name] is None:
-                # Assume we have an empty buffer
-                if not isinstance(default, bytes):
-                    struct.pack_into(fmt, buf, self.offset, default)
-            else:
-                value = routine(self[name])
-                if not isinstance(value, (set, tuple, list)):
-                    value = [value]
-                struct.pack_into(fmt, buf, self.offset, *value)
+        if field.encode:
+            value = field.encode(value)
+        if not isinstance(value, (set, tuple, list)):
+            return (value,)
+        return value
+
+    def _encode(self):
+        self._decode()
 
-            self.offset += size
+        values = []
+        for name, field in self.layout.fields.items():
+            values.extend(self._pack_field(field, dict.get(self, name)))
 
-        # Workaround this issue by copying from a temporary buffer
-        self.buf[:self.offset] = buf[:self.offset]
+        # Workaround old 2.7 versions not having buffer protocol
+        # implemented correctly on memory view... thanks CentOS 7
+        self.buf[:self.layout.size] = self.layout.struct.pack(*values)
+        self.offset = self.layout.size
+        self._encoded = True
+
+    def _encode_field(self, field, value):
+        data = field.struct.pack(*self._pack_field(field, value))
+        self.buf[field.offset:field.offset + field.struct.size] = data
 
     def __getitem__(self, key):
         try:
             return dict.__getitem__(self, key)
         except KeyError:
-            if key in self._fields_names:
+            field = self.layout.fields.get(key)
+            if field is None:
+                raise
+            elif not self._lazy:
                 return None
-            raise
+
+            value = self._decode_field(field)
+            dict.__setitem__(self, key, value)
+            return value
 
     def __setitem__(self, key, value):
         dict.__setitem__(self, key, value)
-        # TODO: smell...
-        if not self.buf.readonly:
+        if self.buf.readonly:
+            return
+
+        # Once the header is in the buffer, only rewrite the bytes
+        # belonging to the field that changed
+        field = self.layout.fields.get(key)
+        if not self._encoded:
             self._encode()
+        elif field:
+            self._encode_field(field, value)
 
     def tobytes(self):
         return self.buf[:self.offset].tobytes()
@@ -139,3 +329,22 @@ class msg(dict):
     @payload.setter
     def payload(self, data):
         self.buf[self.offset:] = data
+
+
+def _decoding(name):
+    method = getattr(dict, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._decode()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+# Any dict API which exposes more than a single field needs every field
+# decoded first
+for _name in ('__contains__', '__eq__', '__iter__', '__len__', '__ne__',
+              '__repr__', 'copy', 'get', 'items', 'keys', 'values'):
+    setattr(msg, _name, _decoding(_name))
+del _name
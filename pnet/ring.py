@@ -0,0 +1,203 @@
+"""
+Batched frame receive for ``AF_PACKET`` sockets.
+
+A :py:class:`RingReceiver` maps a ``TPACKET_V3`` ring shared with the
+kernel (see ``Documentation/networking/packet_mmap.txt``) so every wakeup
+can drain a whole block of frames without a syscall per frame. Where the
+ring can't be set up, :py:class:`BatchReceiver` drains the socket with
+non-blocking reads instead.
+"""
+import errno
+import mmap
+import socket
+import struct
+from . import BufferPool, Frame, recv_frame
+
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3
+tpacket_req3 = struct.Struct('7I')
+# struct tpacket_block_desc, up to tpacket_hdr_v1.offset_to_first_pkt
+block_desc = struct.Struct('5I')
+# struct tpacket3_hdr, up to tp_mac
+tpacket3_hdr = struct.Struct('6IH')
+# struct tpacket_stats and tpacket_stats_v3
+tpacket_stats = struct.Struct('II')
+tpacket_stats_v3 = struct.Struct('III')
+
+
+class Receiver(object):
+    """Base type for receive engines, keeping frame and drop counters."""
+    stats_struct = tpacket_stats
+
+    def __init__(self, sock):
+        self.sock = sock
+        # frames handed to the caller and wakeups which returned frames
+        self.frames = 0
+        self.batches = 0
+        # kernel counters, which the kernel resets every time it's read
+        self.packets = 0
+        self.drops = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self):
+        """Yield every frame currently available without blocking."""
+        raise NotImplementedError
+
+    def statistics(self):
+        """Return the frame counters including the kernel's drop count.
+
+        The kernel's ``packets`` count includes dropped packets, so a
+        growing ``drops`` means the receiver is falling behind.
+        """
+        data = self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS,
+                                    self.stats_struct.size)
+        packets, drops = tpacket_stats.unpack_from(data)
+        self.packets += packets
+        self.drops += drops
+        return {'frames': self.frames,
+                'batches': self.batches,
+                'packets': self.packets,
+                'drops': self.drops}
+
+    def close(self):
+        pass
+
+
+class BatchReceiver(Receiver):
+    """Drain frames with non-blocking ``recv_into`` calls into pooled
+    buffers, up to ``batch`` frames per call.
+
+    ``recvmmsg`` isn't exposed by the ``socket`` module, so this still
+    costs a syscall per frame, but no allocations.
+    """
+    def __init__(self, sock, batch=64, pool=None):
+        super(BatchReceiver, self).__init__(sock)
+        self.batch = batch
+        self.pool = pool or BufferPool()
+
+    def recv(self):
+        count = 0
+        try:
+            while count < self.batch:
+                try:
+                    frame = recv_frame(self.sock, self.pool)
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    return
+
+                count += 1
+                yield frame
+        finally:
+            if count:
+                self.frames += count
+                self.batches += 1
+
+
+class RingReceiver(Receiver):
+    """Receive frames from a ``TPACKET_V3`` memory mapped ring.
+
+    Frames are yielded as transient views into the ring, which are only
+    valid until the receiver moves on to the next block; use
+    :py:meth:`pnet.Frame.detach` to hold on to one.
+
+    Parameters
+    ----------
+    block_size : int, size of each ring block, a multiple of the page size
+    block_nr : int, number of blocks in the ring
+    frame_size : int, maximum frame size
+    timeout : int, ms after which the kernel hands over a partial block
+    """
+    stats_struct = tpacket_stats_v3
+
+    def __init__(self, sock, block_size=1 << 16, block_nr=16,
+                 frame_size=2048, timeout=10):
+        super(RingReceiver, self).__init__(sock)
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.block = 0
+        # offset of the next frame and frames left in a partly read block
+        self.pkt = None
+        self.remaining = 0
+
+        sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        sock.setsockopt(SOL_PACKET, PACKET_RX_RING, tpacket_req3.pack(
+            block_size, block_nr, frame_size,
+            block_size * block_nr // frame_size, timeout, 0, 0))
+
+        try:
+            self.ring = mmap.mmap(sock.fileno(), block_size * block_nr,
+                                  mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+        except (EnvironmentError, ValueError):
+            # Tear the ring down again, or the kernel keeps delivering
+            # frames into it rather than to the socket's queue
+            sock.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                            tpacket_req3.pack(0, 0, 0, 0, 0, 0, 0))
+            raise
+        self.view = memoryview(self.ring)
+
+    def recv(self):
+        """Yield every frame currently available without blocking.
+
+        A block is only handed back to the kernel once all of its frames
+        were yielded, so the next call resumes where a generator closed
+        early left off.
+        """
+        while True:
+            offset = self.block * self.block_size
+            if self.pkt is None:
+                _, _, status, num_pkts, first = block_desc.unpack_from(
+                    self.view, offset)
+                if not status & TP_STATUS_USER:
+                    return
+                self.pkt = offset + first
+                self.remaining = num_pkts
+
+            while self.remaining:
+                next_offset, _, _, snaplen, _, _, mac = \
+                    tpacket3_hdr.unpack_from(self.view, self.pkt)
+                start = self.pkt + mac
+                # Move past the frame first, it's consumed once yielded
+                self.pkt += next_offset
+                self.remaining -= 1
+                self.frames += 1
+                yield Frame(self.view[start:start + snaplen],
+                            transient=True)
+
+            # Hand the block back to the kernel
+            struct.pack_into('I', self.view, offset + 8, TP_STATUS_KERNEL)
+            self.pkt = None
+            self.block = (self.block + 1) % self.block_nr
+            self.batches += 1
+
+    def close(self):
+        try:
+            self.view.release()
+            self.ring.close()
+        except BufferError:
+            # Frames still reference the ring, leave it to the gc
+            pass
+
+
+def open_receiver(sock, ring=True, **kwargs):
+    """Return a :py:class:`RingReceiver` for ``sock`` when ``ring`` is set
+    and the kernel supports it, otherwise a :py:class:`BatchReceiver`.
+    """
+    if ring:
+        try:
+            return RingReceiver(sock, **kwargs)
+        except (socket.error, EnvironmentError, ValueError):
+            pass
+    return BatchReceiver(sock)
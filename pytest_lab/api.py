@@ -1,5 +1,9 @@
+import time
+import hashlib
+import logging
 import pytest
 import requests
+from multiprocessing.pool import ThreadPool
 
 try:
     from urllib.parse import urljoin
@@ -7,25 +11,207 @@ except ImportError:
     from urlparse import urljoin
 
 
+logger = logging.getLogger('pytestlab')
+
+
+def _unavailable(err):
+    """Whether a request failed because the service is down, rather than
+    rejecting it, including 5xx errors from a proxy in front of it."""
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and err.response.status_code >= 500
+    return isinstance(err, (requests.ConnectionError, requests.Timeout))
+
+
+class MarkCache(object):
+    """Marks fetched for an environment, persisted in the pytest cache.
+
+    Marks are kept per item name, so they can be looked up whichever
+    requests they were fetched with. Each request's ``ETag`` and
+    ``Last-Modified`` validators are kept too, to revalidate it on the
+    next run. On :py:meth:`save` validators which weren't used and marks
+    of items not seen for ``max_age`` seconds are dropped.
+    """
+    def __init__(self, cache, env, max_age=30 * 24 * 3600):
+        self.cache = cache
+        self.key = 'pytestlab/marks/{}'.format(env)
+        self.max_age = max_age
+        data = cache.get(self.key, {}) if cache is not None else {}
+        self.validators = data.get('validators', {})
+        self.marks = data.get('marks', {})
+        self.used = set()
+
+    def __contains__(self, name):
+        return name in self.marks
+
+    def get(self, name):
+        entry = self.marks[name]
+        entry['seen'] = time.time()
+        return entry['marks']
+
+    def headers(self, key, names):
+        """Conditional headers for a request fetching ``names``, if all
+        of their marks are cached."""
+        entry = self.validators.get(key, {})
+        headers = {}
+        if not all(name in self.marks for name in names):
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def revalidated(self, key, names):
+        self.used.add(key)
+        return {name: self.get(name) for name in names}
+
+    def update(self, key, response, marks):
+        self.used.add(key)
+        self.validators[key] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        now = time.time()
+        for name, item_marks in marks.items():
+            self.marks[name] = {'marks': item_marks, 'seen': now}
+        return marks
+
+    def save(self):
+        if self.cache is None:
+            return
+        cutoff = time.time() - self.max_age
+        self.cache.set(self.key, {
+            'validators': {key: entry for key, entry
+                           in self.validators.items() if key in self.used},
+            'marks': {name: entry for name, entry in self.marks.items()
+                      if entry['seen'] >= cutoff},
+        })
+
+
 class TestMarker(object):
-    def __init__(self, config, url):
+    """Apply marks to collected items as dictated by a centralized API
+    service.
+
+    Marks for every item are fetched through the batch endpoint, a page of
+    ``page_size`` names per request. Should the service not provide it,
+    they're fetched an item at a time on up to ``workers`` threads.
+
+    Responses are cached on disk per ``--env`` and revalidated on the next
+    run. Once the service can't be reached within ``timeout`` seconds, or
+    responds with a server error, only cached marks are used.
+    """
+    def __init__(self, config, url, page_size=500, workers=8, timeout=10):
+        self.config = config
         self.url = url
+        self.page_size = page_size
+        self.workers = workers
+        self.timeout = timeout
+        self.cache = MarkCache(None, None)
+        self.offline = False
         self.session = requests.session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, key, names, parse, method, path, **kwargs):
+        """Fetch the marks of ``names``, revalidating those cached.
+
+        Returns a dict of marks by name, from ``parse`` applied to the
+        response, or None if the service responded with a status
+        indicating the endpoint isn't supported.
+        """
+        response = self.session.request(
+            method, urljoin(self.url, path), timeout=self.timeout,
+            headers=self.cache.headers(key, names), **kwargs)
+        if response.status_code == 304:
+            return self.cache.revalidated(key, names)
+        if response.status_code in (404, 405, 501):
+            return None
+        response.raise_for_status()
+        return self.cache.update(key, response, parse(response.json()))
 
     def get_marks(self, **params):
-        api_url = urljoin(self.url, '/v1/mark')
-        response = self.session.get(api_url, params=params)
-        return response.json()
+        name = params.get('name')
+        marks = self._request('mark:{}'.format(name), [name],
+                              lambda marks: {name: marks},
+                              'GET', '/v1/mark', params=params)
+        return marks[name] if marks else []
+
+    def get_marks_batch(self, env, names):
+        """Fetch the marks for all ``names`` through the batch endpoint.
+
+        Returns a dict of marks by item name, or None if the service
+        doesn't support batching.
+        """
+        marks = {}
+        for start in range(0, len(names), self.page_size):
+            page = names[start:start + self.page_size]
+            key = 'marks:{}'.format(hashlib.sha1(
+                '\n'.join(page).encode('utf-8')).hexdigest())
+            page_marks = self._request(
+                key, page,
+                lambda marks: {name: marks.get(name, []) for name in page},
+                'POST', '/v1/marks', json={'env': env, 'names': page})
+            if page_marks is None:
+                return None
+            marks.update(page_marks)
+        return marks
+
+    def get_cached_marks(self, names):
+        """Return the cached marks of ``names``, for use while offline.
+
+        Raises RuntimeError if any aren't cached, rather than running
+        them without the marks they may need, e.g. a skip.
+        """
+        missing = [name for name in names if name not in self.cache]
+        if missing:
+            raise RuntimeError(
+                'API service unavailable and no cached marks for {} '
+                'items: {}'.format(len(missing), ', '.join(missing[:10])))
+        return {name: self.cache.get(name) for name in names}
+
+    def fetch_marks(self, env, names):
+        """Return a dict of the marks for every name in ``names``."""
+        names = sorted(set(names))
+        if not names:
+            return {}
+
+        self.cache = MarkCache(getattr(self.config, 'cache', None), env)
+        try:
+            if self.offline:
+                return self.get_cached_marks(names)
+
+            try:
+                marks = self.get_marks_batch(env, names)
+                if marks is not None:
+                    return marks
+
+                pool = ThreadPool(max(1, min(self.workers, len(names))))
+                try:
+                    return dict(zip(names, pool.map(
+                        lambda name: self.get_marks(env=env, name=name),
+                        names)))
+                finally:
+                    pool.close()
+                    pool.join()
+            except requests.RequestException as err:
+                if not _unavailable(err) or \
+                        not any(name in self.cache for name in names):
+                    raise
+                logger.warning('API service unavailable, using cached '
+                               'marks: {}'.format(err))
+                self.offline = True
+                return self.get_cached_marks(names)
+        finally:
+            self.cache.save()
 
     @pytest.hookimpl(hookwrapper=True)
     def pytest_collection_modifyitems(self, session, config, items):
         env = config.getoption('--env')
 
-        # TODO: Really naive, we need add a batch call. Until then,
-        # this is going to be unworkable for anyone outside the
-        # Toronto office...
+        marks = self.fetch_marks(env, [item.name for item in items])
         for item in items:
-            for mark in self.get_marks(env=env, name=item.name):
+            for mark in marks.get(item.name, ()):
                 name = mark['name']
                 args = mark.get('args', [])
                 kwargs = mark.get('kwargs', {})
@@ -77,12 +77,18 @@ def pytest_lab_get_storage(item):
 def pytest_lab_process_logs(config, item, logs):
     """Broadcast all collected log files and where it came from
     to all subscribers.
+
+    ``logs`` maps each role ctl to a dict of the captured logs, keyed by
+    remote path or name, whose values are the local paths the logs were
+    stored at (possibly compressed), or their contents when no storage
+    is available.
     """
 
 @pytest.hookspec(historic=True)
 def pytest_lab_log_watch(config, logmanager):
     """Register a role ctl and a log file table to be watched and
-    processed.
+    processed, or with ``logmanager.watch`` patterns which halt the
+    session through ``pytest.halt`` as soon as they're found in a log.
     """
 
 @pytest.hookspec
@@ -10,18 +10,51 @@ Log monitoring and capture.
 from __future__ import division
 from builtins import next
 from builtins import object
+import os
+import time
+import signal
+import logging
+import threading
 import pytest
 from collections import defaultdict
-from lab.logwatch import logfiles, journal
+from multiprocessing.pool import ThreadPool
+from lab.logwatch import logfiles, journal, journalstream, logtail
+from lab.utils import encode_path
+
+
+logger = logging.getLogger('logwatch')
+
+# delivered to the main thread to abort a test when a pattern is found
+ABORT_SIGNAL = getattr(signal, 'SIGUSR1', None)
 
 
 class LogManager(object):
     """Remote log management and capture on a per test basis.
+
+    Sources are prepared and captured concurrently on up to ``workers``
+    threads, with at most ``per_host`` sources of any one role at once.
+    A source which takes longer than ``timeout`` seconds is abandoned and
+    its connection closed, so a hung host can't hold up the rest.
+
+    Logs registered with :py:meth:`watch` are followed in the background
+    and the session is halted with ``pytest.halt`` as soon as one of the
+    given patterns shows up in them, aborting the running test.
     """
-    def __init__(self, config):
+    def __init__(self, config, workers=8, per_host=1, timeout=60):
         self.config = config
         self.sources = defaultdict(list)
         self.recovered_logs = {}
+        self.item = None
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.watchers = defaultdict(list)
+        # (ctl, log, pattern, line) found since the test started
+        self.matches = []
+        self._running = False
+        self._reported = 0
+        # serializes signalling with restoring the abort signal's handler
+        self._abort_lock = threading.Lock()
 
     def register(self, source):
         """Register a role ctl with a log file table to be watched.
@@ -29,45 +62,248 @@ class LogManager(object):
         source.prepare()
         self.sources[source.ctl].append(source)
 
-    def _capture_logs(self, ctl, sources):
-        ctl_logs = self.recovered_logs.setdefault(ctl, {})
-        for source in sources:
-            ctl_logs.update(source.capture())
+    def watch(self, ctl, patterns, *tables):
+        """Follow the logs in ``tables`` on a role ctl and fail the running
+        test if a line matches any of the regular expressions in
+        ``patterns``.
+        """
+        watcher = logtail(ctl, patterns, *tables, on_match=self._on_match)
+        self.watchers[ctl].append(watcher)
+        return watcher
+
+    def _on_match(self, ctl, log, pattern, line):
+        self.matches.append((ctl, log, pattern, line))
+        with self._abort_lock:
+            if self._running:
+                os.kill(os.getpid(), ABORT_SIGNAL)
+
+    def _describe(self, matches):
+        return '\n'.join('{!r} found in {} on {}: {}'.format(
+            pattern, log, ctl, line) for ctl, log, pattern, line in matches)
+
+    def _halt(self):
+        matches = self.matches[self._reported:]
+        self._reported = len(self.matches)
+        if matches:
+            pytest.halt(self._describe(matches))
+
+    def _abort(self, signum, frame):
+        if self._running:
+            self._running = False
+            self._halt()
+
+    def _log_dir(self, item, ctl):
+        storage = self.config.hook.pytest_lab_get_storage(item=item)
+        if storage is None:
+            return None
+
+        prefix_path = '@'.join((ctl.name, ctl.hostname))
+        log_dir = storage.join('logs').join(prefix_path)
+        log_dir.mkdir()
+        return log_dir
+
+    def _write_log(self, log_dir, name, contents):
+        filename = str(name)
+        # any plumbum remote path should be encoded as an
+        # appropriate file name
+        if getattr(name, 'dirname', None):
+            filename = encode_path(filename)
+
+        localfile = log_dir.join(filename)
+        localfile.write(contents)
+        return localfile
+
+    def _map_sources(self, func, sources):
+        """Call ``func(ctl, source)`` for every source in the ``{ctl:
+        [source]}`` mapping ``sources``.
+
+        Returns ``(ctl, source, result)`` for every call which completed,
+        errors and timeouts are logged.
+        """
+        tasks = [(ctl, source) for ctl, ctl_sources in sources.items()
+                 for source in ctl_sources]
+        if not tasks:
+            return []
+
+        limits = {ctl: threading.Semaphore(self.per_host)
+                  for ctl in sources}
+        started = {}
+
+        def run(ctl, source):
+            with limits[ctl]:
+                started[id(source)] = time.time()
+                return func(ctl, source)
+
+        pool = ThreadPool(max(1, min(self.workers, len(tasks))))
+        try:
+            pending = [(ctl, source, pool.apply_async(run, (ctl, source)))
+                       for ctl, source in tasks]
+
+            results, hung = [], set()
+            for ctl, source, result in pending:
+                while not result.ready():
+                    began = started.get(id(source))
+                    if self.timeout and began and \
+                            time.time() - began > self.timeout:
+                        break
+                    if ctl in hung and not began:
+                        # stuck behind a hung source of the same host
+                        break
+                    result.wait(0.05)
+
+                if not result.ready():
+                    hung.add(ctl)
+                    if id(source) in started:
+                        self._abandon(ctl, source)
+                    else:
+                        logger.error('Skipped {} for {} behind a hung '
+                                     'source'.format(type(source).__name__,
+                                                     ctl))
+                    continue
+
+                try:
+                    results.append((ctl, source, result.get()))
+                except Exception:
+                    logger.exception('Log source {} for {} failed'.format(
+                        type(source).__name__, ctl))
+            return results
+        finally:
+            # doesn't wait on hung sources, whose connections were closed
+            pool.terminate()
+
+    def _abandon(self, ctl, source):
+        """Close the connection of a source which timed out, so the call
+        it's hung in fails rather than lingering on a worker thread.
+        """
+        logger.error('Abandoned {} for {} after {} seconds'.format(
+            type(source).__name__, ctl, self.timeout))
+        ssh = getattr(source, 'ssh', None)
+        if ssh is None:
+            return
+        try:
+            ssh.close()
+            # a Reliable proxy reconnects on next use
+            if hasattr(ssh, 'invalidate'):
+                ssh.invalidate()
+        except Exception:
+            logger.exception('Failed to close the connection of {} for '
+                             '{}'.format(type(source).__name__, ctl))
+
+    def _capture_source(self, source, log_dir):
+        if log_dir is None:
+            return list(source.capture())
+        elif hasattr(source, 'capture_to'):
+            return list(source.capture_to(log_dir))
+        return [(name, self._write_log(log_dir, name, contents))
+                for name, contents in source.capture()]
+
+    def _capture_logs(self, sources, item):
+        """Capture logs from the ``{ctl: [source]}`` mapping ``sources``
+        into the storage of ``item``.
+
+        Sources which can stream their logs to disk do so, the contents
+        of any other are written out as they're captured. Without any
+        storage the log contents are kept in memory.
+        """
+        log_dirs = {ctl: self._log_dir(item, ctl) if item else None
+                    for ctl in sources}
+        results = self._map_sources(
+            lambda ctl, source: self._capture_source(source, log_dirs[ctl]),
+            sources)
+        for ctl, _, logs in results:
+            self.recovered_logs.setdefault(ctl, {}).update(logs)
 
     @pytest.hookimpl(hookwrapper=True)
     def pytest_runtest_setup(self, item):
         """Truncate all logs prior to fixture invocations.
         """
         self.recovered_logs = {}
+        self.item = item
+        self.matches = []
+        self._reported = 0
         self.config.hook.pytest_lab_log_rotate()
-        for sources in self.sources.values():
-            for source in sources:
-                source.prepare()
+        self._map_sources(lambda ctl, source: source.prepare(), self.sources)
         yield
 
+    def pytest_sessionfinish(self, session):
+        watchers = [watcher for ctl_watchers in self.watchers.values()
+                    for watcher in ctl_watchers]
+        self.watchers.clear()
+        for watcher in watchers:
+            watcher.close()
+        for watcher in watchers:
+            watcher.join(1)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item):
+        """Halt as soon as a watched pattern is found during the test call.
+
+        The abort signal is only handled while the test function runs, so
+        it can't interrupt fixtures or other plugins' hooks.
+        """
+        previous = None
+        if ABORT_SIGNAL and self.watchers:
+            try:
+                previous = signal.signal(ABORT_SIGNAL, self._abort)
+            except ValueError:
+                # not the main thread, matches halt on teardown
+                logger.warning('Log watch matches will only halt on '
+                               'teardown')
+        self._running = previous is not None
+        try:
+            yield
+        finally:
+            # a signal already sent is ignored from here on
+            self._running = False
+            with self._abort_lock:
+                if previous is not None:
+                    signal.signal(ABORT_SIGNAL, previous)
+
     @pytest.hookimpl(hookwrapper=True)
     def pytest_runtest_teardown(self, item, nextitem):
         """Collect and store logs on test teardown.
         """
         yield
-        for ctl, sources in self.sources.items():
-            self._capture_logs(ctl, sources)
+        self._capture_logs(self.sources, item)
 
         self.config.hook.pytest_lab_process_logs(
             config=self.config, item=item, logs=self.recovered_logs)
 
+        # anything found outside the test call
+        self._halt()
+
     @pytest.hookimpl(trylast=True)
     def pytest_lab_role_destroyed(self, config, role):
         sources = self.sources.pop(role, None)
         if sources:
-            self._capture_logs(role, sources)
+            self._capture_logs({role: sources}, self.item)
+            for source in sources:
+                # stop any source following logs in the background
+                if hasattr(source, 'close'):
+                    source.close()
+        for watcher in self.watchers.pop(role, ()):
+            watcher.close()
+
+
+@pytest.hookimpl
+def pytest_addoption(parser):
+    group = parser.getgroup('logwatch')
+    group.addoption('--log-workers', action='store', type=int, default=8,
+                    help='number of log sources to prepare and capture '
+                         'concurrently')
+    group.addoption('--log-timeout', action='store', type=float,
+                    default=60, metavar='SECONDS',
+                    help='give up on a log source which takes longer, '
+                         'closing its connection (default: 60)')
 
 
 @pytest.hookimpl(trylast=True)
 def pytest_configure(config):
     """Register the log watch manager.
     """
-    logmanager = LogManager(config)
+    logmanager = LogManager(config,
+                            workers=config.getoption('--log-workers'),
+                            timeout=config.getoption('--log-timeout'))
     pytest.logmanager = logmanager
     # allow plugins to register for log watching
     config.hook.pytest_lab_log_watch.call_historic(
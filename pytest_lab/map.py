@@ -16,7 +16,9 @@ def pytest_lab_map(config, roles):
     if not mapfile:
         return
 
-    mapdata = config_v1.load(mapfile)
+    cache = getattr(config, 'cache', None)
+    cache_dir = cache.makedir('pytestlab') if cache else None
+    mapdata = config_v1.load(mapfile, cache_dir=cache_dir)
 
     environments, zones = mapdata
     envname = config.getoption('--env')
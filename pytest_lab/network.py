@@ -9,15 +9,72 @@ High level networking helpers
 """
 from builtins import next
 from builtins import zip
-from builtins import range
 import socket
 import errno
 import pytest
 import contextlib2
+from multiprocessing.pool import ThreadPool
 from lab import network
+from lab.network import utils
 from pytest_lab.roles import RoleNotFound
 
 
+def _iter_role_hosts(roles):
+    for data in (roles.data, roles.data.zone):
+        for role in (data or {}).values():
+            for loader in role.values():
+                facts = getattr(loader, 'kwargs', loader)
+                hostname = facts.get('hostname')
+                if hostname:
+                    yield hostname
+
+
+def prefetch(cache, hosts, versions=(4, 6), workers=16):
+    """Resolve ``hosts`` into ``cache`` in the background on up to
+    ``workers`` threads, in the same form as
+    :py:func:`lab.network.utils.check_ipaddr`.
+
+    Returns an ``AsyncResult`` to ``wait()`` on if need be.
+    """
+    def resolve(query):
+        try:
+            cache.getaddrinfo(query[0], 0, query[1], socket.SOCK_STREAM, 0,
+                              socket.AI_PASSIVE | socket.AI_CANONNAME)
+        except socket.gaierror:
+            pass
+
+    queries = [(host, utils.version_to_family(version))
+               for host in set(hosts) for version in versions]
+    pool = ThreadPool(max(1, min(workers, len(queries))))
+    try:
+        return pool.map_async(resolve, queries)
+    finally:
+        # workers exit once every query is resolved
+        pool.close()
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_lab_map(config, roles):
+    """Start resolving every host in the role map in the background."""
+    if roles.data:
+        prefetch(utils.dns_cache, _iter_role_hosts(roles))
+
+
+@pytest.hookimpl
+def pytest_terminal_summary(terminalreporter):
+    stats = utils.dns_cache.statistics()
+    if stats['hits'] or stats['misses']:
+        terminalreporter.write_line(
+            'dns cache: {hits} hits, {misses} misses, '
+            '{failures} failed lookups'.format(**stats))
+
+
+@pytest.fixture(scope='session')
+def dns_cache():
+    'The shared DNS resolver cache and its hit/miss statistics'
+    return utils.dns_cache
+
+
 @pytest.fixture(scope='session')
 def best_route(dut_host, ip_ver):
     return network.find_best_route(dut_host, version=ip_ver)
@@ -83,8 +140,8 @@ def vlan_set(primary_iface):
     with contextlib2.ExitStack() as stack:
         def inner(count):
             try:
-                return [stack.enter_context(network.MacVLan(primary_iface))
-                        for _ in range(count)]
+                return list(stack.enter_context(
+                    network.MacVLanSet(primary_iface, count)))
             except network.NetlinkError as err:
                 vlan_handle_error(err)
 
@@ -13,6 +13,7 @@ import plumbum
 import py
 import itertools
 from lab.utils import encode_path
+from lab.ssh import BulkTransfer
 
 
 def sanitized_name(name):
@@ -44,6 +45,20 @@ class ArtifactPath(object):
         plumbum.path.copy(remote, target)
         return target
 
+    def pull(self, sftp, remotepaths, local=None, **kwargs):
+        """Download ``remotepaths`` over ``sftp`` into this storage, or
+        into its ``local`` subdirectory, as a :py:class:`BulkTransfer`.
+        Files are stored under their encoded remote path.
+
+        Returns the transfer's :py:class:`TransferStats`.
+        """
+        target = self.path.join(local) if local else self.path
+        target.mkdir()
+        files = [(str(remote), str(target.join(encode_path(str(remote)))))
+                 for remote in remotepaths]
+        with BulkTransfer(sftp, **kwargs) as transfer:
+            return transfer.get_many(files)
+
     def open(self, path, mode='r'):
         target = self.path.join(path)
         return target.open(mode)
@@ -86,6 +101,13 @@ class StorageManager(object):
             item._storagedir = storagedir
         return self.join(storagedir)
 
+    def pull(self, item, sftp, remotepaths, local='artifacts', **kwargs):
+        """Pull remote artifacts into a test's storage."""
+        stats = self.get_storage(item).pull(sftp, remotepaths, local=local,
+                                            **kwargs)
+        pytest.log.info('Pulled {!r}'.format(stats))
+        return stats
+
     def pytest_runtest_setup(self, item):
         # Make sure the test storage directory is created, even if the
         # test doesn't happen to use it
@@ -93,22 +115,11 @@ class StorageManager(object):
 
     @pytest.hookimpl
     def pytest_lab_process_logs(self, config, item, logs):
+        # Logs are captured straight into the test's storage
         for ctl, logset in logs.items():
-            prefix_path = '@'.join((ctl.name, ctl.hostname))
-            prefix_dir = self.get_storage(item).join('logs').join(prefix_path)
-            prefix_dir.mkdir()
-
-            for remotefile, contents in logset.items():
-                absname = filename = str(remotefile)
-
-                # any plumbum remote path should be encoded as an
-                # appropriate file name
-                if getattr(remotefile, 'dirname', None):
-                    absname = encode_path(absname)
-
-                localfile = prefix_dir.join(absname)
-                localfile.write(contents)
-                pytest.log.info('Archived {}'.format(filename))
+            for remotefile, localfile in logset.items():
+                pytest.log.info('Archived {} as {}'.format(remotefile,
+                                                           localfile))
 
     @pytest.hookimpl
     def pytest_lab_get_storage(self, item):
@@ -1 +1,127 @@
+import pytest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 pytest_plugins = 'pytester'
+
+
+class FakeMsg(dict):
+    """A parsed netlink message."""
+    def get_attr(self, name):
+        return self.get('attrs', {}).get(name)
+
+
+class FakeIPRoute(object):
+    """An ``IPRoute`` serving dumps of the links, addresses, rules and
+    routes added to it. Route lookups for a ``dst`` are recorded in
+    ``lookups`` and answered with ``fib``.
+
+    Each batch sent calls the next of ``batches`` with the fake, if any,
+    to apply what the batch succeeded in. Link and address requests are
+    recorded in ``calls`` and raise a ``NetlinkError`` with the code
+    ``fail`` maps their command to.
+    """
+    def __init__(self):
+        self.links = []
+        self.addrs = []
+        self.batches = []
+        self.fail = {}
+        self.calls = []
+        self.closed = False
+        self.rules = []
+        self.routes = []
+        self.fib = []
+        self.lookups = []
+
+    def add_link(self, index, ifname, flags=1):
+        self.links.append(FakeMsg(index=index, flags=flags,
+                                  attrs={'IFLA_IFNAME': ifname}))
+
+    def add_addr(self, index, address, prefixlen):
+        self.addrs.append(FakeMsg(index=index, prefixlen=prefixlen,
+                                  attrs={'IFA_LOCAL': address}))
+
+    def add_rule(self, table, **attrs):
+        self.rules.append(FakeMsg(table=table,
+                                  attrs=dict(attrs, FRA_TABLE=table)))
+
+    @staticmethod
+    def route(dst, dst_len, oif, metric=0, table=254):
+        attrs = {'RTA_OIF': oif, 'RTA_PRIORITY': metric, 'RTA_TABLE': table}
+        if dst:
+            attrs['RTA_DST'] = dst
+        # a unicast route
+        return FakeMsg(dst_len=dst_len, type=1, table=table, attrs=attrs)
+
+    def add_route(self, *args, **kwargs):
+        self.routes.append(self.route(*args, **kwargs))
+
+    def get_links(self):
+        return list(self.links)
+
+    def get_addr(self, index=None):
+        return [msg for msg in self.addrs
+                if index is None or msg['index'] == index]
+
+    def get_rules(self, family=None):
+        return list(self.rules)
+
+    def get_routes(self, family=None, dst=None, table=None):
+        if dst is not None:
+            self.lookups.append(dst)
+            return list(self.fib)
+        return list(self.routes)
+
+    def _request(self, command, index):
+        from pyroute2 import NetlinkError
+        self.calls.append((command, index))
+        if command in self.fail:
+            raise NetlinkError(self.fail[command], command)
+
+    def link(self, command, index=None, **kwargs):
+        self._request(command, index)
+
+    def addr(self, command, index=None, **kwargs):
+        self._request('addr ' + command, index)
+
+    def sendto(self, data, address):
+        if self.batches:
+            apply = self.batches.pop(0)
+            if apply:
+                apply(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeEvents(object):
+    """A notification socket receiving the messages ``put`` to it."""
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def put(self, *msgs):
+        self.queue.put([FakeMsg(msg) for msg in msgs])
+
+    def get(self):
+        return self.queue.get()
+
+
+@pytest.fixture
+def ipr():
+    ipr = FakeIPRoute()
+    ipr.add_link(1, 'lo')
+    return ipr
+
+
+@pytest.fixture
+def events():
+    return FakeEvents()
+
+
+@pytest.fixture
+def netlink_cache(ipr, events):
+    from lab.network.netlink import NetlinkCache
+    return NetlinkCache(ipr=ipr, events=events)
@@ -0,0 +1,171 @@
+import json
+import threading
+import pytest
+import requests
+from pytest_lab import api
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
+
+
+MARKS = {'test_a': [{'name': 'skip', 'kwargs': {'reason': 'broken'}}]}
+
+
+class MarkHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200):
+        self.server.requests.append(self.path)
+        data = json.dumps(body).encode('utf-8')
+        etag = '"{}"'.format(hash(data))
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, data = 304, b''
+            self.server.revalidated += 1
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.server.status:
+            return self.reply({}, status=self.server.status)
+        query = parse_qs(urlparse(self.path).query)
+        self.reply(MARKS.get(query['name'][0], []))
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        request = json.loads(self.rfile.read(length).decode('utf-8'))
+        if self.server.status:
+            return self.reply({}, status=self.server.status)
+        if not self.server.batch:
+            return self.reply({}, status=404)
+        self.reply({name: MARKS.get(name, []) for name in request['names']})
+
+
+@pytest.fixture(params=[True, False], ids=['batch', 'fallback'])
+def server(request):
+    server = HTTPServer(('127.0.0.1', 0), MarkHandler)
+    server.batch = request.param
+    server.requests = []
+    server.revalidated = 0
+    # status every request fails with, e.g. from a proxy
+    server.status = None
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_marks_round_trips(server):
+    marker = api.TestMarker(None, 'http://127.0.0.1:{}'.format(
+        server.server_port), page_size=40)
+    names = ['test_{}'.format(idx) for idx in range(100)] + ['test_a']
+
+    marks = marker.fetch_marks('env', names)
+    assert marks['test_a'] == MARKS['test_a']
+    assert marks['test_0'] == []
+    if server.batch:
+        assert len(server.requests) == 3
+    else:
+        # one failed batch attempt, then a request per name
+        assert len(server.requests) == 1 + len(names)
+
+
+class FakeCache(dict):
+    def set(self, key, value):
+        # round trip through json like the pytest cache
+        self[key] = json.loads(json.dumps(value))
+
+
+class FakeConfig(object):
+    def __init__(self):
+        self.cache = FakeCache()
+
+
+def test_fetch_marks_cached(server):
+    config = FakeConfig()
+    url = 'http://127.0.0.1:{}'.format(server.server_port)
+    names = ['test_a', 'test_b']
+
+    first = api.TestMarker(config, url).fetch_marks('env', names)
+    assert list(config.cache) == ['pytestlab/marks/env']
+    assert not server.revalidated
+
+    second = api.TestMarker(config, url).fetch_marks('env', names)
+    assert second == first
+    assert server.revalidated == (1 if server.batch else 2)
+
+    server.shutdown()
+    server.server_close()
+    offline = api.TestMarker(config, url)
+    assert offline.fetch_marks('env', names) == first
+    assert offline.offline
+
+    # marks are cached per item, whatever pages they were fetched in
+    assert offline.fetch_marks('env', ['test_a']) == {
+        'test_a': MARKS['test_a']}
+    marker = api.TestMarker(config, url)
+    assert marker.fetch_marks('env', ['test_a']) == {
+        'test_a': MARKS['test_a']}
+    assert marker.offline
+
+    # items without cached marks aren't run unmarked
+    with pytest.raises(RuntimeError):
+        marker.fetch_marks('env', ['test_a', 'test_c'])
+
+
+@pytest.mark.parametrize('status', [502, 503, 504])
+def test_fetch_marks_server_errors(server, status):
+    config = FakeConfig()
+    url = 'http://127.0.0.1:{}'.format(server.server_port)
+    names = ['test_a', 'test_b']
+    first = api.TestMarker(config, url).fetch_marks('env', names)
+
+    server.status = status
+    marker = api.TestMarker(config, url)
+    assert marker.fetch_marks('env', names) == first
+    assert marker.offline
+
+    # without cached marks the error is raised
+    with pytest.raises(requests.HTTPError):
+        api.TestMarker(FakeConfig(), url).fetch_marks('env', names)
+
+
+def test_fetch_marks_prunes_cache(server):
+    config = FakeConfig()
+    url = 'http://127.0.0.1:{}'.format(server.server_port)
+    api.TestMarker(config, url).fetch_marks('env', ['test_a', 'test_b'])
+    api.TestMarker(config, url).fetch_marks('env', ['test_a'])
+    cached = config.cache['pytestlab/marks/env']
+    # only the validators of this run's requests are kept
+    assert len(cached['validators']) == 1
+    assert sorted(cached['marks']) == ['test_a', 'test_b']
+
+    # marks of items not seen for max_age are dropped
+    cache = api.MarkCache(config.cache, 'env', max_age=3600)
+    cache.marks['test_b']['seen'] -= 7200
+    cache.save()
+    assert sorted(config.cache['pytestlab/marks/env']['marks']) == ['test_a']
+
+
+def test_fetch_marks_times_out():
+    import socket
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    try:
+        # accepts connections but never responds
+        marker = api.TestMarker(None, 'http://127.0.0.1:{}'.format(
+            listener.getsockname()[1]), timeout=0.2)
+        with pytest.raises(requests.Timeout):
+            marker.fetch_marks('env', ['test_a'])
+    finally:
+        listener.close()
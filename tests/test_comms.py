@@ -0,0 +1,104 @@
+import threading
+import time
+from lab import comms
+
+
+class FakeSession(object):
+    def __init__(self, location):
+        self.location = location
+        self.up = True
+
+    def close(self):
+        self.up = False
+
+
+def test_session_pool_limits_connections():
+    pool = comms.SessionPool('loc', FakeSession, lambda s: s.up, size=2)
+    seen = []
+
+    def work():
+        with pool.session() as session:
+            seen.append(session)
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = pool.statistics()
+    assert len(set(map(id, seen))) == 2
+    assert stats['connections'] == stats['idle'] == 2
+    assert stats['waits'] and stats['wait_time'] > 0
+    pool.close()
+
+
+def test_session_pool_drops_dead_sessions():
+    pool = comms.SessionPool('loc', FakeSession, lambda s: s.up, size=1,
+                             check_interval=0.01)
+    with pool.session() as session:
+        pass
+
+    session.up = False
+    time.sleep(0.1)
+    assert pool.statistics()['connections'] == 0
+    with pool.session() as fresh:
+        assert fresh is not session
+    pool.close()
+
+
+class FlakyCommand(object):
+    """Like a plumbum command, only fails once it's run."""
+    def __init__(self, session, argv):
+        self.session = session
+        self.argv = argv
+
+    def __getitem__(self, args):
+        return FlakyCommand(self.session, self.argv + [args])
+
+    def __call__(self):
+        if not self.session.up:
+            raise comms.SSHCommsError(self.argv, 255, '', 'connection lost')
+        return ' '.join(self.argv)
+
+    def popen(self):
+        return self()
+
+
+class FlakySession(FakeSession):
+    def __getitem__(self, cmd):
+        return FlakyCommand(self, [cmd])
+
+    def run(self, cmd):
+        return self[cmd]()
+
+
+def test_reliable_caches_health_and_retries(monkeypatch):
+    checks, sessions = [], []
+
+    def factory(location):
+        sessions.append(FlakySession(location))
+        return sessions[-1]
+
+    def is_up(session):
+        checks.append(session)
+        return session.up
+
+    monkeypatch.setitem(comms._registry, 'flaky', {
+        'factory': factory, 'is_up': is_up,
+        'magic_methods': ['__getitem__']})
+    proxy = comms.reliable_proxy('loc', 'flaky', liveness_interval=60)
+
+    assert [proxy['ls']() for _ in range(10)] == ['ls'] * 10
+    assert len(sessions) == 1 and not checks
+
+    # the command is bound before the connection is lost
+    ls = proxy['ls']['-l']
+    sessions[0].up = False
+    assert ls() == 'ls -l'
+    assert len(sessions) == 2 and checks == [sessions[0]]
+
+    sessions[1].up = False
+    assert proxy.run('ls') == 'ls'
+    assert len(sessions) == 3 and checks == sessions[:2]
@@ -0,0 +1,116 @@
+import socket
+import threading
+import time
+import pytest
+import pnet
+from pnet.ring import BatchReceiver
+from pnet.dhcp4 import DHCPPacket, DHCPOpCode, DHCPMessage, DHCPOption
+from lab.network import dhcp
+
+
+SRC = pnet.HWAddress(b'\x02\x00\x00\x00\x00\x01')
+
+
+class PairSocket(object):
+    """A stand in for ``DHCP4Socket`` over one end of a socketpair."""
+    def __init__(self, ifname, pool):
+        self.ifname = ifname
+        self.closed = False
+        self.sock, self.peer = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.rx = BatchReceiver(self.sock, pool=pool)
+        self.src = SRC
+
+    def reply(self, xid, message_type=DHCPMessage.Offer):
+        options = [(DHCPOption.DHCPMessageType, [message_type])]
+        packet = DHCPPacket(DHCPOpCode.Reply, xid=xid, chaddr=SRC,
+                            yiaddr=b'\x0a\x00\x00\x05', options=options)
+        self.peer.send(bytes(dhcp.generate_packet(SRC, packet.tobytes())))
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+        self.peer.close()
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(dhcp.DHCP4Engine, '_open',
+                        lambda self, ifname: PairSocket(ifname, self.pool))
+    return dhcp.DHCP4Engine()
+
+
+def request(xid):
+    return DHCPPacket(DHCPOpCode.Request, xid=xid, chaddr=SRC, options=[
+        (DHCPOption.DHCPMessageType, [DHCPMessage.Discover])])
+
+
+def test_engine_matches_replies_by_xid(engine):
+    first, second = engine.attach('eth0'), engine.attach('eth1')
+    one = engine.exchange(first, request(b'\x00\x00\x00\x01'),
+                          DHCPMessage.Offer)
+    two = engine.exchange(second, request(b'\x00\x00\x00\x02'),
+                          DHCPMessage.Offer)
+
+    second.reply(b'\x00\x00\x00\x09')
+    second.reply(b'\x00\x00\x00\x01')
+    second.reply(b'\x00\x00\x00\x02')
+    assert two.result(timeout=1).xid == b'\x00\x00\x00\x02'
+    assert one.result(timeout=1).xid == b'\x00\x00\x00\x01'
+
+    three = engine.exchange(first, request(b'\x00\x00\x00\x03'),
+                            DHCPMessage.ACK)
+    first.reply(b'\x00\x00\x00\x03', DHCPMessage.NAK)
+    with pytest.raises(RuntimeError, match='protocol error'):
+        three.result(timeout=1)
+
+
+def test_engine_retransmits_then_expires(engine):
+    sock = engine.attach('eth0')
+    transaction = engine.exchange(sock, request(b'\x00\x00\x00\x01'),
+                                  DHCPMessage.Offer, interval=0.05,
+                                  retry=3, timeout=0.3)
+    with pytest.raises(RuntimeError, match='Failed to acquire'):
+        transaction.result(timeout=1)
+
+    sock.peer.setblocking(0)
+    sent = []
+    while True:
+        try:
+            sent.append(sock.peer.recv(0x1000))
+        except socket.error:
+            break
+    assert len(sent) == 3 and len(set(sent)) == 1
+    assert not engine._pending
+
+
+def test_engine_timers_run_in_order(engine):
+    fired, done = [], threading.Event()
+    for delay in (0.06, 0.02, 0.04):
+        engine.call_later(delay, lambda delay=delay: fired.append(delay))
+    engine.call_later(0.03, lambda: fired.append('cancelled')).cancel()
+    engine.call_later(0.08, done.set)
+
+    assert done.wait(1)
+    assert fired == [0.02, 0.04, 0.06]
+
+
+def test_engine_survives_receive_errors(engine):
+    sock = engine.attach('eth0')
+    recv = sock.rx.recv
+
+    def broken():
+        sock.rx.recv = recv
+        raise socket.error('boom')
+        yield
+
+    sock.rx.recv = broken
+    sock.reply(b'\x00\x00\x00\x07')
+    time.sleep(0.1)
+
+    transaction = engine.exchange(sock, request(b'\x00\x00\x00\x01'),
+                                  DHCPMessage.Offer)
+    sock.reply(b'\x00\x00\x00\x01')
+    assert transaction.result(timeout=1).xid == b'\x00\x00\x00\x01'
+    assert engine._thread.is_alive()
@@ -0,0 +1,324 @@
+import os
+import sys
+import json
+import time
+import plumbum
+import pytest
+from lab import logwatch
+
+
+class FakeCtl(object):
+    hostname = 'localhost'
+
+    def ssh(self):
+        return plumbum.local
+
+
+@pytest.fixture
+def logdir(tmpdir):
+    tmpdir.join('app.log').write('before\n')
+    return tmpdir
+
+
+def capture(source):
+    return [(os.path.basename(str(log)), data)
+            for log, data in source.capture()]
+
+
+def test_incremental_capture_leaves_logs(logdir):
+    source = logwatch.logfiles(FakeCtl(), (str(logdir), ['app.log']),
+                               incremental=True)
+    source.prepare()
+    logdir.join('app.log').write('during\n', mode='a')
+
+    assert capture(source) == [('app.log', 'during\n')]
+    assert logdir.join('app.log').read() == 'before\nduring\n'
+
+
+def test_incremental_capture_follows_rotation(logdir):
+    source = logwatch.logfiles(FakeCtl(), (str(logdir), ['app.log']),
+                               incremental=True)
+    source.prepare()
+    logdir.join('app.log').write('during\n', mode='a')
+    logdir.join('app.log').rename(logdir.join('app.log.1'))
+    logdir.join('app.log').write('after\n')
+
+    assert capture(source) == [('app.log.1', 'during\n'),
+                               ('app.log', 'after\n')]
+
+
+def test_incremental_capture_copytruncate(logdir):
+    source = logwatch.logfiles(FakeCtl(), (str(logdir), ['app.log']),
+                               incremental=True)
+    source.prepare()
+    log = logdir.join('app.log')
+    log.write('during\n', mode='a')
+    log.copy(logdir.join('app.log.1'))
+    log.write('')
+    log.write('after\n', mode='a')
+
+    assert capture(source) == [('app.log.1', 'during\n'),
+                               ('app.log', 'after\n')]
+
+
+def test_discover_rotations_in_one_listing(logdir):
+    for name in ('app.log.1', 'app.log.2', 'app.log.4', 'other.log'):
+        logdir.join(name).write('x')
+
+    source = logwatch.logfiles(FakeCtl(), (str(logdir), ['app.log']))
+    stats = source.discover(str(logdir), ['app.log', 'missing.log'])
+    assert sorted(stats) == ['app.log', 'app.log.1', 'app.log.2', 'app.log.4']
+    assert stats['app.log'].st_size == len('before\n')
+    assert logwatch.rotation_chain(stats, 'app.log') == [
+        'app.log', 'app.log.1', 'app.log.2']
+
+
+def test_truncating_prepare(logdir):
+    logdir.join('app.log.1').write('old')
+    source = logwatch.logfiles(FakeCtl(), (str(logdir), ['app.log']))
+    source.prepare()
+    assert logdir.join('app.log').read() == ''
+    assert not logdir.join('app.log.1').exists()
+
+    logdir.join('app.log').write('during\n')
+    assert capture(source) == [('app.log', 'during\n')]
+
+
+@pytest.mark.parametrize('compress, suffix', [('gzip', '.gz'), (None, '')])
+def test_capture_to_streams_compressed(logdir, tmpdir_factory, compress,
+                                       suffix):
+    import gzip
+
+    target = tmpdir_factory.mktemp('storage')
+    source = logwatch.logfiles(FakeCtl(), (str(logdir), ['app.log']),
+                               incremental=True, compress=compress)
+    source.prepare()
+    logdir.join('app.log').write('during\n', mode='a')
+
+    (log, path), = source.capture_to(target)
+    assert str(log) == str(logdir.join('app.log'))
+    assert path.endswith('app.log' + suffix)
+    opener = gzip.open if compress else open
+    with opener(path, 'rb') as fp:
+        assert fp.read() == b'during\n'
+
+
+@pytest.mark.parametrize('compress', ['gzip', None])
+def test_capture_to_drops_failed_reads(logdir, tmpdir_factory, monkeypatch,
+                                       compress):
+    target = tmpdir_factory.mktemp('storage')
+    source = logwatch.logfiles(FakeCtl(), (str(logdir), ['app.log']),
+                               compress=compress)
+    monkeypatch.setattr(source, '_reader',
+                        lambda log, offset: 'cat /nonexistent/app.log')
+
+    assert list(source.capture_to(target)) == []
+    assert target.listdir() == []
+
+
+def test_capture_to_drains_stderr(logdir, tmpdir_factory, monkeypatch):
+    target = tmpdir_factory.mktemp('storage')
+    source = logwatch.logfiles(FakeCtl(), (str(logdir), ['app.log']),
+                               compress=None)
+    reader = source._reader
+    # more than a pipe's buffer worth of stderr
+    monkeypatch.setattr(source, '_reader', lambda log, offset: (
+        'head -c 1000000 /dev/zero >&2; ' + reader(log, offset)))
+
+    (log, path), = source.capture_to(target)
+    with open(path, 'rb') as fp:
+        assert fp.read() == b'before\n'
+
+
+class FakeSSH(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class SlowSource(object):
+    def __init__(self, ctl, delay):
+        self.ctl = ctl
+        self.delay = delay
+        self.ssh = FakeSSH()
+
+    def capture(self):
+        import time
+        time.sleep(self.delay)
+        yield self.ctl, 'log of {}'.format(self.ctl)
+
+
+def test_log_manager_captures_concurrently_with_timeout():
+    import time
+    from pytest_lab.logwatch import LogManager
+
+    manager = LogManager(config=None, workers=4, timeout=0.5)
+    sources = {ctl: [SlowSource(ctl, 0.2)] for ctl in ('a', 'b', 'c')}
+    sources['hung'] = [SlowSource('hung', 5), SlowSource('hung', 0)]
+
+    start = time.time()
+    manager._capture_logs(sources, item=None)
+    assert time.time() - start < 2
+    assert manager.recovered_logs == {
+        ctl: {ctl: 'log of {}'.format(ctl)} for ctl in ('a', 'b', 'c')}
+    # the hung source's connection is closed, the one behind it never ran
+    assert [source.ssh.closed for source in sources['hung']] == [
+        True, False]
+    assert not any(source.ssh.closed for source in sources['a'])
+
+
+def test_log_manager_default_timeout():
+    from pytest_lab.logwatch import LogManager
+    assert LogManager(config=None).timeout
+
+
+FAKE_JOURNALCTL = '''#!{python}
+import sys, time
+args = sys.argv[1:]
+journal = {journal!r}
+lines = open(journal).readlines()
+if '--follow' not in args:
+    sys.stdout.write(lines[-1] if lines else '')
+    sys.exit()
+if '--after-cursor' in args:
+    cursor = args[args.index('--after-cursor') + 1]
+    pos = [l for l in lines if '"c{{}}"'.format(cursor[1:]) in l]
+    pos = lines.index(pos[0]) + 1
+else:
+    pos = len(lines)
+while True:
+    lines = open(journal).readlines()
+    for line in lines[pos:]:
+        sys.stdout.write(line)
+    sys.stdout.flush()
+    pos = len(lines)
+    time.sleep(0.01)
+'''
+
+
+def journal_entry(idx, message):
+    return json.dumps({'__CURSOR': 'c{}'.format(idx), 'MESSAGE': message,
+                       '__REALTIME_TIMESTAMP': str(idx * 1000000),
+                       'SYSLOG_IDENTIFIER': 'app', '_PID': '1'}) + '\n'
+
+
+class JournalCtl(FakeCtl):
+    def __init__(self, journalctl):
+        self.journalctl = journalctl
+
+    def ssh(self):
+        return {'journalctl': plumbum.local[self.journalctl]}
+
+
+@pytest.fixture
+def journal(tmpdir):
+    journal = tmpdir.join('journal')
+    journal.write(journal_entry(1, 'before'))
+    return journal
+
+
+@pytest.fixture
+def journalstream(journal, tmpdir):
+    script = tmpdir.join('journalctl')
+    script.write(FAKE_JOURNALCTL.format(python=sys.executable,
+                                        journal=str(journal)))
+    script.chmod(0o755)
+
+    source = logwatch.journalstream(JournalCtl(str(script)), 'app.service')
+    yield source
+    source.close()
+
+
+def test_journalstream_captures_between_cursors(journal, journalstream,
+                                                tmpdir):
+    journal.write(journal_entry(2, 'setup'), mode='a')
+    journalstream.prepare()
+    journal.write(journal_entry(3, 'during'), mode='a')
+    journal.write(journal_entry(4, [0x6f, 0x6b, 0xff]), mode='a')
+
+    [(unit, text)] = journalstream.capture()
+    assert unit == 'app.service'
+    assert journalstream.cursor == 'c4'
+    assert [line.split(' ', 2)[2] for line in text.splitlines()] == [
+        'app[1]: during', u'app[1]: ok\ufffd']
+
+    (unit, path), = journalstream.capture_to(tmpdir)
+    assert path.endswith('app.service.journal.gz')
+    import gzip
+    with gzip.open(path, 'rb') as fp:
+        assert fp.read().decode('utf-8') == text
+
+    # the spool only holds entries since the last prepare
+    journalstream.prepare()
+    assert os.fstat(journalstream._spool.fileno()).st_size == 0
+    assert list(journalstream.capture_to(tmpdir.mkdir('empty'))) == []
+    assert tmpdir.join('empty').listdir() == []
+
+
+def test_journalstream_idle_unit(journalstream):
+    start = time.time()
+    journalstream.prepare()
+    assert list(journalstream.capture()) == []
+    # neither waits out the sync timeout
+    assert time.time() - start < journalstream.sync_timeout
+    assert journalstream.cursor == 'c1'
+
+
+def test_pattern_matcher_names_pattern():
+    matcher = logwatch.PatternMatcher(['segfault', r'Out of (\w+)',
+                                       r'(?P<code>oops \d+)'])
+    assert matcher.search('kernel: app[12]: segfault at 0') == 'segfault'
+    assert matcher.search('Out of memory: kill app') == r'Out of (\w+)'
+    assert matcher.search('oops 3') == r'(?P<code>oops \d+)'
+    assert matcher.search('all good') is None
+
+
+@pytest.fixture
+def halt(monkeypatch):
+    from pytest_lab.runnerctl import Halt
+    halt = Halt()
+    # normally provided through pytest_namespace by runnerctl
+    monkeypatch.setattr(pytest, 'halt', halt, raising=False)
+    return halt
+
+
+def test_watch_halts_running_test(logdir, halt):
+    import signal
+    from pytest_lab.logwatch import LogManager
+    manager = LogManager(None)
+    previous = signal.getsignal(signal.SIGUSR1)
+    watcher = manager.watch(FakeCtl(), ['segfault'],
+                            (str(logdir), ['app.log']))
+    try:
+        call = manager.pytest_runtest_call(item=None)
+        next(call)
+        assert signal.getsignal(signal.SIGUSR1) == manager._abort
+        try:
+            with pytest.raises(pytest.fail.Exception) as excinfo:
+                for _ in range(200):
+                    logdir.join('app.log').write('app: segfault\n',
+                                                 mode='a')
+                    time.sleep(0.05)
+            assert 'segfault' in str(excinfo.value)
+            assert 'segfault' in halt.msg
+        finally:
+            call.close()
+        assert not manager._running
+        # the handler is only installed for the test call
+        assert signal.getsignal(signal.SIGUSR1) == previous
+    finally:
+        manager.pytest_sessionfinish(session=None)
+    assert not manager.watchers
+    assert watcher.matches[0][1:] == ('segfault', 'app: segfault')
+
+
+def test_pattern_matcher_rejects_global_flags():
+    with pytest.raises(ValueError):
+        logwatch.PatternMatcher(['(?i)segfault'])
+    with pytest.raises(ValueError):
+        logwatch.PatternMatcher([r'(?P<p1>oops)'])
+
+    matcher = logwatch.PatternMatcher(['(?i:segfault)|oom', r'\(?x\)'])
+    assert matcher.search('SEGFAULT') == '(?i:segfault)|oom'
+    assert matcher.search('x)') == r'\(?x\)'
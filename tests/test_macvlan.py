@@ -0,0 +1,64 @@
+import ipaddress
+import pytest
+from pyroute2 import NetlinkError
+from lab.network import macvlan
+
+
+class FakeLease(object):
+    yiaddr = ipaddress.IPv4Address(u'10.0.0.5')
+    prefixlen = 24
+
+    def wait(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def leases(monkeypatch):
+    monkeypatch.setattr(macvlan, 'DHCP4', lambda link, wait: FakeLease())
+
+
+def create(up=True):
+    """A batch creating two macvlans, the second only brought up if
+    ``up`` is set."""
+    def apply(ipr):
+        ipr.add_link(2, 'macvlan0')
+        ipr.add_link(3, 'macvlan1', flags=int(up))
+    return apply
+
+
+def test_set_raises_for_links_not_brought_up(ipr, netlink_cache):
+    ipr.batches = [create(up=False)]
+    ipr.fail = {'set': 95, 'del': 16}
+    with pytest.raises(NetlinkError) as excinfo:
+        macvlan.MacVLanSet('lo', 2, dhcp=False, cache=netlink_cache,
+                           ipr=ipr)
+    # the cleanup failing doesn't mask why the set failed
+    assert excinfo.value.code == 95
+    assert ipr.calls == [('set', 3), ('del', 2)]
+    assert ipr.closed
+
+
+def test_set_raises_for_addresses_not_added(ipr, netlink_cache):
+    ipr.batches = [create(), None,
+                   lambda ipr: ipr.add_addr(2, '10.0.0.5', 24)]
+    ipr.fail = {'addr add': 99}
+    with pytest.raises(NetlinkError):
+        macvlan.MacVLanSet('lo', 2, cache=netlink_cache, ipr=ipr)
+    assert ipr.calls == [('addr add', 3), ('del', 2), ('del', 3)]
+
+
+def test_set_close_deletes_leftover_links(ipr, netlink_cache):
+    ipr.batches = [create()]
+    vlans = macvlan.MacVLanSet('lo', 2, dhcp=False, cache=netlink_cache,
+                               ipr=ipr)
+    assert [vlan.name for vlan in vlans] == ['macvlan0', 'macvlan1']
+    assert not ipr.calls
+
+    ipr.fail = {'del': 16}
+    with pytest.raises(NetlinkError):
+        vlans.close()
+    assert ipr.calls == [('del', 2)]
+    assert ipr.closed and not len(vlans)
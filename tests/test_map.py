@@ -105,3 +105,87 @@ def test_load_custom_map(testdir_with_map_hookimpl):
 
     result = testdir_with_map_hookimpl.runpytest()
     assert result.ret == 0
+
+
+MAP = '''
+zones:
+  mock_zone:
+    roles:
+      mock:
+        - mocker.example:
+            greeting: Hello Zone
+
+environments:
+  mock_env:
+    zones: [mock_zone]
+'''
+
+
+def test_load_caches_parsed_map(tmpdir, monkeypatch):
+    mapfile = tmpdir.join('map.yaml')
+    mapfile.write(MAP)
+    cache_dir = tmpdir.mkdir('cache')
+
+    envs, zones = config_v1.load(mapfile, cache_dir=cache_dir)
+    assert envs['mock_env']['zones'] == ['mock_zone']
+    loader = zones['mock_zone']['roles']['mock']['mocker.example']
+    assert loader.kwargs == {'greeting': 'Hello Zone'}
+
+    def parse(*args, **kwargs):
+        raise AssertionError('map parsed again')
+
+    monkeypatch.setattr(config_v1, 'YAML', parse)
+    cached_envs, cached_zones = config_v1.load(mapfile, cache_dir=cache_dir)
+    assert cached_envs == envs
+    assert cached_zones['mock_zone']['roles']['mock'][
+        'mocker.example'].kwargs == loader.kwargs
+
+    mapfile.write(MAP.replace('Zone', 'Changed'))
+    with pytest.raises(AssertionError):
+        config_v1.load(mapfile, cache_dir=cache_dir)
+
+
+def test_load_parses_lazily(tmpdir, monkeypatch):
+    mapfile = tmpdir.join('map.yaml')
+    mapfile.write(MAP + '''
+  other_env:
+    roles:
+      mock:
+        - mocker.example: {}
+''')
+    parsed = []
+    parse_common = config_v1._parse_common
+
+    def record(yaml, domain=None):
+        parsed.append(yaml)
+        return parse_common(yaml, domain)
+
+    monkeypatch.setattr(config_v1, '_parse_common', record)
+    envs, zones = config_v1.load(mapfile)
+    assert sorted(envs) == ['mock_env', 'other_env'] and not parsed
+
+    assert envs.get('mock_env')['zones'] == ['mock_zone']
+    assert envs['mock_env'] is envs['mock_env']
+    assert len(parsed) == 1
+    assert zones.get('missing', {}) == {}
+
+
+def test_load_parses_yaml_1_2(tmpdir):
+    mapfile = tmpdir.join('map.yaml')
+    mapfile.write(MAP + """
+  scalar_env:
+    roles:
+      mock:
+        - mocker.example:
+            flag: on
+            answer: yes
+            mode: 010
+            duration: 1:30
+""")
+    kwargs = [config_v1.load(mapfile, roundtrip=roundtrip)[0][
+        'scalar_env']['roles']['mock']['mocker.example'].kwargs
+        for roundtrip in (False, True)]
+    # YAML 1.1 would have made these True, True, 8 and 90
+    assert kwargs[0] == {'flag': 'on', 'answer': 'yes', 'mode': 10,
+                         'duration': '1:30'}
+    assert kwargs[0] == dict(kwargs[1])
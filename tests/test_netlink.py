@@ -0,0 +1,43 @@
+import errno
+import threading
+from lab.network import netlink
+
+
+class OverflowingEvents(object):
+    """Lose notifications once released, then block forever."""
+    def __init__(self):
+        self.release = threading.Event()
+        self.blocked = threading.Event()
+        self.calls = 0
+
+    def get(self):
+        self.calls += 1
+        if self.calls == 1:
+            self.release.wait()
+            raise OSError(errno.ENOBUFS, 'No buffer space available')
+        self.blocked.set()
+        threading.Event().wait()
+
+
+def test_cache_syncs_on_start(netlink_cache):
+    assert netlink_cache['lo']['index'] == 1
+    assert netlink_cache.index('lo') == 1
+    assert 'lo' in netlink_cache and 2 not in netlink_cache
+
+
+def test_cache_resyncs_after_lost_notifications(ipr):
+    events = OverflowingEvents()
+    cache = netlink.NetlinkCache(ipr=ipr, events=events)
+    notified = []
+    cache.subscribe(notified.append)
+
+    # a link created while notifications were being dropped
+    ipr.add_link(7, 'macvlan0')
+    ipr.add_addr(7, '10.0.0.5', 24)
+    assert 'macvlan0' not in cache
+    events.release.set()
+    # still receiving after the resync
+    assert events.blocked.wait(1)
+
+    assert notified == [None]
+    assert cache['macvlan0']['ipaddr'] == {('10.0.0.5', 24)}
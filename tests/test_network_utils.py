@@ -0,0 +1,48 @@
+import socket
+import pytest
+from lab.network import utils
+from pytest_lab.network import prefetch
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    calls = []
+
+    def getaddrinfo(host, *args):
+        calls.append(host)
+        if host.endswith('.invalid'):
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, host,
+                 ('10.0.0.1', 0))]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    return calls
+
+
+def test_resolver_cache(lookups):
+    cache = utils.ResolverCache()
+    for _ in range(3):
+        assert cache.getaddrinfo('dut', 0)[0][4] == ('10.0.0.1', 0)
+        with pytest.raises(socket.gaierror):
+            cache.getaddrinfo('dut.invalid', 0)
+
+    assert lookups == ['dut', 'dut.invalid']
+    stats = cache.statistics()
+    assert (stats['hits'], stats['misses'], stats['failures']) == (4, 2, 1)
+
+
+def test_resolver_cache_expiry(lookups):
+    cache = utils.ResolverCache(ttl=0, negative_ttl=0)
+    cache.getaddrinfo('dut', 0)
+    cache.getaddrinfo('dut', 0)
+    assert lookups == ['dut', 'dut']
+
+
+def test_resolver_cache_prefetch(lookups):
+    cache = utils.ResolverCache()
+    prefetch(cache, ['dut', 'dut', 'peer'], versions=(4,), workers=1).wait()
+
+    assert sorted(lookups) == ['dut', 'peer']
+    cache.getaddrinfo('dut', 0, socket.AF_INET, socket.SOCK_STREAM, 0,
+                      socket.AI_PASSIVE | socket.AI_CANONNAME)
+    assert cache.statistics()['hits'] == 1
@@ -0,0 +1,55 @@
+import plumbum
+from lab import parallel
+
+
+class FakeCtl(object):
+    ssh = plumbum.local
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+def test_fan_out_collects_results():
+    ctls = [FakeCtl('a'), FakeCtl('b')]
+    lines = []
+    results = parallel.fan_out(
+        ctls, 'sh', ['-c', 'echo out; echo err >&2'],
+        on_output=lambda ctl, stream, line: lines.append((str(ctl), stream,
+                                                          line)))
+
+    assert [result.ctl for result in results] == ctls
+    assert all(result.ok for result in results)
+    assert results[0].stdout == 'out\n' and results[0].stderr == 'err\n'
+    assert sorted(lines) == [('a', 'stderr', 'err'), ('a', 'stdout', 'out'),
+                             ('b', 'stderr', 'err'), ('b', 'stdout', 'out')]
+    assert all(result.elapsed >= 0 for result in results)
+
+
+def test_fan_out_failures_and_timeouts():
+    results = parallel.fan_out(
+        [FakeCtl('a')], lambda ssh: ssh['sh']['-c', 'exit 3'])
+    assert results.failed[0].retcode == 3
+
+    results = parallel.fan_out([FakeCtl('a')], 'sleep', ['5'], timeout=0.1)
+    assert results[0].timed_out and results[0].elapsed < 5
+    try:
+        results.check()
+    except parallel.FanOutError as err:
+        assert err.results == results
+    else:
+        assert False, 'check() should raise'
+
+
+def test_fan_out_timeout_kills_remote_command(tmpdir):
+    import time
+    marker = tmpdir.join('finished')
+    results = parallel.fan_out(
+        [FakeCtl('a')], 'sh',
+        ['-c', '(sleep 1; touch {}) & wait'.format(marker)], timeout=0.2)
+    assert results[0].timed_out and results[0].elapsed < 1
+    # the whole command was killed on the host, not just the client
+    time.sleep(1.5)
+    assert not marker.exists()
@@ -0,0 +1,261 @@
+import ipaddress
+import pytest
+import pnet
+
+
+SRC = pnet.HWAddress(b'\x02\x00\x00\x00\x00\x01')
+
+
+@pytest.fixture
+def ip4():
+    return pnet.ip4hdr({'src': ipaddress.IPv4Address(u'10.0.0.1'),
+                        'dst': ipaddress.IPv4Address(u'10.0.0.2'),
+                        'proto': 17,
+                        'len': 28},
+                       buf=bytearray(28))
+
+
+def test_layout_matches_min_size():
+    for hdr in (pnet.ethhdr, pnet.sllhdr, pnet.ip4hdr, pnet.udphdr):
+        assert hdr.layout.size == hdr.min_size
+
+
+def test_encode_defaults(ip4):
+    data = ip4.tobytes()
+    assert len(data) == pnet.ip4hdr.min_size
+    assert data[0:1] == b'\x45'  # verlen
+    assert data[8:9] == b'\x80'  # ttl
+    assert data[12:] == b'\x0a\x00\x00\x01\x0a\x00\x00\x02'
+
+
+def test_parse_roundtrip(ip4):
+    parsed = pnet.ip4hdr.parse(ip4.tobytes())
+    assert parsed['src'] == ipaddress.IPv4Address(u'10.0.0.1')
+    assert parsed['ttl'] == 128
+    assert all(parsed[name] == value for name, value in ip4.items())
+    assert parsed.tobytes() == ip4.tobytes()
+
+
+def test_parse_is_lazy(ip4):
+    parsed = pnet.ip4hdr.parse(ip4.tobytes())
+    assert not dict.__len__(parsed)
+    assert parsed['proto'] == 17
+    assert dict.__len__(parsed) == 1
+    assert len(parsed) == len(pnet.ip4hdr.fields)
+
+
+def test_parse_short_buffer():
+    with pytest.raises(pnet.ParseError):
+        pnet.udphdr.parse(b'\x00' * 4)
+
+
+def test_set_field_rewrites_only_its_bytes(ip4):
+    before = ip4.tobytes()
+    ip4['csum'] = 0xbeef
+    after = ip4.tobytes()
+    assert after[10:12] == b'\xbe\xef'
+    assert after[:10] == before[:10] and after[12:] == before[12:]
+
+
+def test_set_field_on_parsed_buffer(ip4):
+    frame = bytearray(ip4.tobytes())
+    parsed = pnet.ip4hdr.parse(frame)
+    parsed['ttl'] = 1
+    assert frame[8] == 1
+    assert pnet.ip4hdr.parse(frame)['dst'] == ip4['dst']
+
+
+def test_set_field_without_content_writes_defaults():
+    udp = pnet.udphdr(buf=bytearray(8))
+    udp['dport'] = 67
+    assert udp.tobytes() == b'\x00\x00\x00\x43\x00\x00\x00\x00'
+
+    ip4 = pnet.ip4hdr(buf=bytearray(20))
+    ip4['proto'] = 17
+    assert ip4.tobytes()[0:1] == b'\x45'
+
+
+def test_native_byte_order_field(ip4):
+    ip4['flags'] = 0x4000
+    assert pnet.ip4hdr.parse(ip4.tobytes())['flags'] == 0x4000
+
+
+def test_payload(ip4):
+    ip4.payload = b'\x01' * 8
+    assert ip4.payload.tobytes() == b'\x01' * 8
+    assert pnet.ethhdr({'src': SRC, 'dst': SRC, 'type': pnet.ETH_P_IP},
+                       buf=bytearray(14)).tobytes()[12:] == b'\x08\x00'
+
+
+def make_dhcp_frame(xid=b'\x01\x02\x03\x04'):
+    from lab.network.dhcp import generate_packet
+    from pnet.dhcp4 import DHCPPacket, DHCPOpCode, DHCPMessage, DHCPOption
+
+    options = [(DHCPOption.DHCPMessageType, [DHCPMessage.Offer])]
+    packet = DHCPPacket(DHCPOpCode.Reply, xid=xid, chaddr=SRC,
+                        yiaddr=b'\x0a\x00\x00\x05', options=options)
+    return bytes(generate_packet(SRC, packet.tobytes()))
+
+
+@pytest.fixture
+def sockpair():
+    import socket
+    pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    yield pair
+    for sock in pair:
+        sock.close()
+
+
+def test_frame_views_share_buffer(sockpair):
+    from pnet.dhcp4 import DHCPPacket, DHCPMessage
+
+    sender, receiver = sockpair
+    frame_data = make_dhcp_frame()
+    sender.send(frame_data)
+
+    pool = pnet.BufferPool(count=1)
+    frame = pnet.recv_frame(receiver, pool)
+    assert len(frame) == len(frame_data)
+    assert frame.payload.obj is frame.buf
+    assert frame.ip4['proto'] == 17
+    assert DHCPPacket.peek_xid(frame.payload) == b'\x01\x02\x03\x04'
+
+    reply = DHCPPacket.parse(frame.payload)
+    assert reply.yiaddr == b'\x0a\x00\x00\x05'
+    assert reply.message_type == DHCPMessage.Offer
+
+    frame.release()
+    assert pool.acquire() is frame.buf
+
+
+def test_dhcp_parse_requires_cookie():
+    from pnet.dhcp4 import DHCPPacket
+
+    with pytest.raises(pnet.ParseError):
+        DHCPPacket.parse(b'\x00' * 300)
+
+
+@pytest.mark.parametrize('data, expected', [
+    (b'', 0xffff),
+    (b'\x00\x00', 0xffff),
+    (b'\xff\xff', 0x0000),
+    (b'\x45\x00\x00\x73\x00\x00\x40\x00\x40\x11'
+     b'\x00\x00\xc0\xa8\x00\x01\xc0\xa8\x00\xc7', 0xb861),
+    (b'\x01', 0xfeff),
+])
+def test_checksum(data, expected):
+    assert pnet.checksum(data) == expected
+
+
+def test_checksum_chunks():
+    data = bytes(bytearray(range(251)))
+    expected = pnet.checksum(data)
+    assert pnet.checksum(data[:3], memoryview(data)[3:100],
+                         data[100:]) == expected
+    assert pnet.Checksum(data[:7]).update(data[7:]).value == expected
+
+
+@pytest.mark.parametrize('offset', [0, 1, 10, 249])
+def test_checksum_incremental_update(offset):
+    data = bytearray(range(251))
+    csum = pnet.Checksum(bytes(data))
+    old = bytes(data[offset:offset + 2])
+    data[offset:offset + 2] = b'\xde\xad'
+    csum.replace(offset, old, b'\xde\xad')
+    assert csum.value == pnet.checksum(bytes(data))
+
+
+def test_batch_receiver(sockpair):
+    from pnet.ring import BatchReceiver
+
+    sender, receiver = sockpair
+    receiver.setblocking(0)
+    for xid in range(5):
+        sender.send(make_dhcp_frame(xid=bytes(bytearray([xid] * 4))))
+
+    rx = BatchReceiver(receiver, batch=3, pool=pnet.BufferPool(count=1))
+    frames = [frame.detach() for frame in rx.recv()]
+    assert len(frames) == 3
+    assert len(set(id(frame.buf) for frame in frames)) == 3
+    assert [frame.ip4['proto'] for frame in rx.recv()] == [17, 17]
+    assert not list(rx.recv())
+    assert (rx.frames, rx.batches) == (5, 2)
+
+
+def test_transient_frame_detach_copies():
+    buf = bytearray(make_dhcp_frame())
+    frame = pnet.Frame(buf, transient=True)
+    detached = frame.detach()
+    buf[:] = b'\x00' * len(buf)
+    assert detached.eth['type'] == pnet.ETH_P_IP
+
+
+ETH_P_TEST = 0x88b5
+
+
+@pytest.fixture
+def packet_sockets():
+    import socket
+    try:
+        sender, receiver = [
+            socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                          socket.htons(ETH_P_TEST)) for _ in range(2)]
+    except (AttributeError, socket.error):
+        pytest.skip('AF_PACKET sockets unavailable')
+    receiver.bind(('lo', ETH_P_TEST))
+    receiver.setblocking(0)
+    sender.bind(('lo', ETH_P_TEST))
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+
+def send_test_frames(sender, count):
+    import struct
+    for idx in range(count):
+        sender.send(b'\xff' * 12 + struct.pack('!HI', ETH_P_TEST, idx) +
+                    b'\x00' * 40)
+
+
+def frame_index(frame):
+    import struct
+    return struct.unpack_from('!I', frame.buf, 14)[0]
+
+
+def test_ring_receiver_resumes_block(packet_sockets):
+    import time
+    from pnet.ring import RingReceiver
+
+    sender, receiver = packet_sockets
+    rx = RingReceiver(receiver, block_size=1 << 12, block_nr=4, timeout=1)
+    try:
+        send_test_frames(sender, 5)
+        time.sleep(0.05)
+
+        # closing the generator mid-block keeps the rest of the block
+        for frame in rx.recv():
+            first = frame_index(frame)
+            break
+        seen = [first] + [frame_index(frame) for frame in rx.recv()]
+        # lo delivers outgoing frames too
+        assert sorted(set(seen)) == list(range(5))
+        assert not list(rx.recv())
+    finally:
+        rx.close()
+
+
+def test_ring_torn_down_when_mmap_fails(packet_sockets, monkeypatch):
+    import mmap
+    from pnet.ring import BatchReceiver, open_receiver
+
+    def fail(*args, **kwargs):
+        raise EnvironmentError('mmap failed')
+    monkeypatch.setattr(mmap, 'mmap', fail)
+
+    sender, receiver = packet_sockets
+    rx = open_receiver(receiver)
+    assert isinstance(rx, BatchReceiver)
+
+    send_test_frames(sender, 3)
+    # frames reach the socket's queue rather than the unmapped ring
+    assert set(frame_index(frame) for frame in rx.recv()) == {0, 1, 2}
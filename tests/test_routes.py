@@ -0,0 +1,85 @@
+import time
+import threading
+import pytest
+from lab.network import routes
+
+
+@pytest.fixture
+def resolver(ipr, netlink_cache):
+    for idx in range(2, 6):
+        ipr.add_link(idx, 'eth{}'.format(idx - 1))
+        ipr.add_addr(idx, '172.16.0.{}'.format(idx - 1), 24)
+    netlink_cache.sync_links()
+    netlink_cache.sync_addrs()
+
+    for table in routes.DEFAULT_POLICY:
+        ipr.add_rule(table)
+    ipr.add_route(None, 0, 2, metric=100)
+    ipr.add_route(None, 0, 3, metric=50)
+    ipr.add_route('10.0.0.0', 8, 2)
+    ipr.add_route('10.1.0.0', 16, 4)
+    ipr.add_route('192.168.0.0', 16, 5, table=routes.RT_TABLE_DEFAULT)
+    # what the kernel answers lookups with
+    ipr.fib = [ipr.route(None, 0, 2)]
+    return routes.RouteResolver(netlink=netlink_cache)
+
+
+def ifnames(results):
+    return {dst: ifname for dst, (ifname, _) in results.items()}
+
+
+def test_resolve_many_longest_prefix_then_metric(ipr, resolver):
+    results = resolver.resolve_many(['10.1.2.3', '10.2.0.1', '8.8.8.8',
+                                     '192.168.1.1'])
+    assert ifnames(results) == {'10.1.2.3': 'eth3', '10.2.0.1': 'eth1',
+                                '8.8.8.8': 'eth2', '192.168.1.1': 'eth2'}
+    assert str(results['10.1.2.3'][1]) == '172.16.0.3'
+    assert not ipr.lookups
+
+    del ipr.routes[:2]
+    assert ifnames(resolver.resolve_many(['192.168.1.1', '8.8.8.8'])) == {
+        '192.168.1.1': 'eth2', '8.8.8.8': 'eth2'}  # cached
+    assert (resolver.hits, resolver.misses) == (2, 4)
+
+    resolver.invalidate()
+    assert ifnames(resolver.resolve_many(['192.168.1.1'])) == {
+        '192.168.1.1': 'eth4'}
+
+
+def test_resolve_many_invalidated_by_notifications(ipr, events,
+                                                   netlink_cache, resolver):
+    resolver.resolve_many(['8.8.8.8'])
+    del ipr.routes[:2]
+
+    # listeners are called in order, so the resolver was notified first
+    notified = threading.Event()
+    netlink_cache.subscribe(lambda msg: notified.set())
+    events.put({'event': 'RTM_DELROUTE'})
+    assert notified.wait(1)
+    with pytest.raises(RuntimeError):
+        resolver.resolve_many(['8.8.8.8'])
+
+
+def test_resolve_many_expires_entries(resolver):
+    resolver.ttl = 0.01
+    resolver.resolve_many(['10.1.2.3'])
+    time.sleep(0.02)
+    resolver.resolve_many(['10.1.2.3'])
+    assert (resolver.hits, resolver.misses) == (0, 2)
+
+
+def test_resolve_many_defers_to_fib_lookups(ipr, resolver):
+    # this host's own addresses are routed through the local table
+    resolver.resolve_many(['172.16.0.3'])
+    assert ipr.lookups == ['172.16.0.3']
+
+    ipr.add_rule(100)
+    results = resolver.resolve_many(['10.1.2.3'])
+    assert ipr.lookups == ['172.16.0.3', '10.1.2.3']
+    assert ifnames(results) == {'10.1.2.3': 'eth1'}
+
+    ipr.rules.pop()
+    ipr.add_rule(0, FRA_L3MDEV=1)
+    resolver.invalidate()
+    resolver.resolve_many(['10.1.2.3'])
+    assert len(ipr.lookups) == 3
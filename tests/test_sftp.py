@@ -0,0 +1,153 @@
+import os
+import socket
+import threading
+import paramiko
+import pytest
+from lab import ssh
+
+
+class StubServer(paramiko.ServerInterface):
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        if attr.st_size is not None:
+            self.writefile.flush()
+            os.ftruncate(self.writefile.fileno(), attr.st_size)
+        return paramiko.SFTP_OK
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    """Serve the local filesystem, mostly as in paramiko's own tests."""
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(
+                os.lstat(os.path.join(path, name)), name)
+                for name in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        mode = 'r+b' if flags & (os.O_WRONLY | os.O_RDWR) else 'rb'
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+
+@pytest.fixture(scope='module')
+def host_key():
+    return paramiko.RSAKey.generate(1024)
+
+
+@pytest.fixture
+def sftp(host_key):
+    client_sock, server_sock = socket.socketpair()
+    server = paramiko.Transport(server_sock)
+    server.add_server_key(host_key)
+    server.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTPServer)
+    event = threading.Event()
+    server.start_server(event, StubServer())
+
+    client = paramiko.Transport(client_sock)
+    client.connect()
+    client.auth_none('test')
+    event.wait(5)
+    sftp = paramiko.SFTPClient.from_transport(client)
+    yield sftp
+    sftp.close()
+    client.close()
+    server.close()
+
+
+@pytest.fixture
+def tree(tmpdir):
+    for path in ('a/b/c/deep.log', 'a/one.log', 'a/b/two.txt', 'top.log',
+                 'skip/hidden.log'):
+        tmpdir.join(path).ensure()
+    return tmpdir
+
+
+def relpaths(root, entries):
+    return sorted(os.path.relpath(path, str(root)) for path, _ in entries)
+
+
+def test_iter_tree(sftp, tree):
+    entries = list(ssh.iter_tree(sftp, str(tree), window=2))
+    assert relpaths(tree, entries) == sorted([
+        'a', 'a/b', 'a/b/c', 'a/b/c/deep.log', 'a/one.log', 'a/b/two.txt',
+        'top.log', 'skip', 'skip/hidden.log'])
+    assert all(attr.st_size is not None for _, attr in entries)
+    # breadth first
+    depths = [path.count('/') for path, _ in entries]
+    assert depths == sorted(depths)
+
+
+def test_iter_tree_filters(sftp, tree):
+    entries = ssh.iter_tree(sftp, str(tree), include=['*.log'],
+                            exclude=['skip'], maxdepth=2)
+    assert relpaths(tree, entries) == ['a/one.log', 'top.log']
+
+
+@pytest.fixture
+def blob(tmpdir):
+    data = os.urandom(300 * 1024 + 7)
+    tmpdir.join('blob.bin').write_binary(data)
+    return data
+
+
+def test_bulk_get_and_put(sftp, tmpdir, blob):
+    src = str(tmpdir.join('blob.bin'))
+    files = [(src, str(tmpdir.join('out', 'copy{}.bin'.format(idx))))
+             for idx in range(3)]
+    with ssh.BulkTransfer(sftp, chunk_size=64 * 1024, concurrency=2) as bulk:
+        stats = bulk.get_many(files)
+        assert (stats.files, stats.bytes) == (3, 3 * len(blob))
+        assert stats.throughput > 0
+
+        stats = bulk.put(src, str(tmpdir.join('put.bin')))
+        assert stats.bytes == len(blob)
+
+    for _, local in files:
+        assert tmpdir.join('out', os.path.basename(local)).read_binary() == blob
+    assert tmpdir.join('put.bin').read_binary() == blob
+
+
+def test_bulk_resume(sftp, tmpdir, blob):
+    src = str(tmpdir.join('blob.bin'))
+    partial = tmpdir.join('partial.bin')
+    partial.write_binary(blob[:100000])
+
+    bulk = ssh.BulkTransfer(sftp, chunk_size=32 * 1024)
+    stats = bulk.get(src, str(partial))
+    assert (stats.bytes, stats.resumed) == (len(blob) - 100000, 100000)
+    assert partial.read_binary() == blob
+
+    # a partial file which doesn't match is transferred again
+    tmpdir.join('other.bin').write_binary(b'y' * 50000)
+    stats = bulk.put(src, str(tmpdir.join('other.bin')))
+    assert (stats.bytes, stats.resumed) == (len(blob), 0)
+    assert tmpdir.join('other.bin').read_binary() == blob
@@ -0,0 +1,44 @@
+import os
+import socket
+import subprocess
+import pytest
+from lab import ssh
+
+
+def sshd_available(host='localhost', port=22):
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+    except socket.error:
+        return False
+    return subprocess.call(['ssh', '-o', 'BatchMode=yes'] + ssh.SSH_OPTS +
+                           [host, 'true']) == 0
+
+
+def test_control_master_connection_refused():
+    with pytest.raises(ssh.SSHException) as excinfo:
+        ssh.ControlMaster('127.0.0.1', port=1)
+    # the master's output is kept for the error
+    assert 'refused' in str(excinfo.value)
+
+
+def test_ssh_opts_without_multiplexing():
+    assert ssh.get_ssh_opts('localhost', multiplex=False) == ssh.SSH_OPTS
+    assert ssh.get_control_opts('localhost', multiplex=False) == []
+
+
+@pytest.mark.skipif(not sshd_available(),
+                    reason='requires key based ssh access to localhost')
+def test_multiplexed_machines_share_master():
+    first = ssh.get_generic_ssh('localhost', multiplex=True)
+    second = ssh.get_generic_ssh('localhost', multiplex=True)
+    try:
+        master = ssh.get_control_master('localhost')
+        assert master.alive
+        assert first['true']() == second['true']() == ''
+
+        check = ['ssh', '-O', 'check'] + master.options + ['localhost']
+        assert subprocess.call(check) == 0
+    finally:
+        first.close()
+        second.close()
+    assert os.path.exists(master.path)